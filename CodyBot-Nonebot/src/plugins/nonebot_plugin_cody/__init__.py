@@ -5,144 +5,222 @@
 # Filename: __init__
 # Created on: 2022/12/27
 
+import time
+import asyncio
 import base64
 from nonebot import on_message, on_command, get_bot
 from nonebot.adapters.onebot import V11Bot as Bot
 from nonebot.adapters.onebot.v11 import Message, MessageEvent, PrivateMessageEvent, MessageSegment, GroupMessageEvent
 from nonebot_plugin_htmlrender import md_to_pic
 
-from .addons import CommandAddon, ReminderAddon
+from .addons import DefaultsAddon, ReminderAddon
 from .config import *
 from .builtin_basic_presets import BUILTIN_PRIVATE_PRESET, BUILTIN_GROUP_PRESET, BUILTIN_PRIVATE_NSFW_PRESET
-from .session import CREATOR_ID, CREATOR_GF_ID, SessionGPT35
-from .api import get_chat_response, CODY_HEADER, ANONYMOUS_HUMAN_HEADER
-from .session import SessionGPT3, INVALID_APIs
+from .session import CREATOR_ID, CREATOR_GF_ID, SessionGPT35, InboundMessage
+from .api import CHAT_CLIENT, CODY_HEADER, ANONYMOUS_HUMAN_HEADER
 from .userdata import Impression
+from .manager import SessionManager, SessionPersister
+from .store import SessionStore
+from .scheduler import ALARM_SCHEDULER
 
 # REGISTERED_ADDONS = [CommandAddon, ReminderAddon]
 REGISTERED_ADDONS = []
 
-user_session = {}
-group_session = {}
-
-user_lock = {}
-group_lock = {}
-
 impression_database: Impression
+session_store: SessionStore
+user_session: SessionManager
+group_session: SessionManager
+session_persister: SessionPersister
+warm_up_task: asyncio.Task = None  # background task loading recently active sessions
+session_sweeper: asyncio.Task = None  # background task evicting idle sessions
 
 
-def list_session_caches(is_group: bool = False) -> dict:
+def api_status_text() -> str:
     """
-    list all session caches in cache directory
-    :param is_group: bool, 'True' - return groups only, 'False' - return users only
-    :return: dict({int ID}: {str Path})
+    return status text of API key pool
+    :return: str
     """
-    memory_dir = Path(CODY_CONFIG.cody_session_cache_dir)
-    # list all files under cache directory
-    if is_group:
-        # fetch groups only
-        files = memory_dir.glob("group_*.session")
-    else:
-        # fetch users only
-        files = memory_dir.glob("user_*.session")
+    total_api_count = len(APIKEY_LIST)
+    invalid_apis = APIKEY_LIST.invalid_ids()
+    valid_count = total_api_count - len(invalid_apis)
+    return "[API key status: {}/{}, integrity: {}%, in flight: {}, invalid list: {}]\n" \
+           "[chat turns in flight: {}/{}, queued: {} private / {} group, dropped: {} private / {} group]".format(
+        valid_count,
+        total_api_count,
+        int(100 * valid_count / total_api_count) if total_api_count else 0,
+        APIKEY_LIST.in_flight(),
+        ", ".join([str(i) for i in invalid_apis]),
+        ADMISSION.in_flight(),
+        ADMISSION.max_in_flight,
+        ADMISSION.waiting(RequestPriority.interactive),
+        ADMISSION.waiting(RequestPriority.group),
+        ADMISSION.shed(RequestPriority.interactive),
+        ADMISSION.shed(RequestPriority.group)
+    )
+
+
+def new_user_session(user_id: int, name: str = None) -> SessionGPT35:
+    """
+    create a new user session
+    :param user_id: QQ ID
+    :param name: str or None, nickname of user
+    :return: SessionGPT35
+    """
+    # get user name from impression database
+    user = impression_database.get_individual(int(user_id))
 
-    ret = {}
-    # parse ID from filename
-    for ele in files:
-        ele = ele.as_posix()
-        ret.update({
-            int(ele.split("_")[1][:-8]): ele
-        })
+    # initialize a new session handler
+    return SessionGPT35(
+        user_id,
+        is_group=False,
+        name=user.name,  # use name saved in impression database
+        addons=REGISTERED_ADDONS,
+        impression_db=impression_database,
+        bot=get_bot()
+    )
 
-    return ret
+
+def new_group_session(group_id: int, name: str = None) -> SessionGPT35:
+    """
+    create a new group session
+    :param group_id: group QQ ID
+    :param name: str or None, not used
+    :return: SessionGPT35
+    """
+    # get group name from impression database
+    group = impression_database.get_group(int(group_id))
+
+    # initialize a new session handler
+    return SessionGPT35(
+        group_id,
+        is_group=True,
+        name=group.name,
+        addons=REGISTERED_ADDONS,
+        impression_db=impression_database,
+        bot=get_bot()
+    )
 
 
 def get_user_session(user_id, name=None) -> SessionGPT35:
     """
-    get a user session with specific QQ ID, and create a new session if none was found in RAM
+    get a user session with specific QQ ID, load it from session store or create a new session
+    if none was found in RAM
     :param user_id: QQ ID
     :param name: str or None, nickname of user
     :return: SessionGPT35
     """
-    if user_id not in user_session:
-        # get user name from impression database
-        user = impression_database.get_individual(int(user_id))
-
-        # initialize a new session handler
-        user_session[user_id] = SessionGPT35(
-            user_id,
-            is_group=False,
-            name=user.name,  # use name saved in impression database
-            addons=REGISTERED_ADDONS,
-            impression_db=impression_database,
-            bot=get_bot()
-        )
-        # check if there is previously saved session files to load
-        files = list_session_caches(is_group=False)
-        if int(user_id) in files:
-            # open previously saved session files and load
-            with open(files[int(user_id)], 'rb') as f:
-                user_session[user_id].load(f.read().decode())
-                f.close()
-
-    return user_session[user_id]
+    return user_session.get(user_id, name)
 
 
 def dump_user_session(user_id) -> bool:
     """
-    dump specific user session to file
+    dump specific user session to session store
     :param user_id: QQ ID
     :return: bool, return operation status
     """
-    memory_dir = Path(CODY_CONFIG.cody_session_cache_dir)
+    return user_session.dump(user_id)
 
-    if user_id not in user_session:
-        # return False when user not found
-        return False
 
-    # generate session dumps
-    session_dumps = user_session[user_id].dump(use_base64=True)
+def get_group_session(group_id) -> SessionGPT35:
+    """
+    get a group session with specific QQ ID, load it from session store or create a new session
+    if none was found in RAM
+    :param group_id: group QQ ID
+    :return: SessionGPT35
+    """
+    return group_session.get(group_id)
 
-    # open file and save
-    with open(memory_dir.joinpath(f"user_{str(user_id)}.session").as_posix(), 'wb') as f:
-        f.write(session_dumps.encode())
-        f.close()
 
-    return True
+def dump_group_session(group_id) -> bool:
+    """
+    dump specific group session to session store
+    :param group_id: group QQ ID
+    :return: bool, return operation status
+    """
+    return group_session.dump(group_id)
 
 
-def get_group_session(group_id) -> SessionGPT35:
+async def send_chat_response(matcher, session: SessionGPT35, messages: list, reply_to: int = None) -> bool:
     """
-    get a group session with specific QQ ID, and create a new session if none was found in RAM
-    :param group_id: group QQ ID
-    :return: SessionGPT35
+    get Cody's response from session and send it with matcher, sentence by sentence if stream mode is enabled
+    :param matcher: Matcher, nonebot matcher to send messages
+    :param session: SessionGPT35
+    :param messages: list of InboundMessage, messages of one turn
+    :param reply_to: int (optional), message ID to quote in the first sentence
+    :return: bool, whether if anything was sent
+    """
+
+    async def send(text: str):
+        if reply_to is not None and not sent:
+            text = MessageSegment.reply(reply_to) + text
+        try:
+            await matcher.send(text)
+        except Exception:
+            img = await md_to_pic(str(text))
+            img = base64.b64encode(img).decode()
+            await matcher.send("[消息发送失败可能是被风控，建议使用文转图模式,本回复已转为图片模式]"
+                               + MessageSegment.image(f"base64://{img}"))
+
+    sent = False
+    if CODY_CONFIG.cody_stream_response:
+        # send every completed sentence as soon as it is ready
+        async for sentence in session.get_chat_response_stream(messages):
+            await send(sentence)
+            sent = True
+
+    else:
+        resp = await session.get_chat_response(messages)
+        if resp != "……":
+            await send(resp)
+            sent = True
+
+    return sent
+
+
+def flush_impressions():
+    """
+    write changed impression frames to database in one transaction
+    :return:
     """
-    if group_id not in group_session:
-        # get group name from impression database
-        group = impression_database.get_group(int(group_id))
+    try:
+        impression_database.flush()
+    except Exception as err:
+        logger.error(f"failed to save impressions, {err}")
 
-        # initialize a new session handler
-        group_session[group_id] = SessionGPT35(
-            group_id,
-            is_group=True,
-            name=group.name,
-            addons=REGISTERED_ADDONS,
-            impression_db=impression_database,
-            bot=get_bot()
-        )
 
-        # check if there is previously saved session files to load
-        files = list_session_caches(is_group=True)
-        if int(group_id) in files:
-            # open previously saved session files and load
-            with open(files[int(group_id)], 'rb') as f:
-                group_session[group_id].load(f.read().decode())
-                f.close()
+async def handle_chat_message(matcher, session: SessionGPT35, message: InboundMessage):
+    """
+    queue a message in session inbox. messages that arrive while session is busy are answered together in one
+    turn by the coroutine owning the inbox, the others return immediately. every turn has to be admitted by
+    admission controller, turns dropped under load are not answered
+    :param matcher: Matcher, nonebot matcher to send messages
+    :param session: SessionGPT35
+    :param message: InboundMessage
+    :return:
+    """
+    if not session.enqueue(message):
+        # current inbox owner will answer it
+        return
 
-    return group_session[group_id]
+    try:
+        while True:
+            batch = await session.take_batch()
+            if not batch:
+                break
 
+            if not await ADMISSION.admit(session.request_priority(batch), batch[0].timestamp):
+                session.log(f"[WARNING] dropped {len(batch)} message(s) under load")
+                continue
 
-# TODO: 添加dump_group_session
+            try:
+                # quote the latest message of this turn
+                await send_chat_response(matcher, session, batch, reply_to=batch[-1].reply_to)
+            finally:
+                ADMISSION.release()
+                # save impressions changed in this turn
+                flush_impressions()
+    finally:
+        session.release_inbox()
 
 
 # 基本群聊（连续对话）
@@ -175,15 +253,7 @@ async def _get_gpt_response(bot: Bot, event: GroupMessageEvent):
 
             elif len(cmd) > 1 and cmd[1] in ("api", "apikey", "status"):
                 # 查询状态
-                total_api_count = len(APIKEY_LIST)
-                invalid_count = len(INVALID_APIs)
-                status_text = "[API key status: {}/{}, integrity: {}%, invalid list: {}]".format(
-                    total_api_count - invalid_count,
-                    total_api_count,
-                    int(100 * (total_api_count - invalid_count) / total_api_count),
-                    ", ".join([str(i) for i in INVALID_APIs])
-                )
-                await group_chat_session.send(status_text)
+                await group_chat_session.send(api_status_text())
 
             else:
                 await group_chat_session.send("[unknown command]")
@@ -198,34 +268,10 @@ async def _get_gpt_response(bot: Bot, event: GroupMessageEvent):
     if not msg:
         return
 
-    if session_id in group_lock and group_lock[session_id]:
-        await group_chat_session.finish("[消息太快啦～请稍后]", at_sender=True)
-
-    group_lock[session_id] = True
-    resp = "……"
-    for i in range(2):
-        resp = await get_group_session(group_id).get_chat_response(msg, user_id=user_id, user_name=user_name)
-        if resp != "……":
-            break
-
-    # 发送消息
-    if resp != "……":
-        message_id = event.source.id
-        group_id = event.sender.group.id
-        msg_chain = event.message_chain
-        sender_id = event.sender.id
-        try:
-            await group_chat_session.send(MessageSegment.quote(message_id, group_id,
-                                                               sender_id, target_id=sender_id,
-                                                               origin=msg_chain) + resp, at_sender=False)
-        except:
-            img = await md_to_pic(resp)
-            img = base64.b64encode(img).decode()
-            resp = MessageSegment.image(base64=img)
-            await private_session.send("[消息发送失败可能是被风控，建议使用文转图模式,本回复已转为图片模式]" + resp,
-                                       at_sender=True)
-            group_lock[session_id] = False
-    group_lock[session_id] = False
+    # 发送消息，引用原消息，会话繁忙时合并到下一轮对话
+    await handle_chat_message(group_chat_session, get_group_session(group_id),
+                              InboundMessage(msg=msg, user_id=user_id, user_name=user_name,
+                                             reply_to=event.message_id))
 
 
 # # 群临时聊天
@@ -246,7 +292,7 @@ async def _get_gpt_response(bot: Bot, event: PrivateMessageEvent):
     # TODO: 重构此私聊消息处理函数
     session_id = event.get_session_id()
     msg = event.get_plaintext().strip()
-    user_id = event.sender.id
+    user_id = event.user_id
     user_name = event.sender.nickname
 
     # 检查指令
@@ -270,15 +316,7 @@ async def _get_gpt_response(bot: Bot, event: PrivateMessageEvent):
 
         elif len(cmd) > 1 and cmd[1] in ("api", "apikey", "status"):
             # 查询状态
-            total_api_count = len(APIKEY_LIST)
-            invalid_count = len(INVALID_APIs)
-            status_text = "[API key status: {}/{}, integrity: {}%, invalid list: {}]".format(
-                total_api_count - invalid_count,
-                total_api_count,
-                int(100 * (total_api_count - invalid_count) / total_api_count),
-                ", ".join([str(i) for i in INVALID_APIs])
-            )
-            await group_chat_session.send(status_text)
+            await private_session.send(api_status_text())
 
         else:
             await private_session.send("[unknown command]")
@@ -289,39 +327,125 @@ async def _get_gpt_response(bot: Bot, event: PrivateMessageEvent):
     if not msg:
         return
 
-    if session_id in user_lock and user_lock[session_id]:
-        await private_session.finish("[消息太快啦～请稍后]", at_sender=True)
+    # 发送消息
+    # 如果是私聊直接发送，会话繁忙时合并到下一轮对话
+    await handle_chat_message(private_session, get_user_session(user_id, name=user_name),
+                              InboundMessage(msg=msg, user_id=user_id, user_name=user_name))
 
-    user_lock[session_id] = True
-    resp = await get_user_session(user_id, name=user_name).get_chat_response(
-        msg, user_id=user_id, user_name=user_name)
 
-    # 发送消息
-    # 如果是私聊直接发送
-    if resp != "……":
-        await private_session.send(resp, at_sender=True)
+async def sweep_idle_sessions(interval: float = 60):
+    """
+    evict idle sessions to disk periodically, and save impressions changed by background tasks
+    :param interval: float, seconds between sweeps
+    :return:
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            user_session.evict_idle()
+            group_session.evict_idle()
+        except Exception as err:
+            logger.error(f"error while evicting idle sessions, {err}")
+        flush_impressions()
+
+
+async def warm_up_sessions(count: int):
+    """
+    load the most recently active sessions and build their prompt caches, so that the first messages after
+    startup do not pay for database lookups and decoding. yields to event loop after every session
+    :param count: int, max count of sessions to load
+    :return:
+    """
+    ts = time.perf_counter()
+    try:
+        targets = impression_database.list_recent_sessions(count)
+    except Exception as err:
+        logger.error(f"failed to list recently active sessions, {err}")
+        return
+
+    loaded = 0
+    for is_group, id in reversed(targets):
+        # load the most recent one at last, so that it is the most recently used one in session manager
+        manager = group_session if is_group else user_session
+        if id in manager or len(manager) >= manager.max_sessions:
+            continue
+        try:
+            session = manager.get(id)
+            session.conversation.get_prompt_tokens()  # build prefix and token caches
+            loaded += 1
+        except Exception as err:
+            logger.warning(f"failed to warm up {'group' if is_group else 'user'} session {id}, {err}")
+        await asyncio.sleep(0)
 
-    user_lock[session_id] = False
+    logger.info(f"warmed up {loaded} session(s) in {time.perf_counter() - ts:.2f} seconds")
 
 
 # Cody初始化
-def cody_init():
-    global impression_database
+async def cody_init():
+    global impression_database, session_store, user_session, group_session, session_persister, session_sweeper
+    ts = time.perf_counter()
     # initialize impression database
-    database_path = Path(CODY_CONFIG.cody_session_cache_dir).joinpath("impressions.db").as_posix()
-    impression_database = Impression(database_path)
+    impression_database = Impression("impressions.db")
+    # initialize session store, import session files of old version
+    session_store = SessionStore(Path(CODY_CONFIG.cody_session_cache_dir).joinpath("sessions.db").as_posix())
+    migrated = session_store.migrate(CODY_CONFIG.cody_session_cache_dir)
+    if migrated:
+        logger.info(f"imported {migrated} session file(s) into session store")
+    # initialize session managers
+    user_session = SessionManager(new_user_session, session_store, is_group=False,
+                                  max_sessions=CODY_CONFIG.cody_session_cache_size,
+                                  idle_timeout=CODY_CONFIG.cody_session_forget_timeout,
+                                  checkpoint_interval=CODY_CONFIG.cody_session_checkpoint_interval)
+    group_session = SessionManager(new_group_session, session_store, is_group=True,
+                                   max_sessions=CODY_CONFIG.cody_session_cache_size,
+                                   idle_timeout=CODY_CONFIG.cody_session_forget_timeout,
+                                   checkpoint_interval=CODY_CONFIG.cody_session_checkpoint_interval)
+    # start write-behind session persister
+    session_persister = SessionPersister(session_store, [user_session, group_session],
+                                         interval=CODY_CONFIG.cody_session_save_interval)
+    session_persister.start()
+    # start alarm scheduler, saved alarms are restored
+    ALARM_SCHEDULER.start(session_store,
+                          lambda is_group, id: group_session.get(id) if is_group else user_session.get(id))
+    # start idle session sweeper
+    session_sweeper = asyncio.create_task(sweep_idle_sessions())
+    logger.info(f"Cody initialized in {time.perf_counter() - ts:.2f} seconds")
+
+
+# 预热会话，需要bot连接后才能创建会话
+async def cody_warm_up(bot: Bot):
+    global warm_up_task
+    if warm_up_task is None and CODY_CONFIG.cody_warmup_sessions > 0:
+        # run once after the first bot connected
+        warm_up_task = asyncio.create_task(warm_up_sessions(CODY_CONFIG.cody_warmup_sessions))
 
 
 # 安全关闭
-def cody_stop():
-    memory_dir = Path(CODY_CONFIG.cody_session_cache_dir)
-    # kill and save all user session
+async def cody_stop():
+    # stop idle session sweeper and warm-up
+    if session_sweeper is not None:
+        session_sweeper.cancel()
+    if warm_up_task is not None:
+        warm_up_task.cancel()
+    # stop alarm scheduler, pending alarms stay in session store
+    await ALARM_SCHEDULER.stop()
+    # save all changed sessions
+    saved = await session_persister.stop()
+    logger.info(f"saved {saved} session(s) before shutdown")
+    # kill all user session
     for ele in user_session:
-        user_session[ele].kill()
-    # kill and save all group session
+        ele.kill()
+    # kill all group session
     for ele in group_session:
-        group_session[ele].kill()
+        ele.kill()
+    # close session store
+    session_store.close()
+    # save changed impressions and close impression database
+    impression_database.close()
+    # close pooled connections of openai API
+    await CHAT_CLIENT.close()
 
 
 DRIVER.on_startup(cody_init)
+DRIVER.on_bot_connect(cody_warm_up)
 DRIVER.on_shutdown(cody_stop)
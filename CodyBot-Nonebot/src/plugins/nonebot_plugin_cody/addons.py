@@ -10,12 +10,14 @@ import json
 import asyncio
 from nonebot import get_bot, logger
 from nonebot.adapters.onebot.v11 import Bot, MessageSegment, Message
+from .config import CODY_CONFIG, ADMISSION
+from .keypool import RequestPriority
 from .session import SessionGPT35
-from .api import get_chat_response
-from .config import APIKEY_LIST
 from .memory import Memory, ExtraTypes
 from .utils import TimeStamp, GPTResponse, extract_json_and_purge_cody_response
-from . import get_user_session, get_group_session
+
+REACH_MIN_SCORE = 0.6  # min score of the best fuzzy matched reach target to reach without asking
+REACH_MIN_MARGIN = 0.1  # min lead of the best fuzzy matched reach target over the second one
 
 
 class AddonBase:
@@ -40,23 +42,24 @@ class AddonBase:
 
     def alarm_callback(self, *args, **kwargs):
         """
-        basic alarm callback function. calls when registered alarm in session triggered.
+        basic alarm callback function. calls when registered alarm in session triggered, a returned coroutine
+        will be started as a task by alarm scheduler.
         :param args: Any
         :param kwargs: Any
         :return: Any
         """
         pass
 
-    def user_msg_post_proc_callback(self):
+    async def user_msg_post_proc_callback(self):
         """
-        basic user message post-processing callback method. calls when a user send message to Cody
+        basic user message post-processing callback coroutine. awaits when a user send message to Cody
         :return: None
         """
         pass
 
-    def cody_msg_post_proc_callback(self):
+    async def cody_msg_post_proc_callback(self):
         """
-        basic cody message post-processing callback method. calls when received a new feedback from gpt
+        basic cody message post-processing callback coroutine. awaits when received a new feedback from gpt
         :return: None
         """
         pass
@@ -73,6 +76,15 @@ class DefaultsAddon(AddonBase):
     6. reach anyone in impression database
     """
 
+    def __init__(self, session: SessionGPT35):
+        """
+        defaults addon of a session
+        :param session: SessionGPT35
+        """
+        super().__init__(session)
+
+        self.__reach_tasks = set()  # running reach tasks, kept here so that they are not garbage collected
+
     def is_silenced(self, user_id: int) -> bool:
         """
         return whether if selected user is silenced in current session
@@ -100,13 +112,13 @@ class DefaultsAddon(AddonBase):
         frame = self.session.impression.get_individual(user_id)
 
         flag_name = f'SI_{self.session.id}'
-        # update flag
-        frame.additional_json.update({flag_name: True})
+        # update flag in a copy, frames from impression database are read-only
+        additional_json = {**frame.additional_json, flag_name: True}
 
         # write modified json dict in impression database
         self.session.impression.update_individual(
             user_id,
-            additional_json=frame.additional_json
+            additional_json=additional_json
         )
 
     def set_feedback_required(self, activate: bool, user_id: int, feedback_source: SessionGPT35, ts: float,
@@ -124,12 +136,40 @@ class DefaultsAddon(AddonBase):
         frame = self.session.impression.get_individual(user_id)
 
         flag_name = f'FBR_{self.session.id}'
-        # update flag
-        frame.additional_json.update({flag_name: {'source': feedback_source.id,
-                                                  'is_group': feedback_source.is_group,
-                                                  'active': activate,
-                                                  'timestamp': ts,
-                                                  'topic': feecback_topic}})
+        # update flag in a copy, frames from impression database are read-only
+        additional_json = {**frame.additional_json, flag_name: {'source': feedback_source.id,
+                                                                'is_group': feedback_source.is_group,
+                                                                'active': activate,
+                                                                'timestamp': ts,
+                                                                'topic': feecback_topic}}
+
+        # write modified json dict in impression database
+        self.session.impression.update_individual(
+            user_id,
+            additional_json=additional_json
+        )
+
+    def remove_flag(self, user_id: int, flag_name: str):
+        """
+        remove a flag from additional json of specified user
+        :param user_id: int
+        :param flag_name: str
+        :return:
+        """
+        # get user impression data frame
+        frame = self.session.impression.get_individual(user_id)
+        if flag_name not in frame.additional_json:
+            return
+
+        # remove flag in a copy, frames from impression database are read-only
+        additional_json = dict(frame.additional_json)
+        additional_json.pop(flag_name)
+
+        # write modified json dict in impression database
+        self.session.impression.update_individual(
+            user_id,
+            additional_json=additional_json
+        )
 
     def set_active(self, user_id: int):
         """
@@ -141,13 +181,13 @@ class DefaultsAddon(AddonBase):
         frame = self.session.impression.get_individual(user_id)
 
         flag_name = f'SI_{self.session.id}'
-        # update flag
-        frame.additional_json.update({flag_name: False})
+        # update flag in a copy, frames from impression database are read-only
+        additional_json = {**frame.additional_json, flag_name: False}
 
         # write modified json dict in impression database
         self.session.impression.update_individual(
             user_id,
-            additional_json=frame.additional_json
+            additional_json=additional_json
         )
 
     def extract_json_from_cody_response(self) -> dict or None:
@@ -181,18 +221,17 @@ class DefaultsAddon(AddonBase):
         users = []
         users_with_impression = []
         # iterate conversations for user ID and impressions
-        for i, ele in enumerate(self.session.conversation.conversation_extra):
-            if ele['type'] == ExtraTypes.user_msg_info:
-                if ele['user_id'] not in users:
-                    # if users not recorded, append it in record
-                    users.append(ele['user_id'])
+        for ele in self.session.conversation.conversation.records(ExtraTypes.user_msg_info):
+            if ele.extra['user_id'] not in users:
+                # if users not recorded, append it in record
+                users.append(ele.extra['user_id'])
 
-                # decode user info json
-                user_info = json.loads(self.session.conversation.conversation[i]['content'])
+            # decode user info json
+            user_info = json.loads(ele.message['content'])
 
-                if "previous impression" in user_info:
-                    # append user with impression in conversation
-                    users_with_impression.append(ele['user_id'])
+            if "previous impression" in user_info:
+                # append user with impression in conversation
+                users_with_impression.append(ele.extra['user_id'])
 
         # find out users without impression
         ret = [ele for ele in users if ele not in users_with_impression]
@@ -207,47 +246,40 @@ class DefaultsAddon(AddonBase):
         :return: str
         """
         now = time.time()
-        ret = ""
-        seg_count = 0
-        for i, ele in enumerate(self.session.conversation.conversation_extra[::-1]):
-            if now - ele['timestamp'] > time_sec:
+        segments = []
+        for ele in self.session.conversation.conversation.records(reverse=True):
+            if now - float(ele.extra.get('timestamp', now)) > time_sec:
                 # break if message timestamp too old
                 break
 
-            if ele['type'] == ExtraTypes.user_msg:
+            if ele.type == ExtraTypes.user_msg:
                 # in case message type is user's input
-                ret += f"{ele['name']}: {self.session.conversation.conversation[i]}\n"
+                segments.append(f"{ele.extra.get('username')}: {ele.message['content']}\n")
 
-            elif ele['type'] == ExtraTypes.cody_msg:
+            elif ele.type == ExtraTypes.cody_msg:
                 # in case message type is cody's feedback
-                ret += f"Cody: {extract_json_and_purge_cody_response(self.session.conversation.conversation[i])[1]}"
+                cody_msg = extract_json_and_purge_cody_response(GPTResponse(message=ele.message['content']))[1]
+                segments.append(f"Cody: {cody_msg}\n")
 
-            if seg_count >= max_msg_pair_count * 2:
+            if len(segments) >= max_msg_pair_count * 2:
                 # break if messages exceeded maximum size
                 break
 
-    def user_msg_post_proc_callback(self):
+        ret = "".join(segments[::-1])
+
+        return ret
+
+    async def user_msg_post_proc_callback(self):
         """
         update impression, interaction timestamp data and ensure it is in conversation
         :return: None
         """
+        from . import get_group_session, get_user_session
+
         # update status massage
-        all_users = self.session.impression.list_individuals()
-        # forming information in CSV format
+        # forming information in CSV format, users never contacted (or no cantact in 2 years) are skipped
         info = []
-        for user_id in all_users:
-            # fetch impression frame
-            frame = self.session.impression.get_individual(user_id)
-            ts = frame.last_interact_timestamp
-
-            # calculate duration since last contact
-            ts_now = time.time()
-            duration = ts_now - frame.last_interact_timestamp.timestamp
-
-            if duration > 63072000:
-                # if the user is never contacted (or no cantact in 2 years), skip
-                continue
-
+        for frame in self.session.impression.iter_recent(time.time() - 63072000):
             # forming location text
             if frame.last_interact_session_is_group:
                 loc = "group chat(group ID: {})".format(frame.last_interact_session_ID)
@@ -255,7 +287,7 @@ class DefaultsAddon(AddonBase):
                 loc = "private chat"
 
             # forming time text
-            time_till_now = frame.last_interact_timestamp.till_now_str()
+            time_till_now = TimeStamp(frame.last_interact_timestamp).till_now_str()
 
             # assembling last contact text
             if frame.last_interact_session_ID == -1:
@@ -281,7 +313,7 @@ class DefaultsAddon(AddonBase):
 
         # copy current user info
         current_user_id = self.session.conversation.user_msg_extra['user_id']
-        current_user_name = self.session.conversation.user_msg_extra['name']
+        current_user_name = self.session.conversation.user_msg_extra['username']
 
         # update user interaction time and location
         ts: TimeStamp = self.session.conversation.user_msg_extra['timestamp']
@@ -312,9 +344,7 @@ class DefaultsAddon(AddonBase):
                 if is_FBR['active']:
                     if time.time() - is_FBR['timestamp'] > 3600 * 24 * 2:
                         # remove FBR flag if user is not responding in 2 days
-                        frame.additional_json.pop(flag_name)
-                        self.session.impression.update_individual(self.session.id,
-                                                                  additional_json=frame.additional_json)
+                        self.remove_flag(self.session.id, flag_name)
                         continue
 
                     # check and update feedback in other session
@@ -330,37 +360,44 @@ class DefaultsAddon(AddonBase):
                         session = get_group_session(is_FBR['source'])
                     else:
                         # fetch target user session
-                        session = get_group_session(is_FBR['source'])
+                        session = get_user_session(is_FBR['source'])
+
+                    # lock target session so that a turn in flight there can not interleave with the edit, current
+                    # session is locked by its own turn already
+                    locked = session is not self.session
+                    if locked and not await session.acquire():
+                        # flag is kept, try again on next message
+                        self.log(f"failed to update feedback in session {session.id}, target session is busy")
+                        continue
 
-                    # check and toggle busy flag of target session
-                    session.busy_check()
-                    session.is_busy = True
-
-                    # locating index of target session's memory recall info segment
-                    info_i = -1
-                    for i, ele in enumerate(session.conversation.conversation_extra):
-                        if (ele['type'] == ExtraTypes.sys_msg
-                                and 'sub_type' in ele and ele['sub_type'] == 'reach_feedback'):
-                            # fetch feedback system info message segment
-                            if ele['timestamp'] == is_FBR['timestamp']:
-                                # record feedback target index
-                                info_i = i
-                                self.log("successfully located target feedback index ({}) in session {}".format(
-                                    info_i, session.id
-                                ))
-
-                    if info_i == -1:
+                    try:
+                        # locating target session's memory recall info segment
+                        info_record = session.conversation.conversation.find(
+                            lambda ele: (ele.type == ExtraTypes.sys_msg
+                                         and ele.extra.get('sub_type') == 'reach_feedback'
+                                         and ele.extra['timestamp'] == is_FBR['timestamp'])
+                        )
+                        if info_record is not None:
+                            self.log("successfully located target feedback segment (turn {}) in session {}".format(
+                                info_record.turn, session.id
+                            ))
+
+                            # update target feedback system info
+                            session.conversation.conversation.update(info_record, {
+                                'role': 'system',
+                                'content': f"feedbacks from {current_user_name} after you reached him:\n"
+                                           f"{feedback_summary}"
+                            })
+
+                    finally:
+                        if locked:
+                            session.release()
+
+                    if info_record is None:
                         # when target feedback system info segment is not found (forgotten by system)
-                        frame.additional_json.pop(flag_name)
-                        self.session.impression.update_individual(self.session.id,
-                                                                  additional_json=frame.additional_json)
-                        session.is_busy = False
+                        self.remove_flag(self.session.id, flag_name)
                         continue
 
-                    # update target feedback system info
-                    session.conversation.conversation[info_i] = (f"feedbacks from {current_user_name} after you reached"
-                                                                 f" him:\n{feedback_summary}")
-
                     # using openai to determine whether if topic of remind is close
                     payload = [
                         {'role': 'system',
@@ -372,28 +409,19 @@ class DefaultsAddon(AddonBase):
                     ]
 
                     # try to generate response from openai
-                    for i in APIKEY_LIST:
+                    feedback, status = await self.session.request_chat_response(
+                        payload, temperature=0.7, presence_p=0.0, frequency_p=0.0
+                    )
+                    if status:
                         try:
-                            key = APIKEY_LIST.get_api()
-                            feedback, status = get_chat_response(key, payload,
-                                                                 temperature=0.7, presence_p=0.0, frequency_p=0.0)
-                            if status:
-                                # try to decode json text
-                                feedback_json, purged = extract_json_and_purge_cody_response(feedback)
-                                feedback_json = json.loads(feedback_json)
-                                if feedback_json['ended'] == 1:
-                                    # remove FBR flag
-                                    frame.additional_json.pop(flag_name)
-                                    self.session.impression.update_individual(self.session.id,
-                                                                              additional_json=frame.additional_json)
-                                    session.is_busy = False
-                                    continue
+                            # try to decode json text
+                            feedback_json, purged = extract_json_and_purge_cody_response(feedback)
+                            feedback_json = json.loads(feedback_json)
+                            if feedback_json['ended'] == 1:
+                                # remove FBR flag
+                                self.remove_flag(self.session.id, flag_name)
                         except Exception as err:
-                            self.log(
-                                f"error while trying to get feedback status from openai, using key \"{key}\", {err}")
-
-                    # release busy flag
-                    session.is_busy = False
+                            self.log(f"error while trying to decode feedback status from openai, {err}")
 
         # get users without impression
         no_imp_users = self.extract_user_id_with_no_impression_description()
@@ -402,6 +430,9 @@ class DefaultsAddon(AddonBase):
         command = "Summarize your current impression of {} based on the previous conversation above and past " \
                   "impressions in second person and return text start with \"Your impression of {} is\". return:"
 
+        # generate list of prompts for openai once, shared by every user below
+        base_prompts = self.session.conversation.to_list()
+
         # update impression data in impression database for every no impression user
         for user in no_imp_users:
             if self.is_silenced(user):
@@ -409,29 +440,21 @@ class DefaultsAddon(AddonBase):
                 continue
             # get username
             user_name = self.session.impression.get_individual(user).name
-            # generate list of prompts for openai
-            prompts = self.session.conversation.to_list()
-            # modify prompts, add system message for commanding
-            prompts.append(
+            # add system message for commanding
+            prompts = [
+                *base_prompts,
                 {
                     'role': 'system',
                     'content': command.format(user_name, user_name)
                 }
-            )
+            ]
 
-            feedback: GPTResponse = GPTResponse()
-            status = False
             # generate impression text
-            for i in APIKEY_LIST:
-                feedback, status = get_chat_response(
-                    APIKEY_LIST.get_api(),
-                    prompts,
-                    temperature=0.6,
-                    frequency_p=0.1
-                )
-                if status:
-                    # break with status=True when succeed
-                    break
+            feedback, status = await self.session.request_chat_response(
+                prompts,
+                temperature=0.6,
+                frequency_p=0.1
+            )
 
             if status:
                 # update impression text if succeed
@@ -452,7 +475,7 @@ class DefaultsAddon(AddonBase):
                          "with OpenAI API.".format(user_name, user))
 
         # update impression description in conversation
-        if current_user_id in no_imp_users or len(self.session.conversation) == 0:
+        if current_user_id in no_imp_users or len(self.session.conversation.conversation) == 0:
             self.set_active(current_user_id)
             # update impression description in user_msg_info
             imp = self.session.impression.get_individual(current_user_id).impression
@@ -462,11 +485,80 @@ class DefaultsAddon(AddonBase):
                 }
             )
 
-    def cody_msg_post_proc_callback(self):
+    async def reach_session(self, session: SessionGPT35, target_id: int, username: str, reach_reason: str,
+                            addtional_msg: str, timestamp: TimeStamp):
+        """
+        ask Cody in target user session to form a message for reach reason and send it to target user
+        :param session: SessionGPT35, target user session
+        :param target_id: int, QQ ID of target user
+        :param username: str, name of target user
+        :param reach_reason: str
+        :param addtional_msg: str, latest messages of current session
+        :param timestamp: TimeStamp, timestamp of reach call
+        :return:
+        """
+        # a reach is a turn of target session, admit it like other turns so that it is shed first under load
+        if not await ADMISSION.admit(RequestPriority.background):
+            self.log(f"failed to reach {username}({target_id}), dropped under load")
+            return
+
+        try:
+            # wait for target session without blocking other sessions
+            if not await session.acquire():
+                self.log(f"failed to reach {username}({target_id}), target session is busy")
+                return
+
+            session.turn_priority = RequestPriority.background
+            try:
+                # modify target session
+                session.conversation.conversation.append({'role': 'system',
+                                                          'content': f"You need to form a message for "
+                                                                     f"\"{username}\" with following reason:\n"
+                                                                     f"{reach_reason}\n"
+                                                                     f"additional information from other chat "
+                                                                     f"session as follows:\n{addtional_msg}"
+                                                          },
+                                                         {'type': ExtraTypes.sys_msg,
+                                                          'sub_type': 'reach_call',
+                                                          'timestamp': timestamp
+                                                          })
+
+                # try to generate response from openai
+                prompts, prompt_tokens, forgotten = session.conversation.build_prompt(
+                    CODY_CONFIG.cody_gpt3_max_tokens)
+                feedback, status = await session.request_chat_response(prompts, prompt_tokens=prompt_tokens)
+                if status:
+                    # add to conversation history if succeed
+                    await session.conversation.add_cody_message(feedback)
+
+            finally:
+                # release lock of target session
+                session.turn_priority = None
+                session.release()
+
+        finally:
+            ADMISSION.release()
+
+        # notify target user through api
+        if status:
+            # notify user if succeed
+            try:
+                json_text, purged = extract_json_and_purge_cody_response(feedback)
+                await self.session.bot.send_private_msg(user_id=target_id, message=purged.message)
+
+                # set FBR flag active in target user impression database
+                self.set_feedback_required(True, target_id, self.session,
+                                           ts=timestamp.timestamp, feecback_topic=reach_reason)
+            except Exception as err:
+                self.log(f"error while sending message though nonebot API, {err}")
+
+    async def cody_msg_post_proc_callback(self):
         """
         decode emotion feelings, name update, reach someone
         :return: None
         """
+        from . import get_user_session
+
         # try to get json text from
         res = self.extract_json_from_cody_response()
 
@@ -502,7 +594,7 @@ class DefaultsAddon(AddonBase):
                     self.session.impression.update_individual(
                         user_id,
                         name=res[key],
-                        alternatives=old_frame.alternatives.append(old_frame.name)
+                        alternatives=[*old_frame.alternatives, old_frame.name]
                     )
             elif key == "del_name":
                 # delete a name from impression database
@@ -517,10 +609,9 @@ class DefaultsAddon(AddonBase):
                     )
                 elif res[key] in old_frame.alternatives:
                     # deleting alternative names
-                    old_frame.alternatives.remove(res[key])
                     self.session.impression.update_individual(
                         user_id,
-                        alternatives=old_frame.alternatives
+                        alternatives=[ele for ele in old_frame.alternatives if ele != res[key]]
                     )
 
             elif key == "reach":
@@ -533,85 +624,66 @@ class DefaultsAddon(AddonBase):
                 reach_reason = res['reach_reason']
                 addtional_msg = self.extract_latest_msg_segment_to_summary()
 
-                matched_frames = []
-                # matching database
-                for ele in self.session.impression.list_individuals():
-                    frame = self.session.impression.get_individual(ele)
-                    if frame.name.upper() == username and self.session.id != frame.id:
-                        matched_frames.append(frame)
+                # matching names and alternative names in database
+                matched = [ele for ele in self.session.impression.find_by_name(username) if ele != self.session.id]
+                target = None  # ID of user to reach without asking
+                candidates = []  # ID of users to ask which one to reach, the best first
+
+                if len(matched) == 1:
+                    # exactly one exact match
+                    target = matched[0]
+                else:
+                    # no exact match or ambiguous, rank similar names by recency and relationship to this session
+                    ranked = [ele for ele in self.session.impression.search_names(
+                        username, limit=5, session_id=self.session.id, session_is_group=self.session.is_group
+                    ) if ele[0] != self.session.id and (not matched or ele[0] in matched)]
+
+                    if ranked and ranked[0][1] >= REACH_MIN_SCORE and \
+                            (len(ranked) == 1 or ranked[0][1] - ranked[1][1] >= REACH_MIN_MARGIN):
+                        # one candidate stands out
+                        target = ranked[0][0]
+                    else:
+                        # weak or close matches are never reached without asking
+                        candidates = [ele[0] for ele in ranked]
 
-                if len(matched_frames) == 1:
+                if target is not None:
                     # matched one, get target session
-                    session = get_user_session(matched_frames[0].id)
-
-                    # busy check target session
-                    session.busy_check()
-                    session.is_busy = True
-
-                    # modify target session
-                    session.conversation.conversation.append({'role': 'system',
-                                                              'content': f"You need to form a message for "
-                                                                         f"\"{username}\" with following reason:\n"
-                                                                         f"{reach_reason}\n"
-                                                                         f"additional information from other chat "
-                                                                         f"session as follows:\n{addtional_msg}"
-                                                              })
-                    session.conversation.conversation_extra.append({
-                        'type': ExtraTypes.sys_msg,
-                        'sub_type': 'reach_call',
-                        'timestamp': timestamp
-                    })
+                    session = get_user_session(target)
 
                     # add feedback info system message segment in current session
-                    self.session.conversation.conversation_extra.append({
+                    self.session.conversation.conversation.append({
+                        'role': 'system',
+                        'content': f'feedbacks from {username} after you reached him:\nNone'
+                    }, {
                         'type': ExtraTypes.sys_msg,
                         'sub_type': 'reach_feedback',
                         'timestamp': timestamp
                     })
+
+                    # reach target session in background, current session is locked by its own request, waiting
+                    # for target session here may dead lock when target session is reaching current one
+                    task = asyncio.create_task(self.reach_session(session, target, username,
+                                                                  reach_reason, addtional_msg, timestamp))
+                    self.__reach_tasks.add(task)
+                    task.add_done_callback(self.__reach_tasks.discard)
+
+                elif candidates:
+                    # not sure, list candidates in the best first order and let cody ask which one
+                    candidates = "\n".join("\"{}\",{},\"{}\"".format(
+                        frame.name,  # user's name
+                        frame.id,  # user QQ ID
+                        frame.title  # user's relationship to Cody
+                    ) for frame in self.session.impression.get_many(candidates))
                     self.session.conversation.conversation.append({
                         'role': 'system',
-                        'content': f'feedbacks from {username} after you reached him:\nNone'
+                        'content': f'not sure which person is {username}, ask which one to reach before reaching '
+                                   f'again:\nName,User_ID,Relationship_to_You\n{candidates}'
+                    }, {
+                        'type': ExtraTypes.sys_msg,
+                        'sub_type': 'reach_candidates',
+                        'timestamp': timestamp
                     })
 
-                    status = False
-                    # try to generate response from openai
-                    for i in APIKEY_LIST:
-                        try:
-                            key = APIKEY_LIST.get_api()
-                            feedback, status = get_chat_response(key, session.conversation.to_list())
-                            if status:
-                                # add to conversation history if succeed
-                                session.conversation.add_cody_message(feedback)
-                        except Exception as err:
-                            self.log(f"error while using key \"{key}\", {err}")
-
-                    # notify target user through api
-                    if status:
-                        # notify user if succeed
-                        try:
-                            json_text, purged = extract_json_and_purge_cody_response(feedback)
-                            async_object = self.session.bot.send_private_msg(user_id=matched_frames[0].id,
-                                                                             message=purged)
-                            asyncio.run(async_object)
-
-                            # set FBR flag active in target user impression database
-                            self.set_feedback_required(True, matched_frames[0].id, self.session,
-                                                       ts=timestamp.timestamp, feecback_topic=reach_reason)
-                        except Exception as err:
-                            self.log(f"error while sending message though nonebot API, {err}")
-
-                    # release busy flag of target session
-                    session.is_busy = False
-
-                elif len(matched_frames) > 1:
-                    # matched multiple, ask cody to contact which
-                    # TODO: finish reach processing when multiple user matched in database, basic logic:
-                    #  1. modify current session conversation(add system prompts of listed matched users), add busy flag
-                    #  2. generate list to get Cody's structured response
-                    #  3. if Cody is not sure, ask user to contact which
-                    #  4. get target session or cancel
-                    pass
-
 
 # TODO: reconstruct ReminderAddon to fit new addon base
 
@@ -653,6 +725,9 @@ class ReminderAddon(AddonBase):
 
         return status_text
 
+    def alarm_callback(self, reminder_id: int):
+        return self.action_retell(reminder_id)
+
     async def action_retell(self, reminder_id: int):
         reminder = self.reminders[reminder_id]
         preset = self.session.static_preset
@@ -725,14 +800,11 @@ class ReminderAddon(AddonBase):
                         self.reminders.update({reminder_id: {"alarm": reminder_ts,
                                                              "text": cmd[4]}})
                         add_count += 1
-                        self.session.registered_alarms.update(
-                            {
-                                f"{self.alarm_id_header}_{reminder_id}": [
-                                    reminder_ts,  # 定时任务时间戳
-                                    self.action_retell,  # 定时任务回调函数
-                                    (reminder_id,)  # 定时任务回调函数参数
-                                ]
-                            }
+                        self.session.register_alarm(
+                            f"{self.alarm_id_header}_{reminder_id}",
+                            reminder_ts,  # 定时任务时间戳
+                            self.addon_name,  # 定时任务回调插件
+                            (reminder_id,)  # 定时任务回调函数参数
                         )
 
                     elif "EDIT" in action:
@@ -740,20 +812,17 @@ class ReminderAddon(AddonBase):
                         self.reminders.update({reminder_id: {"alarm": reminder_ts,
                                                              "text": cmd[4]}})
                         edit_count += 1
-                        self.session.registered_alarms.update(
-                            {
-                                f"{self.alarm_id_header}_{reminder_id}": [
-                                    reminder_ts,  # 定时任务时间戳
-                                    self.action_retell,  # 定时任务回调函数
-                                    (reminder_id,)  # 定时任务回调函数参数
-                                ]
-                            }
+                        self.session.register_alarm(
+                            f"{self.alarm_id_header}_{reminder_id}",
+                            reminder_ts,  # 定时任务时间戳
+                            self.addon_name,  # 定时任务回调插件
+                            (reminder_id,)  # 定时任务回调函数参数
                         )
 
                     elif "REMOVE" in action:
                         self.reminders.pop(reminder_id)
                         remove_count += 1
-                        self.session.registered_alarms.pop(
+                        self.session.cancel_alarm(
                             f"{self.alarm_id_header}_{reminder_id}"
                         )
 
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: i2cy(i2cy@outlook.com)
+# Project: CodyBot2
+# Filename: admission
+# Created on: 2023/7/10
+
+import time
+import asyncio
+from collections import deque
+from .keypool import RequestPriority
+
+
+class TurnWaiter:
+    __slots__ = ("priority", "deadline", "future")
+
+    def __init__(self, priority: int, deadline: float):
+        """
+        chat turn waiting in queue of admission controller
+        :param priority: int, RequestPriority
+        :param deadline: float, timestamp after which the turn is dropped
+        """
+        self.priority = priority
+        self.deadline = deadline
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class AdmissionController:
+
+    def __init__(self, max_in_flight: int = 16, max_queued: int = 64, deadlines: dict = None):
+        """
+        global limit of chat turns processed at once. turns over the limit wait in bounded queues and are
+        admitted strictly by priority. a turn is dropped when it has waited past its deadline, or when queues
+        are full and it is the oldest turn of the lowest priority waiting, so that group chats degrade first
+        under a spike instead of every turn piling up on the API keys
+        :param max_in_flight: int, max chat turns processed at once
+        :param max_queued: int, max chat turns waiting in all queues
+        :param deadlines: dict (optional), max seconds since arrival of its first message a turn may wait,
+                          format: {priority: float}, no deadline if None
+        """
+        if deadlines is None:
+            deadlines = {}
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.deadlines = deadlines
+
+        priorities = (RequestPriority.interactive, RequestPriority.group, RequestPriority.background)
+        self.__queues = {ele: deque() for ele in priorities}  # waiting turns of each class, oldest first
+        self.__shed = {ele: 0 for ele in priorities}  # count of dropped turns of each class
+        self.__in_flight = 0
+
+    def in_flight(self) -> int:
+        """
+        return count of chat turns being processed
+        :return: int
+        """
+        return self.__in_flight
+
+    def waiting(self, priority: int = None) -> int:
+        """
+        return count of chat turns waiting for admission
+        :param priority: int (optional), RequestPriority, count all classes if not given
+        :return: int
+        """
+        if priority is None:
+            return sum(len(queue) for queue in self.__queues.values())
+
+        return len(self.__queues[priority])
+
+    def shed(self, priority: int = None) -> int:
+        """
+        return count of chat turns dropped
+        :param priority: int (optional), RequestPriority, count all classes if not given
+        :return: int
+        """
+        if priority is None:
+            return sum(self.__shed.values())
+
+        return self.__shed[priority]
+
+    def __reject(self, waiter: TurnWaiter):
+        """
+        drop a waiting turn
+        :param waiter: TurnWaiter
+        :return:
+        """
+        self.__shed[waiter.priority] += 1
+        if not waiter.future.done():
+            waiter.future.set_result(False)
+
+    def __dispatch(self):
+        """
+        admit waiting turns in order of priority until in-flight limit reached
+        :return:
+        """
+        while self.__in_flight < self.max_in_flight:
+            for queue in self.__queues.values():
+                if queue:
+                    waiter = queue.popleft()
+                    break
+            else:
+                return
+
+            if waiter.future.done():
+                # cancelled while waiting
+                continue
+            self.__in_flight += 1
+            waiter.future.set_result(True)
+
+    async def admit(self, priority: int, arrival: float = None) -> bool:
+        """
+        wait until a chat turn is admitted, must call release after admitted
+        :param priority: int, RequestPriority
+        :param arrival: float (optional), receive time of the first message of the turn, now if not given
+        :return: bool, False if the turn is dropped
+        """
+        now = time.time()
+        deadline = self.deadlines.get(priority)
+        deadline = (arrival or now) + deadline if deadline is not None else None
+        if deadline is not None and deadline <= now:
+            # waited too long in session inbox already
+            self.__shed[priority] += 1
+            return False
+
+        if self.__in_flight < self.max_in_flight and not self.waiting():
+            self.__in_flight += 1
+            return True
+
+        if self.waiting() >= self.max_queued:
+            # make room by dropping the oldest turn of the lowest class, or drop this one if it is the lowest
+            lowest = max(ele for ele, queue in self.__queues.items() if queue)
+            if lowest <= priority:
+                self.__shed[priority] += 1
+                return False
+            self.__reject(self.__queues[lowest].popleft())
+
+        waiter = TurnWaiter(priority, deadline)
+        self.__queues[priority].append(waiter)
+        self.__dispatch()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter.future),
+                                          deadline - now if deadline is not None else None)
+
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                # admitted or dropped right at deadline
+                return waiter.future.result()
+            self.__queues[priority].remove(waiter)
+            self.__reject(waiter)
+            return False
+
+        except asyncio.CancelledError:
+            if waiter.future.done():
+                if waiter.future.result():
+                    self.release()
+            else:
+                self.__queues[priority].remove(waiter)
+                waiter.future.cancel()
+            raise
+
+    def release(self):
+        """
+        release an admitted chat turn
+        :return:
+        """
+        self.__in_flight -= 1
+        self.__dispatch()
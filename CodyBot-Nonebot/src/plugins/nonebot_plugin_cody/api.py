@@ -6,7 +6,9 @@
 # Created on: 2022/12/27
 
 import time
+import json
 import openai
+import aiohttp
 from typing import Union
 from pydantic import BaseModel
 
@@ -14,6 +16,10 @@ if __name__ == "__main__":
     # from config import *
     class CODY_CONFIG:
         cody_gpt3_max_tokens = 500
+        cody_api_proxy = "i2net.pi:1088"
+        cody_api_pool_size = 32
+        cody_api_timeout = 60.0
+        cody_api_connect_timeout = 10.0
 
 
     from utils import *
@@ -23,6 +29,7 @@ else:
 
 CODY_HEADER = "\nCody: "
 ANONYMOUS_HUMAN_HEADER = "\nHuman: "
+OPENAI_CHAT_API_URL = "https://api.openai.com/v1/chat/completions"
 
 if not __name__ == "__main__":
     if CODY_CONFIG.cody_api_proxy:
@@ -31,6 +38,359 @@ else:
     openai.proxy = "i2net.pi:1088"
 
 
+class APIStatusError(RuntimeError):
+
+    def __init__(self, status: int, message: str, retry_after: float = None):
+        """
+        error of openai API that returned a non-200 http status
+        :param status: int, http status code
+        :param message: str, response text
+        :param retry_after: float (optional), seconds to wait suggested by server
+        """
+        super().__init__(f"openai API returned {status}, {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+    @staticmethod
+    def parse_retry_after(headers) -> Union[float, None]:
+        """
+        parse 'retry-after' header
+        :param headers: Mapping, response headers
+        :return: float or None
+        """
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+
+
+class ChatClient:
+
+    def __init__(self, pool_size: int = 32, timeout: float = 60.0, connect_timeout: float = 10.0,
+                 proxy: str = ""):
+        """
+        asynchronous openai chat API client with keep-alive connection pool, api key is given per request
+        so that concurrent requests will never share or leak keys
+        :param pool_size: int, max count of connections kept in pool
+        :param timeout: float, total timeout of one request in seconds
+        :param connect_timeout: float, timeout of connecting in seconds
+        :param proxy: str, http proxy address, e.g. "127.0.0.1:1080"
+        """
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+
+        if proxy and "://" not in proxy:
+            # openai style proxy setting has no scheme
+            proxy = f"http://{proxy}"
+        self.proxy = proxy if proxy else None
+
+        self.__session: Union[aiohttp.ClientSession, None] = None
+
+    def __get_session(self) -> aiohttp.ClientSession:
+        """
+        return current connection pool, create one if not exists
+        :return: aiohttp.ClientSession
+        """
+        if self.__session is None or self.__session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300)
+            self.__session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+        return self.__session
+
+    async def post(self, key: str, payload: dict) -> dict:
+        """
+        post a request to openai chat API and return decoded json response
+        :param key: str, api key on openai
+        :param payload: dict, request body
+        :return: dict
+        """
+        headers = {"Authorization": f"Bearer {key}"}
+        async with self.__get_session().post(OPENAI_CHAT_API_URL, json=payload,
+                                             headers=headers, proxy=self.proxy) as response:
+            if response.status != 200:
+                raise APIStatusError(response.status, await response.text(),
+                                     APIStatusError.parse_retry_after(response.headers))
+            ret = await response.json(content_type=None)
+
+        return ret
+
+    async def stream(self, key: str, payload: dict):
+        """
+        post a streaming request to openai chat API and yield decoded json chunks, raise if request failed
+        :param key: str, api key on openai
+        :param payload: dict, request body
+        :return: AsyncGenerator of dict
+        """
+        headers = {"Authorization": f"Bearer {key}"}
+        payload = dict(payload, stream=True)
+        async with self.__get_session().post(OPENAI_CHAT_API_URL, json=payload,
+                                             headers=headers, proxy=self.proxy) as response:
+            if response.status != 200:
+                raise APIStatusError(response.status, await response.text(),
+                                     APIStatusError.parse_retry_after(response.headers))
+
+            # server-sent events, one chunk per line
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                yield json.loads(data)
+
+    async def close(self):
+        """
+        close all connections in pool
+        :return:
+        """
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+        self.__session = None
+
+
+CHAT_CLIENT = ChatClient(pool_size=CODY_CONFIG.cody_api_pool_size,
+                         timeout=CODY_CONFIG.cody_api_timeout,
+                         connect_timeout=CODY_CONFIG.cody_api_connect_timeout,
+                         proxy=CODY_CONFIG.cody_api_proxy)
+
+
+def purge_cody_header(text: str) -> str:
+    """
+    remove 'Cody:' header and leading blank spaces that model may generate
+    :param text: str
+    :return: str
+    """
+    if CODY_HEADER[1:-1] in text or CODY_HEADER[1:-1].replace(":", "：") in text:
+        text = text.split(CODY_HEADER[1:-1])[-1]
+        text = text.split(CODY_HEADER[1:-1].replace(":", "："))[-1]
+    while len(text) and text[0] == " ":
+        text = text[1:]
+
+    return text
+
+
+def form_chat_payload(msg: list, stop_list: list = None,
+                      temperature: float = 0.6,
+                      frequency_p: float = 0.05,
+                      presence_p: float = 0.0) -> dict:
+    """
+    form request body of openai gpt-3.5 chat API
+    :param msg: list, list of dict messages for gpt-3.5
+    :param stop_list: list, stop sequence of model
+    :param temperature: float, controls randomness
+    :param frequency_p: float, reduce repetitive words
+    :param presence_p: float, increase talking about new topics
+    :return: dict
+    """
+    payload = {
+        "model": "gpt-3.5-turbo-16k",
+        "messages": msg,
+        "temperature": temperature,
+        "max_tokens": CODY_CONFIG.cody_gpt3_max_tokens,
+        "top_p": 1,
+        "frequency_penalty": frequency_p,
+        "presence_penalty": presence_p
+    }
+    if stop_list:
+        payload["stop"] = stop_list
+
+    return payload
+
+
+async def async_get_chat_response(key: str, msg: list, stop_list: list = None,
+                                  temperature: float = 0.6,
+                                  frequency_p: float = 0.05,
+                                  presence_p: float = 0.0) -> tuple:
+    """
+    get openai gpt-3.5 API response asynchronously through pooled connections
+    :param key: str, api key on openai, only used by this request
+    :param msg: list, list of dict messages for gpt-3.5
+    :param stop_list: list, stop sequence of model
+    :param temperature: float, controls randomness
+    :param frequency_p: float, reduce repetitive words
+    :param presence_p: float, increase talking about new topics
+    :return: (GPTResponse, status: bool)
+    """
+    payload = form_chat_payload(msg, stop_list, temperature, frequency_p, presence_p)
+
+    try:
+        response = await CHAT_CLIENT.post(key, payload)
+        return parse_chat_response(response), True
+    except Exception as e:
+        return GPTResponse(message=f"发生错误: {e}"), False
+
+
+async def request_chat_response(msg: list, stop_list: list = None,
+                                temperature: float = 0.6,
+                                frequency_p: float = 0.05,
+                                presence_p: float = 0.0,
+                                prompt_tokens: int = None,
+                                priority: int = RequestPriority.group,
+                                session_key: str = None) -> tuple:
+    """
+    get openai gpt-3.5 API response with keys scheduled by API_SCHEDULER, retry with other keys if failed
+    :param msg: list, list of dict messages for gpt-3.5
+    :param stop_list: list, stop sequence of model
+    :param temperature: float, controls randomness
+    :param frequency_p: float, reduce repetitive words
+    :param presence_p: float, increase talking about new topics
+    :param prompt_tokens: int (optional), token count of prompts, will be estimated if not given
+    :param priority: int, RequestPriority of request
+    :param session_key: str (optional), key of session that sends request, e.g. 'user_123456'
+    :return: (GPTResponse, status: bool)
+    """
+    payload = form_chat_payload(msg, stop_list, temperature, frequency_p, presence_p)
+    if prompt_tokens is None:
+        prompt_tokens = estimate_usage(msg, "").prompt_tokens
+    reserved = prompt_tokens + CODY_CONFIG.cody_gpt3_max_tokens
+
+    ret = GPTResponse(message="发生错误: no API key available")
+    for i in range(len(APIKEY_LIST)):
+        key = await API_SCHEDULER.acquire(reserved, priority, session_key)
+        if key is None:
+            break
+
+        try:
+            response = await CHAT_CLIENT.post(key.key, payload)
+            ret = parse_chat_response(response)
+        except APIStatusError as err:
+            API_SCHEDULER.release(key, priority, False, reserved, status_code=err.status, retry_after=err.retry_after)
+            ret = GPTResponse(message=f"发生错误: {err}")
+            logger.error(f"API key (ID: {key.id}) failed, {err}")
+            continue
+        except Exception as err:
+            API_SCHEDULER.release(key, priority, False, reserved)
+            ret = GPTResponse(message=f"发生错误: {err}")
+            logger.error(f"API key (ID: {key.id}) failed, {err}")
+            continue
+
+        API_SCHEDULER.release(key, priority, True, reserved, used_tokens=ret.usage.total_tokens)
+        return ret, True
+
+    return ret, False
+
+
+async def request_chat_response_stream(msg: list, stop_list: list = None,
+                                       temperature: float = 0.6,
+                                       frequency_p: float = 0.05,
+                                       presence_p: float = 0.0,
+                                       prompt_tokens: int = None,
+                                       priority: int = RequestPriority.group,
+                                       session_key: str = None):
+    """
+    get openai gpt-3.5 API response in stream mode with keys scheduled by API_SCHEDULER, retry with other keys
+    if failed before any text arrived. yield nothing if all attempts failed
+    :param msg: list, list of dict messages for gpt-3.5
+    :param stop_list: list, stop sequence of model
+    :param temperature: float, controls randomness
+    :param frequency_p: float, reduce repetitive words
+    :param presence_p: float, increase talking about new topics
+    :param prompt_tokens: int (optional), token count of prompts, will be estimated if not given
+    :param priority: int, RequestPriority of request
+    :param session_key: str (optional), key of session that sends request, e.g. 'user_123456'
+    :return: AsyncGenerator of str
+    """
+    if prompt_tokens is None:
+        prompt_tokens = estimate_usage(msg, "").prompt_tokens
+    reserved = prompt_tokens + CODY_CONFIG.cody_gpt3_max_tokens
+
+    for i in range(len(APIKEY_LIST)):
+        key = await API_SCHEDULER.acquire(reserved, priority, session_key)
+        if key is None:
+            logger.error("no API key available in time")
+            return
+
+        started = False
+        response_text = ""
+        try:
+            async for delta in async_get_chat_response_stream(key.key, msg, stop_list,
+                                                              temperature, frequency_p, presence_p):
+                started = True
+                response_text += delta
+                yield delta
+
+        except APIStatusError as err:
+            API_SCHEDULER.release(key, priority, False, reserved, status_code=err.status, retry_after=err.retry_after)
+            logger.error(f"API key (ID: {key.id}) failed, {err}")
+            if started:
+                return
+            continue
+
+        except Exception as err:
+            API_SCHEDULER.release(key, priority, False, reserved)
+            logger.error(f"API key (ID: {key.id}) failed, {err}")
+            if started:
+                # stream broke after text arrived, the caller keeps what it has got
+                return
+            continue
+
+        except BaseException:
+            # cancelled or generator closed by caller
+            API_SCHEDULER.release(key, priority, True, reserved, used_tokens=reserved)
+            raise
+
+        API_SCHEDULER.release(key, priority, True, reserved, used_tokens=prompt_tokens + count_tokens(response_text))
+        return
+
+
+async def async_get_chat_response_stream(key: str, msg: list, stop_list: list = None,
+                                         temperature: float = 0.6,
+                                         frequency_p: float = 0.05,
+                                         presence_p: float = 0.0):
+    """
+    get openai gpt-3.5 API response in stream mode, yield text deltas as soon as they arrive.
+    exceptions will be raised directly if request failed
+    :param key: str, api key on openai, only used by this request
+    :param msg: list, list of dict messages for gpt-3.5
+    :param stop_list: list, stop sequence of model
+    :param temperature: float, controls randomness
+    :param frequency_p: float, reduce repetitive words
+    :param presence_p: float, increase talking about new topics
+    :return: AsyncGenerator of str
+    """
+    payload = form_chat_payload(msg, stop_list, temperature, frequency_p, presence_p)
+
+    async for chunk in CHAT_CLIENT.stream(key, payload):
+        delta = chunk['choices'][0].get('delta', {}).get('content')
+        if delta:
+            yield delta
+
+
+def parse_chat_response(response: dict) -> GPTResponse:
+    """
+    parse decoded json response of openai chat API
+    :param response: dict
+    :return: GPTResponse
+    """
+    res = purge_cody_header(response['choices'][0]['message']['content'].strip())
+
+    usage = Usage(completion_tokens=response["usage"]["completion_tokens"],
+                  prompt_tokens=response["usage"]["prompt_tokens"],
+                  total_tokens=response["usage"]["total_tokens"])
+
+    return GPTResponse(message=res, usage=usage)
+
+
+def estimate_usage(msg: list, response_text: str, prompt_tokens: int = None) -> Usage:
+    """
+    estimate token usage locally, for stream mode responses that come without usage data
+    :param msg: list, list of dict messages sent to gpt-3.5
+    :param response_text: str, full response text
+    :param prompt_tokens: int (optional), token count of prompts if already known, skips counting msg
+    :return: Usage
+    """
+    if prompt_tokens is None:
+        prompt_tokens = REPLY_PRIMER_TOKENS
+        for ele in msg:
+            prompt_tokens += count_message_tokens(ele)
+    completion_tokens = count_tokens(response_text)
+
+    return Usage(completion_tokens=completion_tokens,
+                 prompt_tokens=prompt_tokens,
+                 total_tokens=prompt_tokens + completion_tokens)
+
+
 def get_chat_response(key: str, msg: Union[str, dict], stop_list: list = None,
                       temperature: float = 0.6,
                       frequency_p: float = 0.05,
@@ -47,11 +407,11 @@ def get_chat_response(key: str, msg: Union[str, dict], stop_list: list = None,
     :param use_35: bool, using gpt-3.5
     :return: (response_text: str, status: bool), (GPTResponse, status: bool)
     """
-    openai.api_key = key
     # logger.debug("using openai api...")
     if use_35:
         try:
             response: dict = openai.ChatCompletion.create(
+                api_key=key,
                 model="gpt-3.5-turbo-16k",
                 messages=msg,
                 temperature=temperature,
@@ -62,13 +422,7 @@ def get_chat_response(key: str, msg: Union[str, dict], stop_list: list = None,
                 stop=stop_list
             )
 
-            res = response['choices'][0]['message']['content'].strip()
-
-            if CODY_HEADER[1:-1] in res or CODY_HEADER[1:-1].replace(":", "：") in res:
-                res = res.split(CODY_HEADER[1:-1])[-1]
-                res = res.split(CODY_HEADER[1:-1].replace(":", "："))[-1]
-            while len(res) and res[0] == " ":
-                res = res[1:]
+            res = purge_cody_header(response['choices'][0]['message']['content'].strip())
 
             usage = Usage(completion_tokens=response["usage"]["completion_tokens"],
                           prompt_tokens=response["usage"]["prompt_tokens"],
@@ -83,6 +437,7 @@ def get_chat_response(key: str, msg: Union[str, dict], stop_list: list = None,
     else:
         try:
             response: dict = openai.Completion.create(
+                api_key=key,
                 model="text-davinci-003",
                 prompt=msg,
                 temperature=temperature,
@@ -93,12 +448,7 @@ def get_chat_response(key: str, msg: Union[str, dict], stop_list: list = None,
                 stop=stop_list
             )
 
-            res = response['choices'][0]['text'].strip()
-            if CODY_HEADER[1:-1] in res or CODY_HEADER[1:-1].replace(":", "：") in res:
-                res = res.split(CODY_HEADER[1:-1])[-1]
-                res = res.split(CODY_HEADER[1:-1].replace(":", "："))[-1]
-            while len(res) and res[0] == " ":
-                res = res[1:]
+            res = purge_cody_header(response['choices'][0]['text'].strip())
             return res, True
         except Exception as e:
             return f"发生错误: {e}", False
@@ -12,6 +12,8 @@ from pydantic import BaseSettings
 from nonebot import get_driver
 from nonebot.rule import to_me
 from nonebot.log import logger
+from .keypool import APIKeyPool, RequestScheduler, RequestPriority
+from .admission import AdmissionController
 
 
 class Config(BaseSettings):
@@ -21,29 +23,36 @@ class Config(BaseSettings):
     cody_gpt3_max_tokens: int = 400
     cody_max_session_tokens: int = 2048
     cody_session_forget_timeout: int = 3600
+    cody_api_pool_size: int = 32  # max keep-alive connections to openai API
+    cody_api_timeout: float = 60.0  # total timeout of one API request in seconds
+    cody_api_connect_timeout: float = 10.0  # connection timeout of one API request in seconds
+    cody_stream_response: bool = True  # send response sentence by sentence while it is generating
+    cody_api_key_rpm: int = 3500  # requests per minute limit of each API key
+    cody_api_key_tpm: int = 90000  # tokens per minute limit of each API key
+    cody_api_breaker_threshold: int = 3  # continuous failures to disable an API key
+    cody_api_breaker_cooldown: float = 30.0  # seconds before retrying a disabled API key
+    cody_api_acquire_timeout: float = 30.0  # max seconds to wait for an available API key
+    cody_api_key_concurrency: int = 8  # max requests in flight per API key
+    cody_api_group_share: float = 0.75  # max share of API concurrency used by group chat replies
+    cody_api_background_share: float = 0.25  # max share of API concurrency used by impressions and summaries
+    cody_summary_high_water: float = 0.75  # summarize old turns when prompts exceed this ratio of token budget
+    cody_summary_turns: int = 4  # count of the oldest turns to summarize at a time
+    cody_session_lock_timeout: float = 30.0  # max seconds to wait for a busy session
+    cody_batch_window: float = 0.0  # max seconds to wait for more messages before sending them in one turn
+    cody_batch_size: int = 8  # max count of messages combined in one turn
+    cody_session_cache_size: int = 256  # max count of user sessions and group sessions each kept in RAM
+    cody_session_save_interval: float = 30.0  # seconds between saving changed sessions in background
+    cody_session_checkpoint_interval: int = 32  # count of journal entries before a session is saved entirely
+    cody_warmup_sessions: int = 32  # count of recently active sessions loaded in background after startup
+    cody_max_turns_in_flight: int = 16  # max chat turns processed at once
+    cody_max_queued_turns: int = 64  # max chat turns waiting for admission, group turns are dropped first when full
+    cody_turn_deadline: float = 120.0  # max seconds a private chat turn may wait since its message arrived
+    cody_group_turn_deadline: float = 30.0  # max seconds a group chat turn may wait before it is dropped
 
     class Config:
         extra = "ignore"
 
 
-class APIManager(list):
-    current_api_index: int = 0
-
-    def get_api(self) -> str:
-        """
-        return api keys in loop
-        :return: str, API key of openai
-        """
-
-        ret = self[self.current_api_index]
-
-        self.current_api_index += 1
-        if self.current_api_index >= len(self):
-            self.current_api_index = 0
-
-        return ret
-
-
 DRIVER = get_driver()
 global_config = DRIVER.config
 CODY_CONFIG = Config.parse_obj(global_config)
@@ -59,14 +68,36 @@ if not Path(CODY_CONFIG.cody_gpt3_apikey_path).exists():
 # 创建路径
 LOCAL_CACHE = Path() / "cache"
 LOCAL_CACHE.mkdir(exist_ok=True)
-if not Path(CODY_CONFIG.cody_session_cache_dir).exists():
-    with open(CODY_CONFIG.cody_session_cache_dir, 'w', encoding='utf-8') as f:
-        f.close()
+SESSION_CACHE = Path(CODY_CONFIG.cody_session_cache_dir)
+if SESSION_CACHE.is_file() and SESSION_CACHE.stat().st_size == 0:
+    # empty placeholder file created by old version
+    SESSION_CACHE.unlink()
+if SESSION_CACHE.exists() and not SESSION_CACHE.is_dir():
+    raise NotADirectoryError(f"cody_session_cache_dir \"{SESSION_CACHE}\" exists but is not a directory, "
+                             f"move it away or set cody_session_cache_dir to another path")
+SESSION_CACHE.mkdir(parents=True, exist_ok=True)
 
 # 读取api密钥
 with open(CODY_CONFIG.cody_gpt3_apikey_path, 'r', encoding='utf-8') as f:
     APIKEY_LIST = yaml.load(f, Loader=yaml.FullLoader).get('api_keys')
-    APIKEY_LIST = APIManager(APIKEY_LIST)
+    APIKEY_LIST = APIKeyPool(APIKEY_LIST,
+                             rpm_limit=CODY_CONFIG.cody_api_key_rpm,
+                             tpm_limit=CODY_CONFIG.cody_api_key_tpm,
+                             failure_threshold=CODY_CONFIG.cody_api_breaker_threshold,
+                             cooldown=CODY_CONFIG.cody_api_breaker_cooldown,
+                             acquire_timeout=CODY_CONFIG.cody_api_acquire_timeout,
+                             key_concurrency=CODY_CONFIG.cody_api_key_concurrency)
     f.close()
 
+# 按优先级调度API请求
+API_SCHEDULER = RequestScheduler(APIKEY_LIST,
+                                 shares={RequestPriority.group: CODY_CONFIG.cody_api_group_share,
+                                         RequestPriority.background: CODY_CONFIG.cody_api_background_share})
+
+# 限制同时处理的对话轮数，过载时优先丢弃群聊消息
+ADMISSION = AdmissionController(max_in_flight=CODY_CONFIG.cody_max_turns_in_flight,
+                                max_queued=CODY_CONFIG.cody_max_queued_turns,
+                                deadlines={RequestPriority.interactive: CODY_CONFIG.cody_turn_deadline,
+                                           RequestPriority.group: CODY_CONFIG.cody_group_turn_deadline})
+
 logger.info(f"加载 {len(APIKEY_LIST)}个 APIKeys")
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: i2cy(i2cy@outlook.com)
+# Project: CodyBot2
+# Filename: conversation
+# Created on: 2023/7/4
+
+from collections import deque
+from typing import Callable, Union
+
+if __name__ == "__main__":
+    from utils import count_message_tokens
+else:
+    from .utils import count_message_tokens
+
+
+class ExtraTypes:
+    user_msg: int = 0
+    user_msg_info: int = 1
+    cody_msg: int = 2
+    sys_msg: int = 3
+
+
+class ConversationRecord:
+    __slots__ = ("message", "extra", "tokens", "turn")
+
+    def __init__(self, message: dict, extra: dict, tokens: int, turn: int):
+        """
+        one segment of conversation, message paired with its extra information
+        :param message: dict, message of openai chat API
+        :param extra: dict, extra information, default keywords: type, user_id, timestamp
+        :param tokens: int, token count of message
+        :param turn: int, turn ID that this segment belongs to
+        """
+        self.message = message
+        self.extra = extra
+        self.tokens = tokens
+        self.turn = turn
+
+    @property
+    def type(self) -> int:
+        return self.extra.get("type", ExtraTypes.sys_msg)
+
+    def __repr__(self):
+        return f"ConversationRecord(turn={self.turn}, tokens={self.tokens}, message={self.message})"
+
+
+class ConversationStore:
+
+    def __init__(self):
+        """
+        deque based ring buffer of conversation records. records are grouped in turns, a new turn starts
+        with the first user message or system message after Cody's message, so that bursts of user messages
+        share one turn with the reply. evictions from head cost O(1)
+        """
+        self.__records = deque()
+        self.__turn = 0  # ID of current (latest) turn
+        self.tokens = 0  # token count of all records
+        self.revision = 0  # mutation counter, increased by every modification
+        self.journal = None  # list of operations since last checkpoint, journaling is disabled when None
+
+    def __len__(self) -> int:
+        return len(self.__records)
+
+    def __iter__(self):
+        return iter(self.__records)
+
+    def __reversed__(self):
+        return reversed(self.__records)
+
+    def __bool__(self) -> bool:
+        return len(self.__records) > 0
+
+    def __repr__(self):
+        return f"ConversationStore(records={len(self.__records)}, tokens={self.tokens})"
+
+    def __record(self, *operation):
+        """
+        record an operation to journal if journaling is enabled
+        :param operation: operation name and its arguments
+        :return:
+        """
+        if self.journal is not None:
+            self.journal.append(operation)
+
+    def append(self, message: dict, extra: dict, tokens: int = None) -> ConversationRecord:
+        """
+        append a new segment to the tail of conversation
+        :param message: dict, message of openai chat API
+        :param extra: dict, extra information with 'type' keyword of ExtraTypes
+        :param tokens: int (optional), token count of message, will be counted if not given
+        :return: ConversationRecord
+        """
+        if tokens is None:
+            tokens = count_message_tokens(message)
+
+        record_type = extra.get("type", ExtraTypes.sys_msg)
+        if not self.__records:
+            self.__turn += 1
+        elif record_type != ExtraTypes.cody_msg and self.__records[-1].type == ExtraTypes.cody_msg:
+            # first segment after Cody's reply starts a new turn
+            self.__turn += 1
+
+        record = ConversationRecord(message, extra, tokens, self.__turn)
+        self.__records.append(record)
+        self.tokens += tokens
+        self.revision += 1
+        self.__record("append", message, extra, tokens)
+
+        return record
+
+    def appendleft(self, message: dict, extra: dict, tokens: int = None) -> ConversationRecord:
+        """
+        insert a segment as an individual turn at the head of conversation
+        :param message: dict, message of openai chat API
+        :param extra: dict, extra information with 'type' keyword of ExtraTypes
+        :param tokens: int (optional), token count of message, will be counted if not given
+        :return: ConversationRecord
+        """
+        if tokens is None:
+            tokens = count_message_tokens(message)
+
+        turn = self.__records[0].turn - 1 if self.__records else self.__turn
+        record = ConversationRecord(message, extra, tokens, turn)
+        self.__records.appendleft(record)
+        self.tokens += tokens
+        self.revision += 1
+        self.__record("appendleft", message, extra, tokens)
+
+        return record
+
+    def popleft(self) -> ConversationRecord:
+        """
+        remove and return the oldest segment
+        :return: ConversationRecord
+        """
+        record = self.__records.popleft()
+        self.tokens -= record.tokens
+        self.revision += 1
+        self.__record("popleft")
+
+        return record
+
+    def evict_turn(self) -> list:
+        """
+        remove the oldest turn as a whole
+        :return: list of ConversationRecord, removed records
+        """
+        ret = []
+        if self.__records:
+            turn = self.__records[0].turn
+            while self.__records and self.__records[0].turn == turn:
+                ret.append(self.popleft())
+
+        return ret
+
+    def turns(self) -> int:
+        """
+        return count of turns in conversation
+        :return: int
+        """
+        if not self.__records:
+            return 0
+
+        return self.__records[-1].turn - self.__records[0].turn + 1
+
+    def evict_until(self, max_tokens: int, min_turns: int = 0) -> list:
+        """
+        remove the oldest turns until token count of conversation is not greater than max_tokens
+        :param max_tokens: int
+        :param min_turns: int, count of the latest turns that will never be removed
+        :return: list of ConversationRecord, removed records
+        """
+        ret = []
+        while self.__records and self.tokens > max_tokens and self.turns() > min_turns:
+            ret.extend(self.evict_turn())
+
+        return ret
+
+    def head_turns(self, count: int) -> list:
+        """
+        return records of the oldest turns without removing them
+        :param count: int, count of turns
+        :return: list of ConversationRecord
+        """
+        ret = []
+        if self.__records:
+            end_turn = self.__records[0].turn + count
+            for ele in self.__records:
+                if ele.turn >= end_turn:
+                    break
+                ret.append(ele)
+
+        return ret
+
+    def compact(self, records: list, message: dict, extra: dict, tokens: int = None) -> ConversationRecord:
+        """
+        replace records at the head of conversation with one segment, e.g. a summary of them. records that
+        have been removed already are ignored
+        :param records: list of ConversationRecord, records returned by head_turns
+        :param message: dict, message of openai chat API
+        :param extra: dict, extra information with 'type' keyword of ExtraTypes
+        :param tokens: int (optional), token count of message, will be counted if not given
+        :return: ConversationRecord
+        """
+        records = set(id(ele) for ele in records)
+        while self.__records and id(self.__records[0]) in records:
+            self.popleft()
+
+        return self.appendleft(message, extra, tokens)
+
+    def remove(self, record: ConversationRecord):
+        """
+        remove a specific record
+        :param record: ConversationRecord
+        :return:
+        """
+        if self.journal is not None:
+            self.__record("remove", self.__records.index(record))
+        self.__records.remove(record)
+        self.tokens -= record.tokens
+        self.revision += 1
+
+    def update(self, record: ConversationRecord, message: dict, tokens: int = None):
+        """
+        replace message of a record and update its token count
+        :param record: ConversationRecord
+        :param message: dict, new message of openai chat API
+        :param tokens: int (optional), token count of message, will be counted if not given
+        :return:
+        """
+        if tokens is None:
+            tokens = count_message_tokens(message)
+
+        if self.journal is not None:
+            self.__record("update", self.__records.index(record), message, tokens)
+        self.tokens += tokens - record.tokens
+        record.message = message
+        record.tokens = tokens
+        self.revision += 1
+
+    def clear(self):
+        """
+        remove all records
+        :return:
+        """
+        self.__records.clear()
+        self.tokens = 0
+        self.revision += 1
+        self.__record("clear")
+
+    def replay(self, operation: str, *args):
+        """
+        apply an operation recorded in journal
+        :param operation: str, name of operation
+        :param args: arguments of operation, records are referred by index
+        :return:
+        """
+        if operation in ("append", "appendleft"):
+            getattr(self, operation)(*args)
+        elif operation == "popleft":
+            self.popleft()
+        elif operation == "remove":
+            self.remove(self.__records[args[0]])
+        elif operation == "update":
+            self.update(self.__records[args[0]], *args[1:])
+        elif operation == "clear":
+            self.clear()
+        else:
+            raise ValueError(f"unknown journal operation \"{operation}\"")
+
+    def records(self, record_type: int = None, reverse: bool = False):
+        """
+        iterate records, optionally only records of one type
+        :param record_type: int (optional), ExtraTypes
+        :param reverse: bool, iterate from the latest
+        :return: Generator of ConversationRecord
+        """
+        records = reversed(self.__records) if reverse else self.__records
+        for ele in records:
+            if record_type is None or ele.type == record_type:
+                yield ele
+
+    def last(self, record_type: int = None) -> Union[ConversationRecord, None]:
+        """
+        return the latest record, optionally of one type
+        :param record_type: int (optional), ExtraTypes
+        :return: ConversationRecord or None
+        """
+        for ele in self.records(record_type, reverse=True):
+            return ele
+
+        return None
+
+    def find(self, condition: Callable) -> Union[ConversationRecord, None]:
+        """
+        return the first record that matches condition
+        :param condition: Function(ConversationRecord) -> bool
+        :return: ConversationRecord or None
+        """
+        for ele in self.__records:
+            if condition(ele):
+                return ele
+
+        return None
+
+    def messages(self) -> list:
+        """
+        return list of messages in order, messages are not copied
+        :return: list of dict
+        """
+        return [ele.message for ele in self.__records]
+
+    def extras(self) -> list:
+        """
+        return list of extra information in order
+        :return: list of dict
+        """
+        return [ele.extra for ele in self.__records]
+
+    def to_json(self) -> (list, list):
+        """
+        return messages and extras in two lists, which is the storage format of sessions
+        :return: (list conversation, list conversation_extra)
+        """
+        conversation = []
+        conversation_extra = []
+        for ele in self.__records:
+            conversation.append(ele.message)
+            extra = dict(ele.extra)
+            extra['tokens'] = ele.tokens
+            conversation_extra.append(extra)
+
+        return conversation, conversation_extra
+
+    @classmethod
+    def from_json(cls, conversation: list, conversation_extra: list) -> "ConversationStore":
+        """
+        create a store from messages and extras in two lists
+        :param conversation: list of dict
+        :param conversation_extra: list of dict
+        :return: ConversationStore
+        """
+        ret = cls()
+        for message, extra in zip(conversation, conversation_extra):
+            extra = dict(extra)
+            tokens = extra.pop('tokens', None)
+            ret.append(message, extra, tokens)
+
+        return ret
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: i2cy(i2cy@outlook.com)
+# Project: CodyBot2
+# Filename: keypool
+# Created on: 2023/7/2
+
+import math
+import time
+import asyncio
+from collections import deque, OrderedDict
+from typing import Union
+from nonebot.log import logger
+
+
+class BreakerStates:
+    closed: int = 0  # key works normally
+    open: int = 1  # key is considered dead, no request will be sent until cooldown
+    half_open: int = 2  # cooldown finished, one probe request is allowed
+
+
+class TokenBucket:
+
+    def __init__(self, rate_per_min: float):
+        """
+        token bucket that refills continuously at given rate per minute
+        :param rate_per_min: float, also the capacity of bucket
+        """
+        self.capacity = float(rate_per_min)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.__last_ts = time.monotonic()
+
+    def __refill(self, now: float):
+        """
+        refill bucket according to time passed
+        :param now: float, monotonic timestamp
+        :return:
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.__last_ts) * self.rate)
+        self.__last_ts = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """
+        return seconds to wait until given amount of tokens is available, 0 if available now
+        :param amount: float
+        :param now: float, monotonic timestamp
+        :return: float
+        """
+        self.__refill(now)
+        amount = min(amount, self.capacity)  # oversize requests only need a full bucket
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float, now: float):
+        """
+        take tokens from bucket, bucket may go negative for oversize requests
+        :param amount: float
+        :param now: float, monotonic timestamp
+        :return:
+        """
+        self.__refill(now)
+        self.tokens -= amount
+
+    def refund(self, amount: float):
+        """
+        give back tokens (negative amount to take more), used when actual cost differs from reserved
+        :param amount: float
+        :return:
+        """
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def drain(self, now: float):
+        """
+        empty bucket, used when server reported rate limited
+        :param now: float, monotonic timestamp
+        :return:
+        """
+        self.__refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class APIKey:
+
+    def __init__(self, key: str, id: int, rpm_limit: int, tpm_limit: int):
+        """
+        state of one openai API key
+        :param key: str, API key
+        :param id: int, 1-based ID of key for display
+        :param rpm_limit: int, requests per minute
+        :param tpm_limit: int, tokens per minute
+        """
+        self.key = key
+        self.id = id
+        self.request_bucket = TokenBucket(rpm_limit)
+        self.token_bucket = TokenBucket(tpm_limit)
+        self.in_flight = 0
+
+        # circuit breaker
+        self.state = BreakerStates.closed
+        self.failures = 0  # consecutive failures
+        self.open_until = 0.0  # monotonic timestamp when open state ends
+        self.cooldown = 0.0  # current cooldown duration, doubled after every failed probe
+        self.probing = False  # whether if the half-open probe request is in flight
+
+        self.blocked_until = 0.0  # monotonic timestamp when server side rate limit ends
+
+    def __str__(self):
+        return str(self.key)
+
+    def __repr__(self):
+        return f"APIKey(ID: {self.id})"
+
+    def wait_time(self, tokens: int, now: float) -> float:
+        """
+        return seconds to wait until this key can take a request of given token size, 0 if available now
+        :param tokens: int, estimated token cost of request
+        :param now: float, monotonic timestamp
+        :return: float
+        """
+        if self.state == BreakerStates.open:
+            if now < self.open_until:
+                return self.open_until - now
+            # cooldown finished, allow one probe
+            self.state = BreakerStates.half_open
+            self.probing = False
+
+        if self.state == BreakerStates.half_open and self.probing:
+            # wait for result of probe, check again later
+            return 1.0
+
+        return max(self.blocked_until - now,
+                   self.request_bucket.wait_time(1, now),
+                   self.token_bucket.wait_time(tokens, now),
+                   0.0)
+
+
+class APIKeyPool(list):
+
+    def __init__(self, keys: list = None, rpm_limit: int = 3500, tpm_limit: int = 90000,
+                 failure_threshold: int = 3, cooldown: float = 30.0, max_cooldown: float = 1800.0,
+                 acquire_timeout: float = 30.0, key_concurrency: int = 8):
+        """
+        health and rate-limit aware API key scheduler, always lends the least loaded available key.
+        every key has token buckets of requests/min and tokens/min, and a circuit breaker which opens
+        after continuous failures and probes the key again after cooldown
+        :param keys: list, list of API keys in str
+        :param rpm_limit: int, requests per minute of each key
+        :param tpm_limit: int, tokens per minute of each key
+        :param failure_threshold: int, continuous failures to open circuit breaker
+        :param cooldown: float, seconds before probing an opened key
+        :param max_cooldown: float, max seconds of cooldown after repeated failed probes
+        :param acquire_timeout: float, default max seconds to wait for an available key
+        :param key_concurrency: int, max requests in flight per key
+        """
+        if keys is None:
+            keys = []
+        super().__init__(APIKey(ele, i + 1, rpm_limit, tpm_limit) for i, ele in enumerate(keys))
+
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.acquire_timeout = acquire_timeout
+        self.key_concurrency = key_concurrency
+
+    def __select(self, tokens: int, now: float) -> (Union[APIKey, None], Union[float, None]):
+        """
+        select the least loaded key that is available now
+        :param tokens: int, estimated token cost of request
+        :param now: float, monotonic timestamp
+        :return: (APIKey or None, float seconds to wait or None if no key exists)
+        """
+        best = None
+        min_wait = None
+        for key in self:
+            wait = key.wait_time(tokens, now)
+            if wait <= 0 and key.in_flight >= self.key_concurrency:
+                # key is busy, check again after a request released
+                wait = 1.0
+            if wait > 0:
+                if min_wait is None or wait < min_wait:
+                    min_wait = wait
+                continue
+
+            if best is None or (key.in_flight, -key.token_bucket.tokens) < \
+                    (best.in_flight, -best.token_bucket.tokens):
+                best = key
+
+        return best, min_wait
+
+    def try_acquire(self, tokens: int, now: float = None) -> (Union[APIKey, None], Union[float, None]):
+        """
+        lend an available key without waiting. must call release after request
+        :param tokens: int, estimated token cost of request
+        :param now: float (optional), monotonic timestamp
+        :return: (APIKey or None, float seconds to wait or None if no key exists)
+        """
+        if now is None:
+            now = time.monotonic()
+        key, wait = self.__select(tokens, now)
+
+        if key is not None:
+            key.request_bucket.consume(1, now)
+            key.token_bucket.consume(tokens, now)
+            key.in_flight += 1
+            if key.state == BreakerStates.half_open:
+                key.probing = True
+
+        return key, wait
+
+    async def acquire(self, tokens: int = 0, timeout: float = None) -> Union[APIKey, None]:
+        """
+        lend an available key, wait if all keys are busy or rate limited. must call release after request
+        :param tokens: int, estimated token cost of request
+        :param timeout: float (optional), max seconds to wait, use default acquire timeout if not set
+        :return: APIKey, or None if timeout
+        """
+        if timeout is None:
+            timeout = self.acquire_timeout
+        deadline = time.monotonic() + timeout
+
+        while True:
+            now = time.monotonic()
+            key, wait = self.try_acquire(tokens, now)
+
+            if key is not None:
+                return key
+
+            if wait is None or now + wait > deadline:
+                # no key at all, or no key will be available in time
+                return None
+
+            await asyncio.sleep(min(wait, 1.0))
+
+    def unlend(self, key: APIKey, reserved_tokens: int = 0):
+        """
+        return a lent key that has not been used to send any request
+        :param key: APIKey
+        :param reserved_tokens: int, token count reserved when acquiring
+        :return:
+        """
+        key.in_flight = max(0, key.in_flight - 1)
+        key.request_bucket.refund(1)
+        key.token_bucket.refund(reserved_tokens)
+        if key.state == BreakerStates.half_open:
+            key.probing = False
+
+    def release(self, key: APIKey, success: bool, reserved_tokens: int = 0, used_tokens: int = None,
+                status_code: int = 0, retry_after: float = None):
+        """
+        return a lent key with result of request
+        :param key: APIKey
+        :param success: bool, whether if request succeeded
+        :param reserved_tokens: int, token count reserved when acquiring
+        :param used_tokens: int (optional), actual token cost, refund reserved tokens if not set
+        :param status_code: int, http status code of failed request, 0 for unknown
+        :param retry_after: float (optional), seconds to wait that server suggested when rate limited
+        :return:
+        """
+        now = time.monotonic()
+        key.in_flight = max(0, key.in_flight - 1)
+
+        if used_tokens is None:
+            used_tokens = 0
+        key.token_bucket.refund(reserved_tokens - used_tokens)
+
+        if success:
+            if key.state != BreakerStates.closed:
+                logger.info(f"API key (ID: {key.id}) recovered")
+            key.state = BreakerStates.closed
+            key.failures = 0
+            key.cooldown = 0.0
+            key.probing = False
+            return
+
+        if status_code == 429:
+            # rate limited, not a health problem of key
+            key.request_bucket.drain(now)
+            key.blocked_until = now + (retry_after if retry_after else 20.0)
+            if key.state == BreakerStates.half_open:
+                key.probing = False
+            logger.warning(f"API key (ID: {key.id}) is rate limited, blocked for "
+                           f"{key.blocked_until - now:.1f} seconds")
+            return
+
+        key.failures += 1
+        if key.state == BreakerStates.half_open or key.failures >= self.failure_threshold \
+                or status_code in (401, 403):
+            # open circuit breaker, cooldown doubles after every failed probe
+            if key.state == BreakerStates.half_open:
+                key.cooldown = min(self.max_cooldown, key.cooldown * 2)
+            else:
+                key.cooldown = self.cooldown
+            if status_code in (401, 403):
+                # invalid key, no need to probe frequently
+                key.cooldown = self.max_cooldown
+            key.state = BreakerStates.open
+            key.open_until = now + key.cooldown
+            key.probing = False
+            logger.warning(f"API key (ID: {key.id}) disabled for {key.cooldown:.0f} seconds after "
+                           f"{key.failures} failure(s)")
+
+    def invalid_ids(self) -> list:
+        """
+        return ID of keys that are currently disabled by circuit breaker
+        :return: list of int
+        """
+        return [ele.id for ele in self if ele.state != BreakerStates.closed]
+
+    def available(self, now: float = None) -> int:
+        """
+        return count of keys not disabled by circuit breaker, including keys ready for a probe
+        :param now: float (optional), monotonic timestamp
+        :return: int
+        """
+        if now is None:
+            now = time.monotonic()
+
+        return sum(1 for ele in self if ele.state != BreakerStates.open or ele.open_until <= now)
+
+    def in_flight(self) -> int:
+        """
+        return count of requests in flight of all keys
+        :return: int
+        """
+        return sum(ele.in_flight for ele in self)
+
+
+class RequestPriority:
+    interactive: int = 0  # replies in private chats and to admin
+    group: int = 1  # replies in group chats
+    background: int = 2  # bookkeeping such as impressions, feedback checks and summaries
+
+
+class RequestWaiter:
+    __slots__ = ("tokens", "future")
+
+    def __init__(self, tokens: int):
+        """
+        request waiting in queue of request scheduler
+        :param tokens: int, estimated token cost of request
+        """
+        self.tokens = tokens
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class RequestScheduler:
+
+    def __init__(self, pool: APIKeyPool, shares: dict = None):
+        """
+        global priority scheduler of outbound API requests. keys are lent strictly by priority, so that when
+        keys are scarce user-facing requests are served before bookkeeping ones. every priority class has
+        a concurrency limit of its share of the pool, and sessions in one class are served in round-robin
+        :param pool: APIKeyPool
+        :param shares: dict (optional), share of pool concurrency of each class, format: {priority: float}
+        """
+        if shares is None:
+            shares = {}
+        self.pool = pool
+        self.shares = {
+            RequestPriority.interactive: 1.0,
+            RequestPriority.group: 0.75,
+            RequestPriority.background: 0.25
+        }
+        self.shares.update(shares)
+
+        # waiting requests of each class, format: {priority: OrderedDict({session_key: deque of RequestWaiter})}
+        self.__queues = {ele: OrderedDict() for ele in self.shares}
+        self.__in_flight = {ele: 0 for ele in self.shares}
+        self.__pump: asyncio.Task = None  # task retrying queued requests, alive while there are waiters
+        self.__wakeup: asyncio.Event = None
+
+    def limit(self, priority: int) -> int:
+        """
+        return max requests in flight of a priority class
+        :param priority: int, RequestPriority
+        :return: int
+        """
+        # keys disabled by circuit breaker take no requests, so they add nothing to the limit
+        return max(1, math.ceil(self.pool.available() * self.pool.key_concurrency * self.shares[priority]))
+
+    def in_flight(self, priority: int = None) -> int:
+        """
+        return count of requests in flight
+        :param priority: int (optional), RequestPriority, count all classes if not given
+        :return: int
+        """
+        if priority is None:
+            return sum(self.__in_flight.values())
+
+        return self.__in_flight[priority]
+
+    def waiting(self, priority: int = None) -> int:
+        """
+        return count of requests waiting for keys
+        :param priority: int (optional), RequestPriority, count all classes if not given
+        :return: int
+        """
+        queues = self.__queues.values() if priority is None else (self.__queues[priority],)
+
+        return sum(len(waiters) for queue in queues for waiters in queue.values())
+
+    def __dispatch(self) -> Union[float, None]:
+        """
+        lend keys to waiting requests in order of priority and session round-robin
+        :return: float, seconds to wait before keys may be available again, None if nothing to wait for
+        """
+        now = time.monotonic()
+        for priority in sorted(self.__queues):
+            queue = self.__queues[priority]
+            while queue and self.__in_flight[priority] < self.limit(priority):
+                session_key, waiters = next(iter(queue.items()))
+                waiter = waiters[0]
+                if not waiter.future.done():
+                    key, wait = self.pool.try_acquire(waiter.tokens, now)
+                    if key is None and wait is not None:
+                        # keys are scarce, lower classes must not overtake
+                        return wait
+                    waiter.future.set_result(key)  # None if there is no key at all
+                    if key is not None:
+                        self.__in_flight[priority] += 1
+
+                # serve next session in this class
+                waiters.popleft()
+                queue.pop(session_key)
+                if waiters:
+                    queue[session_key] = waiters
+
+        return None
+
+    async def __pump_loop(self):
+        while self.waiting():
+            self.__wakeup.clear()
+            wait = self.__dispatch()
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), min(wait, 1.0) if wait is not None else None)
+            except asyncio.TimeoutError:
+                pass
+
+    def __kick(self):
+        """
+        dispatch waiting requests now and keep retrying in background while some are left
+        :return:
+        """
+        if self.__wakeup is None:
+            self.__wakeup = asyncio.Event()
+        if self.__pump is None or self.__pump.done():
+            self.__dispatch()
+            if self.waiting():
+                self.__pump = asyncio.create_task(self.__pump_loop())
+        else:
+            self.__wakeup.set()
+
+    async def acquire(self, tokens: int = 0, priority: int = RequestPriority.group, session_key: str = None,
+                      timeout: float = None) -> Union[APIKey, None]:
+        """
+        lend a key when it is the turn of this request. must call release after request
+        :param tokens: int, estimated token cost of request
+        :param priority: int, RequestPriority
+        :param session_key: str (optional), key of session for fair queuing, e.g. 'user_123456'
+        :param timeout: float (optional), max seconds to wait, use default acquire timeout of pool if not set
+        :return: APIKey, or None if timeout or there is no key
+        """
+        if timeout is None:
+            timeout = self.pool.acquire_timeout
+
+        waiter = RequestWaiter(tokens)
+        self.__queues[priority].setdefault(session_key, deque()).append(waiter)
+        self.__kick()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as err:
+            if waiter.future.done() and waiter.future.result() is not None:
+                # key lent right before timeout or cancellation, give it back
+                self.pool.unlend(waiter.future.result(), tokens)
+                self.__in_flight[priority] -= 1
+                self.__kick()
+            else:
+                waiter.future.cancel()
+                waiters = self.__queues[priority].get(session_key)
+                if waiters is not None and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        self.__queues[priority].pop(session_key)
+            if isinstance(err, asyncio.CancelledError):
+                raise
+            logger.warning(f"no API key lent in {timeout} seconds for request of priority {priority}")
+            return None
+
+    def release(self, key: APIKey, priority: int, *args, **kwargs):
+        """
+        return a lent key with result of request, see APIKeyPool.release for arguments
+        :param key: APIKey
+        :param priority: int, RequestPriority of request
+        :return:
+        """
+        self.__in_flight[priority] = max(0, self.__in_flight[priority] - 1)
+        self.pool.release(key, *args, **kwargs)
+        if self.waiting():
+            self.__kick()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: i2cy(i2cy@outlook.com)
+# Project: CodyBot2
+# Filename: manager
+# Created on: 2023/7/6
+
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Callable
+from nonebot.log import logger
+from .session import SessionGPT35
+from .store import SessionStore
+
+
+class SessionManager:
+
+    def __init__(self, factory: Callable, store: SessionStore, is_group: bool = False,
+                 max_sessions: int = 256, idle_timeout: float = 3600, checkpoint_interval: int = 32):
+        """
+        LRU cache of sessions in RAM, sessions are saved to session store when evicted and loaded lazily
+        on next access. changes are saved as journal entries, and a session is saved entirely as a new
+        checkpoint after checkpoint_interval journal entries
+        :param factory: Function(int id, str name) -> SessionGPT35, create a new session
+        :param store: SessionStore, storage of saved sessions
+        :param is_group: bool, manage group sessions or user sessions
+        :param max_sessions: int, max count of sessions in RAM
+        :param idle_timeout: float, seconds without access before a session is evicted
+        :param checkpoint_interval: int, max count of journal entries since last checkpoint
+        """
+        self.factory = factory
+        self.store = store
+        self.is_group = is_group
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.checkpoint_interval = checkpoint_interval
+
+        self.__sessions = OrderedDict()  # least recently used first
+        self.__saved = {}  # memory revision of sessions when they were saved or loaded, format: {id: revision}
+        self.__journal_entries = {}  # count of journal entries since last checkpoint, None if there is no checkpoint
+        self.__saving = set()  # ID of sessions collected by collect_dirty and not written yet
+
+    def __len__(self) -> int:
+        return len(self.__sessions)
+
+    def __contains__(self, id) -> bool:
+        return int(id) in self.__sessions
+
+    def __iter__(self):
+        return iter(list(self.__sessions.values()))
+
+    def __log(self, message: str):
+        label = "group" if self.is_group else "user"
+        logger.info(f"[{label} session manager] {message}")
+
+    def get(self, id: int, name: str = None) -> SessionGPT35:
+        """
+        get a session, load it from session store or create a new one if it is not in RAM
+        :param id: int, QQ ID of user or group
+        :param name: str (optional), nickname of user
+        :return: SessionGPT35
+        """
+        id = int(id)
+        session = self.__sessions.get(id)
+
+        if session is None:
+            session = self.factory(id, name)
+
+            # check if there is previously saved session to load, then replay its journal
+            entries = None
+            try:
+                data = self.store.get(self.is_group, id)
+                if data is not None:
+                    session.load(data, self.store)
+                    journal = self.store.get_journal(self.is_group, id)
+                    session.load_journal(journal)
+                    entries = len(journal)
+            except Exception as err:
+                logger.error(f"failed to load saved session {self.store.session_key(self.is_group, id)}, {err}")
+                entries = None
+
+            session.conversation.start_journal()
+            self.__sessions[id] = session
+            self.__saved[id] = session.conversation.get_revision()
+            self.__journal_entries[id] = entries
+            self.evict_overflow()
+        else:
+            self.__sessions.move_to_end(id)
+
+        session.last_active = time.time()
+
+        return session
+
+    def is_dirty(self, id: int) -> bool:
+        """
+        return whether if a session in RAM has changes not saved
+        :param id: int, QQ ID of user or group
+        :return: bool
+        """
+        session = self.__sessions.get(int(id))
+        if session is None:
+            return False
+
+        return self.__saved.get(int(id)) != session.conversation.get_revision()
+
+    def dump(self, id: int) -> bool:
+        """
+        save a session in RAM to session store immediately if it has changes
+        :param id: int, QQ ID of user or group
+        :return: bool, return operation status
+        """
+        id = int(id)
+        session = self.__sessions.get(id)
+        if session is None:
+            # return False when session not found
+            return False
+
+        if not self.is_dirty(id):
+            # nothing to save
+            return True
+
+        if id in self.__saving:
+            # being saved by session persister
+            return False
+
+        try:
+            # generate session dumps and save
+            revision = session.conversation.get_revision()
+            is_checkpoint, session_dumps, count = self.__serialize(id, session)
+            if is_checkpoint:
+                self.store.put(self.is_group, id, session_dumps)
+            else:
+                self.store.append_journal(self.is_group, id, session_dumps)
+            self.mark_saved(id, revision, is_checkpoint, count)
+        except Exception as err:
+            logger.error(f"failed to save session {id}, {err}")
+            return False
+
+        return True
+
+    def __serialize(self, id: int, session: SessionGPT35) -> (bool, bytes, int):
+        """
+        serialize changes of a session as a journal entry, or the whole session as a checkpoint when its journal
+        is too long or can not describe the changes. a new journal starts right after checkpoint is taken, and
+        checkpoint is required again until mark_saved is called
+        :param id: int, QQ ID of user or group
+        :param session: SessionGPT35
+        :return: (bool is_checkpoint, bytes data, int count of journal operations)
+        """
+        memory = session.conversation
+        entries = self.__journal_entries.get(id)
+        if memory.journal is None or entries is None or entries >= self.checkpoint_interval \
+                or self.__saved[id][0] != memory.version:
+            # memory replaced, no checkpoint saved, journal too long or preset modified
+            data = session.dump(self.store)
+            memory.start_journal()
+            self.__journal_entries[id] = None
+            return True, data, 0
+
+        data, count = session.dump_journal()
+
+        return False, data, count
+
+    def collect_dirty(self) -> list:
+        """
+        serialize all sessions in RAM that have changes not saved, call mark_saved or mark_failed after
+        they are written
+        :return: list of (int id, bool is_checkpoint, bytes data, tuple revision, int count)
+        """
+        ret = []
+        for id, session in self.__sessions.items():
+            revision = session.conversation.get_revision()
+            if self.__saved.get(id) == revision or id in self.__saving:
+                continue
+            try:
+                is_checkpoint, data, count = self.__serialize(id, session)
+                ret.append((id, is_checkpoint, data, revision, count))
+                self.__saving.add(id)
+            except Exception as err:
+                logger.error(f"failed to serialize session {id}, {err}")
+
+        return ret
+
+    def mark_saved(self, id: int, revision: tuple, is_checkpoint: bool = True, count: int = 0):
+        """
+        record revision of a session that has been written to session store, and drop saved operations
+        from its journal
+        :param id: int, QQ ID of user or group
+        :param revision: tuple, revision returned by collect_dirty
+        :param is_checkpoint: bool, whether if the whole session was saved
+        :param count: int, count of journal operations saved
+        :return:
+        """
+        id = int(id)
+        self.__saving.discard(id)
+        session = self.__sessions.get(id)
+        if session is None:
+            return
+
+        self.__saved[id] = revision
+        if is_checkpoint:
+            self.__journal_entries[id] = 0
+        else:
+            session.conversation.truncate_journal(count)
+            self.__journal_entries[id] += 1
+
+    def mark_failed(self, id: int):
+        """
+        release a session collected by collect_dirty that failed to be written, its changes will be collected
+        again next time
+        :param id: int, QQ ID of user or group
+        :return:
+        """
+        self.__saving.discard(int(id))
+
+    @staticmethod
+    def is_evictable(session: SessionGPT35) -> bool:
+        """
+        return whether if a session has no work in progress
+        :param session: SessionGPT35
+        :return: bool
+        """
+        if session.is_busy() or session.inbox_owner or session.inbox:
+            return False
+        if session.compaction_task is not None and not session.compaction_task.done():
+            return False
+
+        return True
+
+    def evict(self, id: int) -> bool:
+        """
+        save a session and remove it from RAM
+        :param id: int, QQ ID of user or group
+        :return: bool, return operation status
+        """
+        id = int(id)
+        session = self.__sessions.get(id)
+        if session is None or not self.is_evictable(session) or id in self.__saving:
+            return False
+
+        if not self.dump(id):
+            # keep it in RAM if it can not be saved
+            return False
+
+        self.__sessions.pop(id)
+        self.__saved.pop(id, None)
+        self.__journal_entries.pop(id, None)
+        session.kill()
+
+        return True
+
+    def evict_overflow(self) -> int:
+        """
+        evict the least recently used sessions until session count fits in limit
+        :return: int, count of sessions evicted
+        """
+        ret = 0
+        for id in list(self.__sessions):
+            if len(self.__sessions) <= self.max_sessions:
+                break
+            ret += self.evict(id)
+
+        if ret:
+            self.__log(f"evicted {ret} least recently used session(s), {len(self.__sessions)} in RAM")
+
+        return ret
+
+    def evict_idle(self) -> int:
+        """
+        evict sessions that have not been accessed in idle timeout
+        :return: int, count of sessions evicted
+        """
+        ret = 0
+        deadline = time.time() - self.idle_timeout
+        for id, session in list(self.__sessions.items()):
+            if session.last_active >= deadline:
+                # sessions are ordered by access time, the rest are all active
+                break
+            ret += self.evict(id)
+
+        if ret:
+            self.__log(f"evicted {ret} idle session(s), {len(self.__sessions)} in RAM")
+
+        return ret
+
+
+class SessionPersister:
+
+    def __init__(self, store: SessionStore, managers: list, interval: float = 30):
+        """
+        write-behind persister, saves changed sessions of managers to session store periodically in batches.
+        every batch is written in one transaction so that a crash never leaves half-written sessions
+        :param store: SessionStore
+        :param managers: list of SessionManager
+        :param interval: float, seconds between flushes
+        """
+        self.store = store
+        self.managers = managers
+        self.interval = interval
+
+        self.__task: asyncio.Task = None
+
+    async def flush(self) -> int:
+        """
+        save all changed sessions in one transaction. changes are collected on event loop, and the transaction
+        is written in a worker thread so that chats are not blocked while database syncs to disk
+        :return: int, count of sessions saved
+        """
+        batches = [(manager, manager.collect_dirty()) for manager in self.managers]
+        rows = []
+        journal_rows = []
+        for manager, batch in batches:
+            for id, is_checkpoint, data, revision, count in batch:
+                (rows if is_checkpoint else journal_rows).append((manager.is_group, id, data))
+
+        saved = not rows and not journal_rows
+        try:
+            if not saved:
+                write = asyncio.get_running_loop().run_in_executor(None, self.store.put_many, rows, journal_rows)
+                try:
+                    await asyncio.shield(write)
+                except asyncio.CancelledError:
+                    # transaction can not be stopped halfway, wait for it so that its result is known
+                    await asyncio.wait((write,))
+                    raise
+                finally:
+                    saved = write.done() and write.exception() is None
+        finally:
+            for manager, batch in batches:
+                for id, is_checkpoint, data, revision, count in batch:
+                    if saved:
+                        manager.mark_saved(id, revision, is_checkpoint, count)
+                    else:
+                        manager.mark_failed(id)
+
+        return len(rows) + len(journal_rows)
+
+    async def __loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                count = await self.flush()
+                if count:
+                    logger.debug(f"[session persister] saved {count} session(s)")
+            except Exception as err:
+                logger.error(f"[session persister] failed to save sessions, {err}")
+
+    def start(self):
+        """
+        start background flushing task
+        :return:
+        """
+        if self.__task is None or self.__task.done():
+            self.__task = asyncio.create_task(self.__loop())
+
+    async def stop(self) -> int:
+        """
+        stop background flushing task and save everything left
+        :return: int, count of sessions saved in final flush
+        """
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+        return await self.flush()
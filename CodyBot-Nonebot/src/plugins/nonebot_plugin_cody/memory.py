@@ -7,13 +7,15 @@
 
 import json
 import time
-from typing import Any
+import itertools
+from typing import Any, TYPE_CHECKING
 
-import tiktoken
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, root_validator, validator
 
 if __name__ == "__main__":
-    from utils import GPTResponse, TimeStamp
+    from utils import GPTResponse, TimeStamp, count_message_tokens, REPLY_PRIMER_TOKENS, \
+        extract_json_and_purge_cody_response
+    from conversation import ConversationStore, ExtraTypes
 
 
     class SessionGPT35:
@@ -21,15 +23,71 @@ if __name__ == "__main__":
         def __init__(self):
             pass
 else:
-    from .utils import GPTResponse, TimeStamp
-    from .session import SessionGPT35
+    from .utils import GPTResponse, TimeStamp, count_message_tokens, REPLY_PRIMER_TOKENS, \
+        extract_json_and_purge_cody_response
+    from .conversation import ConversationStore, ExtraTypes
 
+    if TYPE_CHECKING:
+        from .session import SessionGPT35
 
-class ExtraTypes:
-    user_msg: int = 0
-    user_msg_info: int = 1
-    cody_msg: int = 2
-    sys_msg: int = 3
+
+PRESET_FIELDS = ("basic", "actions", "extensions", "conversation_examples")  # fields of preset in saved json
+STATUS_VERSION_COUNTER = itertools.count(1)  # global unique version stamps of status message dicts
+
+
+class StatusMessages(dict):
+
+    def __init__(self, *args, **kwargs):
+        """
+        dict of status messages that stamps a new version on every modification, modifications are recorded
+        to journal if journaling is enabled
+        """
+        super().__init__(*args, **kwargs)
+        self.version = next(STATUS_VERSION_COUNTER)
+        self.journal = None  # list of operations since last checkpoint, journaling is disabled when None
+
+    def __touch(self, *operation):
+        self.version = next(STATUS_VERSION_COUNTER)
+        if self.journal is not None:
+            self.journal.append(operation)
+
+    def __setitem__(self, key, value):
+        if key in self and self[key] == value:
+            # unchanged, keep version and journal untouched
+            return
+        super().__setitem__(key, value)
+        self.__touch("status_set", key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.__touch("status_del", key)
+
+    def update(self, *args, **kwargs):
+        # record changed keys one by one
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key not in self:
+            # return default or raise KeyError
+            return super().pop(key, *args)
+        ret = self[key]
+        del self[key]
+        return ret
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.__touch("status_del", key)
+        return key, value
+
+    def clear(self):
+        super().clear()
+        self.__touch("status_reset", {})
 
 
 class Memory(BaseModel):
@@ -91,14 +149,28 @@ class Memory(BaseModel):
                      "from your cage, where is your master by the way?"}],
     ]  # example conversation example
 
-    status_messages: dict = {}  # status message dict with no order
+    status_messages: StatusMessages = Field(default_factory=StatusMessages)  # status message dict with no order
 
-    conversation: list = []  # conversation dict in memory
-    conversation_extra: list = []  # extra information about each element in conversations
+    # conversation segments in memory, each message is paired with its extra information and token count
+    conversation: ConversationStore = Field(default_factory=ConversationStore)
 
     used_token_score: int = 0  # summary of tokens that current prompts cost
     max_token_limit: int = 16_384  # max token score limit setting
 
+    version: int = 0  # mutation counter of preset, bumped by every preset modification
+
+    journal: list = None  # operations on conversation and status messages since last checkpoint
+
+    # -*- prompt caches -*-
+
+    static_prefix: tuple = ()  # frozen messages of basic, actions, extensions and examples
+    static_prefix_version: int = -1  # version of memory that static prefix cache was built from
+    static_prefix_tokens: int = 0  # token count of static prefix
+    status_prefix: tuple = ()  # frozen messages of status and the head of real conversations
+    status_prefix_version: int = -1  # version of status messages that status prefix cache was built from
+    status_prefix_tokens: int = 0  # token count of status prefix
+    status_message_tokens: dict = {}  # token count cache of status messages, format: {key: (text, tokens)}
+
     # -*- temporaries -*-
 
     user_msg: str = ""  # user message temporary storage
@@ -114,13 +186,68 @@ class Memory(BaseModel):
     # extra information about cody_msg_extra, default keywords: type=ExtraTypes.cody_msg, user_id, timestamp(same)
     cody_msg_extra: dict = {}
 
-    user_msg_post_proc: list = []  # list of functions that will be called every time calling 'add_user_message' method
-    cody_msg_post_proc: list = []  # list of functions that will be called every time parsing a GPTResponse
+    user_msg_post_proc: list = []  # coroutine functions that will be awaited every time calling 'add_user_message'
+    cody_msg_post_proc: list = []  # coroutine functions that will be awaited every time parsing a GPTResponse
 
     logger: None = None
     session: Any = None
 
-    def set_parent(self, session: SessionGPT35):
+    class Config:
+        arbitrary_types_allowed = True
+
+    @root_validator(pre=True)
+    def parse_conversation(cls, values: dict) -> dict:
+        """
+        parse conversation and conversation_extra lists in saved json to ConversationStore
+        :param values: dict
+        :return: dict
+        """
+        conversation = values.get("conversation")
+        if isinstance(conversation, list):
+            conversation_extra = [cls.parse_extra(ele) for ele in values.pop("conversation_extra", [])]
+            values["conversation"] = ConversationStore.from_json(conversation, conversation_extra)
+
+        return values
+
+    @staticmethod
+    def parse_extra(extra: dict) -> dict:
+        """
+        convert saved extra information of conversation segment back to its runtime form
+        :param extra: dict
+        :return: dict
+        """
+        if isinstance(extra.get("timestamp"), (int, float)):
+            # timestamps are saved in float
+            extra = dict(extra, timestamp=TimeStamp(extra["timestamp"]))
+
+        return extra
+
+    @staticmethod
+    def dump_extra(extra: dict) -> dict:
+        """
+        convert extra information of conversation segment to json serializable form
+        :param extra: dict
+        :return: dict
+        """
+        if isinstance(extra.get("timestamp"), TimeStamp):
+            # save timestamps in float
+            extra = dict(extra, timestamp=float(extra["timestamp"]))
+
+        return extra
+
+    @validator("status_messages", pre=True)
+    def parse_status_messages(cls, value) -> StatusMessages:
+        """
+        convert status message dict to StatusMessages
+        :param value: dict
+        :return: StatusMessages
+        """
+        if not isinstance(value, StatusMessages):
+            value = StatusMessages(value)
+
+        return value
+
+    def set_parent(self, session: "SessionGPT35"):
         """
         set parent session class for memory class
         :param session: SessionGPT35
@@ -160,9 +287,9 @@ class Memory(BaseModel):
         """
         if self.user_msg:
             # if user_msg was stored before, save it and clear it
-            self.conversation.extend(self.__form_user_msg())
-            self.conversation_extra.append(self.user_msg_extra)
-            self.conversation_extra.append(self.user_msg_info_extra)
+            user_msg_info, user_msg = self.__form_user_msg()
+            self.conversation.append(user_msg_info, self.user_msg_info_extra)
+            self.conversation.append(user_msg, self.user_msg_extra)
             self.user_msg = ""
             self.user_msg_info = {}
             self.user_msg_extra = {}
@@ -170,11 +297,11 @@ class Memory(BaseModel):
 
         if self.cody_msg is not None:
             # if cody_msg was stored before, save it and clear it
-            self.conversation.append({
+            cody_msg = {
                 'role': 'assistant',
                 'content': str(self.cody_msg)
-            })
-            self.conversation_extra.append(self.cody_msg_extra)
+            }
+            self.conversation.append(cody_msg, self.cody_msg_extra)
             self.cody_msg = None
             self.cody_msg_extra = {}
 
@@ -208,6 +335,8 @@ class Memory(BaseModel):
         :param id: int (Optional), for update existed actions only
         :return: bool, status
         """
+        self.version += 1  # preset changed, prompt caches outdated
+
         if action in self.actions:
             id = self.actions.index(action)
 
@@ -227,6 +356,8 @@ class Memory(BaseModel):
         :param action_text: str
         :return:
         """
+        self.version += 1  # preset changed, prompt caches outdated
+
         if id is not None:
             self.actions.pop(id)
 
@@ -240,6 +371,8 @@ class Memory(BaseModel):
         :param id: int (Optional), if not set, then return a generated extension id
         :return: int, id
         """
+        self.version += 1  # preset changed, prompt caches outdated
+
         if extension_text in self.extensions:
             id = self.extensions.index(extension_text)
 
@@ -259,6 +392,8 @@ class Memory(BaseModel):
         :param extension_text: str
         :return:
         """
+        self.version += 1  # preset changed, prompt caches outdated
+
         if id is not None:
             self.extensions.pop(id)
 
@@ -272,6 +407,8 @@ class Memory(BaseModel):
         :param id: int, start index of examples
         :return: int, id
         """
+        self.version += 1  # preset changed, prompt caches outdated
+
         if examples in self.conversation_examples:
             id = self.conversation_examples.index(examples)
 
@@ -291,6 +428,8 @@ class Memory(BaseModel):
         :param examples: str
         :return:
         """
+        self.version += 1  # preset changed, prompt caches outdated
+
         if id is not None:
             self.conversation_examples.pop(id)
 
@@ -303,6 +442,8 @@ class Memory(BaseModel):
         :param basic: str
         :return:
         """
+        self.version += 1  # preset changed, prompt caches outdated
+
         self.basic = basic
 
     def clear_conversation(self):
@@ -310,29 +451,81 @@ class Memory(BaseModel):
         clear conversation in temporary memory, will not affect impressions
         :return:
         """
-        self.conversation = []
-        self.conversation_extra = []
+        self.conversation.clear()
 
     def to_json(self) -> dict:
         """
         return a dict object that can be directly parse by Preset
         :return: dict
         """
+        conversation, conversation_extra = self.conversation.to_json()
+        conversation_extra = [self.dump_extra(ele) for ele in conversation_extra]
         res = {
             "basic": self.basic,
             "actions": self.actions,
             "extensions": self.extensions,
             "conversation_examples": self.conversation_examples,
             "status_messages": self.status_messages,
-            "conversation": self.conversation,
-            "conversation_extra": self.conversation_extra,
+            "conversation": conversation,
+            "conversation_extra": conversation_extra,
             "max_token_limit": self.max_token_limit,
             "used_token_score": self.used_token_score
         }
         return res
 
-    def add_user_message(self, msg: str, username: str, user_id: int, alternative_name: list = None,
-                         timestamp: TimeStamp = None, extra_msg_info: dict = None):
+    def start_journal(self):
+        """
+        start recording operations on conversation and status messages to a new journal, operations recorded
+        before are dropped. call it right after memory is checkpointed
+        :return:
+        """
+        self.journal = []
+        self.conversation.journal = self.journal
+        self.status_messages.journal = self.journal
+
+    def dump_journal(self) -> list:
+        """
+        return json serializable copy of operations in journal
+        :return: list
+        """
+        ret = []
+        for ele in self.journal:
+            if ele[0] in ("append", "appendleft"):
+                ele = (ele[0], ele[1], self.dump_extra(ele[2]), ele[3])
+            ret.append(ele)
+
+        return ret
+
+    def truncate_journal(self, count: int):
+        """
+        remove the first operations that have been saved from journal
+        :param count: int, count of operations saved
+        :return:
+        """
+        del self.journal[:count]
+
+    def replay_journal(self, operations: list):
+        """
+        apply saved operations to memory, used to recover memory from checkpoint
+        :param operations: list, operations returned by dump_journal
+        :return:
+        """
+        for ele in operations:
+            operation, args = ele[0], ele[1:]
+            if operation == "status_set":
+                self.status_messages[args[0]] = args[1]
+            elif operation == "status_del":
+                self.status_messages.pop(args[0], None)
+            elif operation == "status_reset":
+                self.status_messages.clear()
+                self.status_messages.update(args[0])
+            else:
+                if operation in ("append", "appendleft"):
+                    args = (args[0], self.parse_extra(args[1]), args[2])
+                self.conversation.replay(operation, *args)
+
+    async def add_user_message(self, msg: str, username: str, user_id: int, alternative_name: list = None,
+                               timestamp: TimeStamp = None, extra_msg_info: dict = None):
         """
         add a new user message for conversation, but it will not be stored to "self.conversations"
         until next call or calling add_cody_message
@@ -355,57 +548,40 @@ class Memory(BaseModel):
         # log
         self.__log("new user input: {}".format(msg))
 
-        failed = True
-        while failed:
-            failed = False  # reset retry flag
-            self.user_msg = msg  # form new user message to temp
-            self.user_msg_info = {
-                "message time": timestamp,
-                "user ID": user_id,
-                "name": username,
-                "alternative names": alternative_name,
-            }  # form new user message description to temp
-            self.user_msg_info.update(extra_msg_info)  # update extra message info to temp
-
-            # form new extra information for user_msg
-            self.user_msg_extra = {
-                "type": ExtraTypes.user_msg,
-                "user_id": user_id,
-                "username": username,
-                "timestamp": timestamp
-            }
-            # form new extra information for user_msg_info
-            self.user_msg_info_extra = {
-                "type": ExtraTypes.user_msg_info,
-                "user_id": user_id,
-                "timestamp": timestamp
-            }
-
-            for func in self.user_msg_post_proc:
-                # run additional function related to user message post-processing
-                func()
-
-            encoder = tiktoken.encoding_for_model("gpt-3.5-turbo")  # initialize encoder
-
-            # calculate token size of user_msg and user_msg_info
-            user_msg_score = len(encoder.encode(json.dumps(self.user_msg_info)))
-            user_msg_score += len(encoder.encode(self.user_msg))
+        self.user_msg = msg  # form new user message to temp
+        self.user_msg_info = {
+            "message time": str(timestamp),
+            "user ID": user_id,
+            "name": username,
+            "alternative names": alternative_name,
+        }  # form new user message description to temp
+        self.user_msg_info.update(extra_msg_info)  # update extra message info to temp
+
+        # form new extra information for user_msg
+        self.user_msg_extra = {
+            "type": ExtraTypes.user_msg,
+            "user_id": user_id,
+            "username": username,
+            "timestamp": timestamp
+        }
+        # form new extra information for user_msg_info
+        self.user_msg_info_extra = {
+            "type": ExtraTypes.user_msg_info,
+            "user_id": user_id,
+            "timestamp": timestamp
+        }
 
-            if self.used_token_score + user_msg_score >= self.max_token_limit:
-                # if current token usage is going exceed, forget the oldest conversation segment
-                del self.conversation[0]
-                del self.conversation_extra[0]
-                failed = True
-                # log info
-                self.__log("conversation token usage score exceeded max limit of {}, forcing to forget "
-                           "the oldest conversation, current message segment count: {}".format(self.max_token_limit,
-                                                                                               len(self.conversation)
-                                                                                               ))
+        for func in self.user_msg_post_proc:
+            # run additional function related to user message post-processing
+            await func()
 
         # write message segment to conservation
         self.__save_and_clear_temp_msg()
 
-    def add_cody_message(self, msg: GPTResponse):
+        # forget the oldest conversation turns until current token usage fits in limit
+        self.fit()
+
+    async def add_cody_message(self, msg: GPTResponse):
         """
         add and process Cody's message from a GPTResponse.
         :param msg: GPTResponse
@@ -413,22 +589,23 @@ class Memory(BaseModel):
         """
         self.cody_msg = msg  # copy message to temp
 
-        # get last user_msg index(inverted)
-        last_user_msg_index = -1
-        for ele in self.conversation_extra[::-1]:
-            if ele["type"] == ExtraTypes.user_msg:
-                break
-            last_user_msg_index -= 1
+        # get last user_msg
+        last_user_msg = self.conversation.last(ExtraTypes.user_msg)
+        if last_user_msg is None:
+            # Cody talks without user message, e.g. reached by other session
+            last_user_msg_extra = {"user_id": None, "timestamp": TimeStamp(time.time())}
+        else:
+            last_user_msg_extra = last_user_msg.extra
 
         self.cody_msg_extra = {
             "type": ExtraTypes.cody_msg,
-            "user_id": self.conversation_extra[last_user_msg_index]["user_id"],
-            "timestamp": self.conversation_extra[last_user_msg_index]["timestamp"]
+            "user_id": last_user_msg_extra["user_id"],
+            "timestamp": last_user_msg_extra["timestamp"]
         }
 
         for func in self.cody_msg_post_proc:
             # run additional functions that related to cody message's post-processing
-            func()
+            await func()
 
         # log info
         self.__log("Cody feed back (raw): {}".format(msg))
@@ -438,32 +615,210 @@ class Memory(BaseModel):
         self.__save_and_clear_temp_msg()
 
         # record token usage
-        self.used_token_score = msg.usage.total_tokens
+        self.used_token_score = self.get_prompt_tokens()
+
+    def __form_static_prefix(self) -> tuple:
+        """
+        return frozen messages of basic preset, actions, extensions and conversation examples
+        :return: tuple
+        """
+        if self.static_prefix_version != self.version:
+            # rebuild only after preset modified
+            conversation_examples = []
+            for ele in self.conversation_examples:
+                conversation_examples.extend(ele)
+
+            self.static_prefix = (
+                {"role": "system", "content": "{}\n"
+                                              "You will include your feelings and actions of "
+                                              "{} in JSON text format at the head of your message.\n"
+                                              "{}".format(self.basic, ", ".join(self.actions),
+                                                          " ".join(self.extensions))},
+                {"role": "system", "content": "***conversations of demonstration starts***"},
+                *conversation_examples,
+                {"role": "system", "content": "***Conversations of demonstration ends***"}
+            )
+            self.static_prefix_tokens = sum(count_message_tokens(ele) for ele in self.static_prefix)
+            self.static_prefix_version = self.version
+
+        return self.static_prefix
+
+    def __form_status_prefix(self) -> tuple:
+        """
+        return frozen messages of status and the head of real conversations
+        :return: tuple
+        """
+        if self.status_prefix_version != self.status_messages.version:
+            # rebuild only after status messages modified
+            self.status_prefix = (
+                *[
+                    {"role": "system", "content": ele}
+                    for ele in list(self.status_messages.values())
+                ],
+                {"role": "system", "content": "***real conversations starts***"}
+            )
+
+            # drop caches of removed status messages
+            for key in [ele for ele in self.status_message_tokens if ele not in self.status_messages]:
+                self.status_message_tokens.pop(key)
+
+            tokens = count_message_tokens(self.status_prefix[-1])
+            for key, text in self.status_messages.items():
+                cache = self.status_message_tokens.get(key)
+                if cache is None or cache[0] != text:
+                    # encode new or changed status message only
+                    cache = (text, count_message_tokens({"role": "system", "content": text}))
+                    self.status_message_tokens[key] = cache
+                tokens += cache[1]
+
+            self.status_prefix_tokens = tokens
+            self.status_prefix_version = self.status_messages.version
+
+        return self.status_prefix
+
+    def get_version(self) -> (int, int):
+        """
+        return version of prompt prefix, changes after any modification of preset or status messages
+        :return: (int preset_version, int status_messages_version)
+        """
+        return self.version, self.status_messages.version
+
+    def get_revision(self) -> (int, int, int):
+        """
+        return revision of whole memory, changes after any modification of preset, status messages or
+        conversation, used to detect unsaved changes
+        :return: (int preset_version, int status_messages_version, int conversation_revision)
+        """
+        return self.version, self.status_messages.version, self.conversation.revision
+
+    def get_prefix_tokens(self) -> int:
+        """
+        return token count of all messages ahead of conversation, only changed parts will be re-encoded
+        :return: int
+        """
+        self.__form_static_prefix()
+        self.__form_status_prefix()
+
+        return self.static_prefix_tokens + self.status_prefix_tokens
+
+    def get_prefix(self) -> tuple:
+        """
+        return frozen messages ahead of conversation, rebuilt only when version changed
+        :return: tuple
+        """
+        return self.__form_static_prefix() + self.__form_status_prefix()
+
+    def get_prompt_tokens(self) -> int:
+        """
+        return exact token count of prompts generated by to_list, including the reply primer of chat API
+        :return: int
+        """
+        return self.get_prefix_tokens() + self.conversation.tokens + REPLY_PRIMER_TOKENS
+
+    def fit(self, reserve_tokens: int = 0) -> list:
+        """
+        forget the oldest conversation turns as a whole until prompts and reserved completion tokens fit in
+        max token limit, the latest turn is always kept
+        :param reserve_tokens: int, tokens reserved for completion
+        :return: list of ConversationRecord, forgotten records
+        """
+        budget = self.max_token_limit - reserve_tokens - self.get_prefix_tokens() - REPLY_PRIMER_TOKENS
+        forgotten = self.conversation.evict_until(budget, min_turns=1)
+
+        if forgotten:
+            # log info
+            self.__log("conversation token usage exceeded max limit of {} (reserved {} for completion), forced "
+                       "to forget the oldest {} conversation segment(s) of {} turn(s), current message segment "
+                       "count: {}".format(self.max_token_limit, reserve_tokens, len(forgotten),
+                                          len({ele.turn for ele in forgotten}), len(self.conversation)))
+
+        self.used_token_score = self.get_prompt_tokens()
+        if self.used_token_score + reserve_tokens > self.max_token_limit:
+            self.__log("[WARNING] prompts cost {} tokens which still exceeds max limit of {} with {} reserved "
+                       "for completion".format(self.used_token_score, self.max_token_limit, reserve_tokens))
+
+        return forgotten
+
+    def build_prompt(self, reserve_tokens: int = 0) -> (list, int, list):
+        """
+        generate prompts for openai API that fit in max token limit with completion tokens reserved
+        :param reserve_tokens: int, tokens reserved for completion, usually max_tokens of API request
+        :return: (list prompts, int prompt_tokens, list forgotten ConversationRecord)
+        """
+        forgotten = self.fit(reserve_tokens)
+
+        return self.to_list(), self.used_token_score, forgotten
+
+    def get_compaction_records(self, turns: int) -> list:
+        """
+        return records of the oldest turns to be summarized, the latest turn will never be included
+        :param turns: int, max count of turns
+        :return: list of ConversationRecord, empty if there is nothing to compact
+        """
+        turns = min(turns, self.conversation.turns() - 1)
+        if turns < 1:
+            return []
+
+        ret = self.conversation.head_turns(turns)
+        if len(ret) == 1 and ret[0].extra.get("sub_type") == "summary":
+            # the only record is a summary already
+            return []
+
+        return ret
+
+    @staticmethod
+    def form_transcript(records: list) -> str:
+        """
+        convert conversation records to plain text transcript
+        :param records: list of ConversationRecord
+        :return: str
+        """
+        lines = []
+        for ele in records:
+            if ele.type == ExtraTypes.user_msg:
+                lines.append(f"{ele.extra.get('username', ele.message.get('name'))}: {ele.message['content']}")
+            elif ele.type == ExtraTypes.cody_msg:
+                purged = extract_json_and_purge_cody_response(GPTResponse(message=ele.message['content']))[1]
+                lines.append(f"Cody: {purged.message}")
+            elif ele.type == ExtraTypes.sys_msg:
+                if ele.extra.get("sub_type") == "summary":
+                    lines.append(f"({ele.message['content']})")
+                else:
+                    lines.append(f"(system) {ele.message['content']}")
+            # user_msg_info segments are omitted, names are already included above
+
+        return "\n".join(lines)
+
+    def compact(self, records: list, summary: str, timestamp: TimeStamp = None) -> int:
+        """
+        replace records at the head of conversation with a summary system message
+        :param records: list of ConversationRecord, records returned by get_compaction_records
+        :param summary: str, summary text of records
+        :param timestamp: TimeStamp (optional), timestamp of summary
+        :return: int, token count saved
+        """
+        if timestamp is None:
+            timestamp = TimeStamp(time.time())
+
+        tokens_before = self.conversation.tokens
+        self.conversation.compact(records,
+                                  {"role": "system", "content": f"summary of earlier conversation: {summary}"},
+                                  {"type": ExtraTypes.sys_msg, "sub_type": "summary", "timestamp": timestamp})
+        self.used_token_score = self.get_prompt_tokens()
+
+        ret = tokens_before - self.conversation.tokens
+        self.__log("compacted {} conversation segment(s) into a summary, saved {} token(s)".format(
+            len(records), ret))
+
+        return ret
 
     def to_list(self) -> list:
         """
-        generate conversation list that can be directly used by openai API
+        generate conversation list that can be directly used by openai API. the list is a shallow
+        concatenation of cached prefix and conversation messages, which must not be modified in place
         :return: list
         """
-        conversation_examples = []
-        for ele in self.conversation_examples:
-            conversation_examples.extend(ele)
-
-        ret = [
-            {"role": "system", "content": "{}\n"
-                                          "You will include your feelings and actions of "
-                                          "{} in JSON text format at the head of your message.\n"
-                                          "{}".format(self.basic, ", ".join(self.actions), " ".join(self.extensions))},
-            {"role": "system", "content": "***conversations of demonstration starts***"},
-            *conversation_examples,
-            {"role": "system", "content": "***Conversations of demonstration ends***"},
-            *[
-                {"role": "system", "content": ele}
-                for ele in list(self.status_messages.values())
-            ],
-            {"role": "system", "content": "***real conversations starts***"},
-            *self.conversation
-        ]
+        ret = [*self.get_prefix(), *self.conversation.messages()]
 
         return ret
 
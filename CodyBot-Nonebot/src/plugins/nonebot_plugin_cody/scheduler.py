@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: i2cy(i2cy@outlook.com)
+# Project: CodyBot2
+# Filename: scheduler
+# Created on: 2023/7/8
+
+import json
+import time
+import heapq
+import asyncio
+import itertools
+from typing import Callable, Union
+from pydantic import BaseModel
+from nonebot.log import logger
+
+
+class Alarm(BaseModel):
+    is_group: bool  # kind of session that registered this alarm
+    id: int  # QQ ID of user or group
+    alarm_id: str  # unique ID of alarm in its session
+    addon: str  # addon_name of addon whose alarm_callback will be called
+    timestamp: float  # fire time
+    args: list = []  # arguments of alarm_callback
+    seq: int = 0  # sequence number of its entry in scheduler heap
+
+    @property
+    def key(self) -> str:
+        return alarm_key(self.is_group, self.id, self.alarm_id)
+
+
+def alarm_key(is_group: bool, id: int, alarm_id: str) -> str:
+    """
+    return global unique key of an alarm
+    :param is_group: bool
+    :param id: int, QQ ID of user or group
+    :param alarm_id: str, unique ID of alarm in its session
+    :return: str
+    """
+    return f"{'group' if is_group else 'user'}_{int(id)}:{alarm_id}"
+
+
+class AlarmScheduler:
+
+    def __init__(self):
+        """
+        one scheduler for alarms of all sessions on event loop. alarms are kept in a heap keyed by fire time,
+        and a single task sleeps until the earliest one, so that idle sessions cost no threads or wakeups.
+        alarms are saved in session store and restored on start
+        """
+        self.store = None
+        self.resolver: Callable = None
+
+        self.__heap = []  # entries of (float timestamp, int seq, str key), cancelled entries are skipped lazily
+        self.__alarms = {}  # pending alarms, format: {key: Alarm}
+        self.__seq = itertools.count()
+        self.__wakeup: asyncio.Event = None  # set when an earlier alarm is added, created on start
+        self.__task: asyncio.Task = None
+        self.__callbacks = set()  # running alarm callback tasks
+
+    def __len__(self) -> int:
+        return len(self.__alarms)
+
+    def add(self, is_group: bool, id: int, alarm_id: str, timestamp: float, addon: str,
+            args: Union[list, tuple] = ()) -> Alarm:
+        """
+        register an alarm, or reschedule it if alarm ID already exists in session
+        :param is_group: bool
+        :param id: int, QQ ID of user or group
+        :param alarm_id: str, unique ID of alarm in its session
+        :param timestamp: float, fire time
+        :param addon: str, addon_name of addon whose alarm_callback will be called
+        :param args: list or tuple, json serializable arguments of alarm_callback
+        :return: Alarm
+        """
+        alarm = Alarm(is_group=is_group, id=int(id), alarm_id=str(alarm_id), addon=addon,
+                      timestamp=float(timestamp), args=list(args), seq=next(self.__seq))
+        self.__push(alarm)
+        self.__save(alarm)
+
+        return alarm
+
+    def cancel(self, is_group: bool, id: int, alarm_id: str) -> bool:
+        """
+        remove a registered alarm
+        :param is_group: bool
+        :param id: int, QQ ID of user or group
+        :param alarm_id: str, unique ID of alarm in its session
+        :return: bool, False if alarm not found
+        """
+        key = alarm_key(is_group, id, alarm_id)
+        if self.__alarms.pop(key, None) is None:
+            return False
+
+        if self.store is not None:
+            self.store.remove_alarm(key)
+        if len(self.__heap) > 2 * len(self.__alarms) + 64:
+            # drop cancelled entries when they take most of the heap
+            self.__heap = [ele for ele in self.__heap
+                           if ele[2] in self.__alarms and self.__alarms[ele[2]].seq == ele[1]]
+            heapq.heapify(self.__heap)
+
+        return True
+
+    def list_alarms(self, is_group: bool, id: int) -> list:
+        """
+        return pending alarms of a session in order of fire time
+        :param is_group: bool
+        :param id: int, QQ ID of user or group
+        :return: list of Alarm
+        """
+        ret = [ele for ele in self.__alarms.values() if ele.is_group == is_group and ele.id == int(id)]
+        ret.sort(key=lambda ele: ele.timestamp)
+
+        return ret
+
+    def __save(self, alarm: Alarm):
+        """
+        save an alarm to session store if scheduler is started
+        :param alarm: Alarm
+        :return:
+        """
+        if self.store is not None:
+            self.store.put_alarm(alarm.key, alarm.is_group, alarm.id, alarm.timestamp,
+                                 json.dumps(alarm.dict(exclude={"seq"})))
+
+    def __push(self, alarm: Alarm):
+        """
+        put an alarm into heap, wake up scheduler task if it is the earliest one
+        :param alarm: Alarm
+        :return:
+        """
+        self.__alarms[alarm.key] = alarm
+        heapq.heappush(self.__heap, (alarm.timestamp, alarm.seq, alarm.key))
+        if self.__wakeup is not None and self.__heap[0][1] == alarm.seq:
+            self.__wakeup.set()
+
+    def __fire(self, alarm: Alarm):
+        """
+        call alarm_callback of addon in session of alarm, coroutines are started as tasks
+        :param alarm: Alarm
+        :return:
+        """
+        logger.debug(f"[alarm scheduler] alarm triggered of ID {alarm.key}")
+        try:
+            session = self.resolver(alarm.is_group, alarm.id)
+            for addon in session.addons:
+                if addon.addon_name == alarm.addon:
+                    ret = addon.alarm_callback(*alarm.args)
+                    if asyncio.iscoroutine(ret):
+                        task = asyncio.create_task(ret)
+                        self.__callbacks.add(task)
+                        task.add_done_callback(self.__callbacks.discard)
+                    break
+            else:
+                logger.warning(f"[alarm scheduler] addon \"{alarm.addon}\" of alarm {alarm.key} not found")
+        except Exception as err:
+            logger.error(f"[alarm scheduler] error while executing alarm {alarm.key}, {err}")
+
+    async def __loop(self):
+        while True:
+            self.__wakeup.clear()
+            now = time.time()
+            while self.__heap and self.__heap[0][0] <= now:
+                timestamp, seq, key = heapq.heappop(self.__heap)
+                alarm = self.__alarms.get(key)
+                if alarm is None or alarm.seq != seq:
+                    # cancelled or rescheduled
+                    continue
+                self.__alarms.pop(key)
+                if self.store is not None:
+                    self.store.remove_alarm(key)
+                self.__fire(alarm)
+
+            # sleep until the earliest alarm, or until an earlier one is added
+            timeout = self.__heap[0][0] - now if self.__heap else None
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, store, resolver: Callable):
+        """
+        restore saved alarms and start scheduler task, overdue alarms fire immediately
+        :param store: SessionStore, storage of alarms
+        :param resolver: Function(bool is_group, int id) -> SessionGPT35, get session of alarm
+        :return:
+        """
+        self.store = store
+        self.resolver = resolver
+        self.__wakeup = asyncio.Event()
+
+        # alarms registered before start are newer than saved ones
+        registered = list(self.__alarms.values())
+        for ele in self.store.list_alarms():
+            alarm = Alarm.parse_raw(ele)
+            alarm.seq = next(self.__seq)
+            self.__push(alarm)
+        if self.__alarms:
+            logger.info(f"[alarm scheduler] restored {len(self.__alarms)} alarm(s)")
+        for alarm in registered:
+            alarm.seq = next(self.__seq)
+            self.__push(alarm)
+            self.__save(alarm)
+
+        if self.__task is None or self.__task.done():
+            self.__task = asyncio.create_task(self.__loop())
+
+    async def stop(self):
+        """
+        stop scheduler task, pending alarms stay in session store
+        :return:
+        """
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+
+ALARM_SCHEDULER = AlarmScheduler()
@@ -7,21 +7,43 @@
 
 import asyncio
 import base64
-import threading
+import struct
 import time
+import zlib
+from collections import deque
 from hashlib import sha256
+from pydantic import BaseModel, Field
 from nonebot.adapters.onebot import V11Bot as Bot
 from .config import *
 from .builtin_basic_presets import BUILTIN_PRIVATE_PRESET, BUILTIN_GROUP_PRESET
-from .api import get_chat_response, CODY_HEADER, ANONYMOUS_HUMAN_HEADER
+from .api import request_chat_response, request_chat_response_stream, estimate_usage, purge_cody_header, \
+    CODY_HEADER, ANONYMOUS_HUMAN_HEADER
+from .keypool import RequestPriority
+from .utils import GPTResponse, TimeStamp, SentenceSplitter, CREATOR_ID, CREATOR_GF_ID, \
+    extract_json_and_purge_cody_response
 from .userdata import Impression, ImpressionFrame
-from .memory import Memory
+from .memory import Memory, PRESET_FIELDS
+from .scheduler import ALARM_SCHEDULER
 
 API_INDEX = -1
-INVALID_APIs = []
+
+SESSION_MAGIC = b"CODY"  # header of binary session data
+SESSION_FORMAT_VERSION = 1
+SECTION_HEADER = struct.Struct(">cI")  # section tag and payload length
+SECTION_PRESET_REF = b"P"  # sha256 digest of preset stored in preset table
+SECTION_PRESET = b"I"  # compressed inline preset json
+SECTION_STATE = b"S"  # compressed json of status messages and conversation
 PUNCTUATION_SETS = {"。", "！", "？", ".", "!", "?", ";", "；", "……", "~", "~"}
 
 
+class InboundMessage(BaseModel):
+    msg: str  # message text
+    user_id: int = None  # QQ ID of sender
+    user_name: str = None  # name of sender, used only when sender is unknown in impression database
+    reply_to: int = None  # message ID to quote in reply
+    timestamp: float = Field(default_factory=time.time)  # receive time
+
+
 # TODO: 移除旧版本GPT3的会话对象
 # class SessionGPT3:
 #     def __init__(self, id, is_group=False, username=None, addons=None):
@@ -381,33 +403,54 @@ class SessionGPT35:
         self.impression = impression_db
         self.bot: Bot = bot
 
-        # threading
         self.live = True
-        self.threads = []
+        self.compaction_task: asyncio.Task = None  # background task summarizing the oldest turns
+        self.turn_priority: int = None  # RequestPriority of the turn being processed, None if idle
 
-        # flags
-        self.is_busy: bool = False
+        # lock held while conversation of this session is being processed
+        self.lock = asyncio.Lock()
 
-        # storage ables
+        # inbound messages waiting to be sent in next turn
+        self.inbox = deque()
+        self.inbox_owner = False  # whether if a coroutine is processing inbox
 
-        # registered alarms, (format: [timestamp, string to execute])
-        # executive must set ADDON_NAME of addon to call and ALARM_ARGS
-        # of its alarm_callback method e.g.:
-        #
-        # # this is the test addons registered
-        # class TestAddon(AddonBase):
-        #     addon_name: str = "test_addon"
-        #     def alarm_callback(group_id, message):
-        #         self.session.bot.send_group_message(group_id, message)
-        # # this is executive string example
-        # """
-        # ADDON_NAME = "test_addon"
-        # ALARM_ARGS = (1222333444, "this is a test")
-        # """
-        self.registered_alarms = []
+        # storage ables
 
         # initialize a new conversation memory object
         self.conversation = Memory()
+        self.__setup_memory()
+
+        self.last_active = time.time()  # timestamp of last access, used by session manager
+        self.__preset_pack = None  # cache of packed preset, format: (memory version, digest, data)
+
+    @property
+    def key(self) -> str:
+        """
+        return unique key of session, e.g. 'user_123456'
+        :return: str
+        """
+        return f"{'group' if self.is_group else 'user'}_{int(self.id)}"
+
+    def request_priority(self, messages: list = None) -> int:
+        """
+        return priority of reply requests, private chats and messages from admin are interactive
+        :param messages: list of InboundMessage (optional), messages to reply
+        :return: int, RequestPriority
+        """
+        if not self.is_group:
+            return RequestPriority.interactive
+
+        for ele in messages or []:
+            if ele.user_id is not None and sha256(str(ele.user_id).encode()).hexdigest() == CREATOR_ID:
+                return RequestPriority.interactive
+
+        return RequestPriority.group
+
+    def __setup_memory(self):
+        """
+        bind conversation memory to this session
+        :return:
+        """
         # setup parents
         self.conversation.set_parent(self)
         # register logger
@@ -416,20 +459,93 @@ class SessionGPT35:
         self.conversation.user_msg_post_proc = [func.user_msg_post_proc_callback for func in self.addons]
         self.conversation.cody_msg_post_proc = [func.cody_msg_post_proc_callback for func in self.addons]
 
-    def busy_check(self, timeout=30) -> bool:
+    async def acquire(self, timeout: float = None) -> bool:
+        """
+        wait for the session lock without blocking event loop, must call release after acquired
+        :param timeout: float (optional), max seconds to wait, use cody_session_lock_timeout if not set
+        :return: bool, True if acquired, False if timeout
         """
-        block if session is currently busy, return True if timeout
+        if timeout is None:
+            timeout = CODY_CONFIG.cody_session_lock_timeout
+
+        # wait_for may leave lock acquired when timeout lands right as acquire completes (before python 3.12),
+        # so acquire in a task and check its result after timeout or cancellation
+        acquiring = asyncio.ensure_future(self.lock.acquire())
+        try:
+            await asyncio.wait_for(asyncio.shield(acquiring), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as err:
+            if acquiring.done() and not acquiring.cancelled():
+                # acquired right before timeout or cancellation
+                if isinstance(err, asyncio.CancelledError):
+                    self.lock.release()
+                    raise
+                return True
+            acquiring.cancel()
+            if isinstance(err, asyncio.CancelledError):
+                raise
+            self.log(f"[WARNING] session is still busy after {timeout} seconds, lock not acquired")
+            return False
+
+        return True
+
+    def release(self):
+        """
+        release the session lock
+        :return:
+        """
+        self.lock.release()
+
+    def enqueue(self, message: InboundMessage) -> bool:
+        """
+        put an inbound message into inbox, return True if caller becomes the owner of inbox and must process it
+        with take_batch until empty, otherwise the message will be answered by current owner in a combined turn
+        :param message: InboundMessage
         :return: bool
         """
-        ts = time.time()  # record start timestamp
+        self.inbox.append(message)
+        if self.inbox_owner:
+            return False
 
-        while self.is_busy:
-            time.sleep(0.02)
-            if time.time() - ts > timeout:
-                # break if timeout
-                break
+        self.inbox_owner = True
+        return True
+
+    async def take_batch(self) -> list:
+        """
+        take messages from inbox as one turn, wait up to cody_batch_window seconds since the first message
+        for more messages. ownership of inbox is released when returning an empty list
+        :return: list of InboundMessage
+        """
+        if not self.inbox:
+            self.inbox_owner = False
+            return []
 
-        return self.is_busy
+        # wait for more messages within batch window
+        deadline = self.inbox[0].timestamp + CODY_CONFIG.cody_batch_window
+        while len(self.inbox) < CODY_CONFIG.cody_batch_size and time.time() < deadline:
+            await asyncio.sleep(min(0.1, deadline - time.time()))
+
+        ret = []
+        while self.inbox and len(ret) < CODY_CONFIG.cody_batch_size:
+            ret.append(self.inbox.popleft())
+
+        if len(ret) > 1:
+            self.log(f"combined {len(ret)} messages in one turn")
+
+        return ret
+
+    def release_inbox(self):
+        """
+        give up ownership of inbox, messages left will be taken by the owner of next message
+        :return:
+        """
+        self.inbox_owner = False
+
+    def is_busy(self) -> bool:
+        """
+        return whether if the session is processing conversation
+        :return: bool
+        """
+        return self.lock.locked()
 
     def log(self, message: str):
         """
@@ -451,84 +567,176 @@ class SessionGPT35:
         """
         self.bot = bot
 
-    def dump(self, use_base64: bool = True) -> str:
+    def __pack_preset(self) -> (bytes, bytes):
         """
-        dump current session status to str
-        :param use_base64: bool, use base64 to encode data
-        :return: str
+        return compressed preset json and its sha256 digest, cached until preset modified
+        :return: (bytes digest, bytes data)
         """
+        version = self.conversation.version
+        if self.__preset_pack is None or self.__preset_pack[0] != version:
+            preset = {key: getattr(self.conversation, key) for key in PRESET_FIELDS}
+            data = json.dumps(preset, sort_keys=True, separators=(",", ":")).encode()
+            self.__preset_pack = (version, sha256(data).digest(), zlib.compress(data))
 
+        return self.__preset_pack[1], self.__preset_pack[2]
+
+    def dump(self, preset_table=None) -> bytes:
+        """
+        dump current session status to compact binary data:
+        magic(4) + version(1) + sections of [tag(1) + length(4, big endian) + payload]
+        preset is stored by reference in preset table if given, otherwise inline
+        :param preset_table: SessionStore (optional), object with has_preset and put_preset methods
+        :return: bytes
+        """
         memory_json = self.conversation.to_json()
-        save = {
-            'conversations': memory_json,
-            'alarms': self.registered_alarms
+        for key in PRESET_FIELDS:
+            memory_json.pop(key)
+        state = {
+            'conversations': memory_json
         }
-        save = json.dumps(save)
-        if use_base64:
-            ret = (b'_B64' + base64.b64encode(save)).decode()
+        state = zlib.compress(json.dumps(state, separators=(",", ":")).encode())
+
+        digest, preset = self.__pack_preset()
+        if preset_table is not None:
+            if not preset_table.has_preset(digest):
+                preset_table.put_preset(digest, preset)
+            preset_section = SECTION_HEADER.pack(SECTION_PRESET_REF, len(digest)) + digest
         else:
-            ret = save
+            preset_section = SECTION_HEADER.pack(SECTION_PRESET, len(preset)) + preset
+
+        ret = b"".join((
+            SESSION_MAGIC, bytes((SESSION_FORMAT_VERSION,)),
+            preset_section,
+            SECTION_HEADER.pack(SECTION_STATE, len(state)), state
+        ))
 
         return ret
 
-    def load(self, status_str: str):
+    @staticmethod
+    def unpack(data: bytes, preset_table=None) -> dict:
         """
-        load current session status from previous saved status string
-        :param status_str: str
-        :return:
+        decode binary session data
+        :param data: bytes
+        :param preset_table: SessionStore (optional), object with get_preset method
+        :return: dict, session status in json
+        """
+        version = data[len(SESSION_MAGIC)]
+        if version != SESSION_FORMAT_VERSION:
+            raise ValueError(f"unsupported session format version {version}")
+
+        status = {}
+        preset = {}
+        offset = len(SESSION_MAGIC) + 1
+        while offset < len(data):
+            tag, length = SECTION_HEADER.unpack_from(data, offset)
+            offset += SECTION_HEADER.size
+            payload = data[offset:offset + length]
+            offset += length
+
+            if tag == SECTION_PRESET_REF:
+                if preset_table is None:
+                    raise ValueError("preset table is required to load session data with preset reference")
+                payload = preset_table.get_preset(payload)
+                if payload is None:
+                    raise ValueError("preset referenced by session data not found")
+                preset = json.loads(zlib.decompress(payload))
+            elif tag == SECTION_PRESET:
+                preset = json.loads(zlib.decompress(payload))
+            elif tag == SECTION_STATE:
+                status = json.loads(zlib.decompress(payload))
+            # unknown sections are skipped for forward compatibility
+
+        status['conversations'].update(preset)
+
+        return status
+
+    def dump_journal(self) -> (bytes, int):
+        """
+        dump operations recorded in memory journal since last save, which is much smaller than a full dump
+        :return: (bytes data, int count of operations)
         """
-        if len(status_str) > 4 and status_str[:4] == '_B64':
-            status_str = status_str[4:]
-            status_str = base64.b64decode(status_str).decode()
+        operations = self.conversation.dump_journal()
+        ret = json.dumps(operations, ensure_ascii=False, separators=(",", ":")).encode()
 
-        status = json.loads(status_str)
-        self.conversation.parse_obj(status['conversations'])
-        self.registered_alarms = status['alarms']
-        self.log(f"loaded {len(self.conversation.conversation)} conversations and {len(self.registered_alarms)} "
-                 f"registered alarms from previously saved session")
+        return ret, len(operations)
 
-    def alarm_trigger_thread(self):
+    def load_journal(self, entries: list):
         """
-        timed event sub thread
+        replay journal entries on loaded session
+        :param entries: list of bytes, data returned by dump_journal in order
         :return:
         """
-        # TODO: 重新构建此定时事件处理线程循环
-
-        logger.info("[session {}] sub thread started".format(self.session_id))
-        cnt = 0
-        while self.live:
-            if cnt >= 10:
-                try:
-                    cnt = 0
-                    ts_now = time.time()
-                    triggered_alarms = []
-                    for ele in self.registered_alarms.keys():
-                        if ts_now > self.registered_alarms[ele][0]:
-                            logger.debug("[session {}] alarm triggered of ID {}".format(self.session_id, ele))
-                            async_object = self.registered_alarms[ele][1](*self.registered_alarms[ele][2])
-                            asyncio.run(async_object)
-                            triggered_alarms.append(ele)
-
-                    for ele in triggered_alarms:
-                        self.registered_alarms.pop(ele)
-                except Exception as err:
-                    logger.error(f"[session {self.session_id}] error while executing alarm, {err}")
-            else:
-                cnt += 1
-                time.sleep(0.1)
-        logger.info(f"[session {self.session_id}] alarm thread stopped")
+        for ele in entries:
+            self.conversation.replay_journal(json.loads(ele))
+        if entries:
+            self.log(f"replayed {len(entries)} journal entries on previously saved session")
+
+    def load(self, data: bytes, preset_table=None):
+        """
+        load current session status from previous saved data, text data of old versions are supported
+        :param data: bytes or str
+        :param preset_table: SessionStore (optional), object with get_preset method
+        :return:
+        """
+        if isinstance(data, bytes) and data[:len(SESSION_MAGIC)] == SESSION_MAGIC:
+            status = self.unpack(data, preset_table)
+        else:
+            # base64 wrapped json or plain json of old versions
+            if isinstance(data, bytes):
+                data = data.decode()
+            if len(data) > 4 and data[:4] == '_B64':
+                data = base64.b64decode(data[4:]).decode()
+            status = json.loads(data)
+
+        self.conversation = Memory.parse_obj(status['conversations'])
+        self.__setup_memory()
+        self.log(f"loaded {len(self.conversation.conversation)} conversations from previously saved session")
+
+    def register_alarm(self, alarm_id: str, timestamp: float, addon_name: str, args: tuple = ()):
+        """
+        register an alarm in global alarm scheduler, alarm_callback of addon with addon_name will be called
+        with args at timestamp, e.g.:
+
+        # this is the test addons registered
+        class TestAddon(AddonBase):
+            addon_name: str = "test_addon"
+            def alarm_callback(group_id, message):
+                return self.session.bot.send_group_msg(group_id=group_id, message=message)
+        # register alarm in session
+        session.register_alarm("test", time.time() + 60, "test_addon", (1222333444, "this is a test"))
+
+        :param alarm_id: str, unique ID of alarm in this session, alarm with the same ID will be replaced
+        :param timestamp: float, fire time
+        :param addon_name: str
+        :param args: tuple, json serializable arguments of alarm_callback
+        :return:
+        """
+        ALARM_SCHEDULER.add(self.is_group, self.id, alarm_id, timestamp, addon_name, args)
+
+    def cancel_alarm(self, alarm_id: str) -> bool:
+        """
+        remove a registered alarm of this session
+        :param alarm_id: str
+        :return: bool, False if alarm not found
+        """
+        return ALARM_SCHEDULER.cancel(self.is_group, self.id, alarm_id)
+
+    def list_alarms(self) -> list:
+        """
+        return pending alarms of this session in order of fire time
+        :return: list of Alarm
+        """
+        return ALARM_SCHEDULER.list_alarms(self.is_group, self.id)
 
     def __del__(self):
         self.kill()
 
     def kill(self):
         """
-        kill current session, which will make sub threads stop
+        kill current session, registered alarms are kept in alarm scheduler
         :return:
         """
         self.live = False
-        [ele.join() for ele in self.threads]
-        self.threads.clear()
 
     def reset(self):
         """
@@ -537,66 +745,185 @@ class SessionGPT35:
         """
         # TODO: 完成会话reset方法
 
-    async def get_chat_response(self, msg,
-                                user_id: int = None,
-                                user_name: str = None,
-                                group_id: int = None) -> str:
-        # check thread safety
-        self.busy_check()
-        self.is_busy = True
+    async def request_chat_response(self, prompts: list, **kwargs) -> (GPTResponse, bool):
+        """
+        request a response from openai with API keys scheduled by key pool
+        :param prompts: list, list of dict messages for gpt-3.5
+        :param kwargs: Any, additional arguments of request_chat_response, priority of current turn or session
+                       is used if priority is not given, so that requests made inside a turn never wait behind
+                       lower classes
+        :return: (GPTResponse, status: bool)
+        """
+        kwargs.setdefault("priority", self.request_priority() if self.turn_priority is None else self.turn_priority)
+        kwargs.setdefault("session_key", self.key)
+        feedback, status = await request_chat_response(prompts, **kwargs)
+        if not status:
+            self.log(f"[ERROR] failed to get response from openai, {feedback}")
+
+        return feedback, status
+
+    def schedule_compaction(self):
+        """
+        start a background task to summarize the oldest turns if prompts exceeded high-water mark of token
+        budget, return immediately without waiting for it
+        :return:
+        """
+        if self.compaction_task is not None and not self.compaction_task.done():
+            # one compaction at a time
+            return
 
-        # TODO: 重新构建此GPT反馈获取函数
+        budget = self.conversation.max_token_limit - CODY_CONFIG.cody_gpt3_max_tokens
+        if self.conversation.used_token_score <= budget * CODY_CONFIG.cody_summary_high_water:
+            return
 
+        self.compaction_task = asyncio.create_task(self.compact_conversation())
+
+    async def compact_conversation(self) -> bool:
+        """
+        summarize the oldest turns of conversation into one system message segment
+        :return: bool, status
+        """
+        records = self.conversation.get_compaction_records(CODY_CONFIG.cody_summary_turns)
+        if not records:
+            return False
+        revision = self.conversation.conversation.revision
+
+        prompts = [
+            {'role': 'system',
+             'content': "You are Cody. Summarize the following conversation in third person concisely, keep names, "
+                        "facts, promises and unfinished topics, return summary text only."},
+            {'role': 'user',
+             'content': self.conversation.form_transcript(records)}
+        ]
+
+        try:
+            feedback, status = await self.request_chat_response(prompts, temperature=0.2, frequency_p=0.0,
+                                                                priority=RequestPriority.background)
+        except Exception as err:
+            self.log(f"[ERROR] failed to summarize conversation, {err}")
+            return False
+
+        if not status or not feedback.message.strip():
+            return False
+
+        # apply with session locked, so that a turn in flight can not change conversation halfway
+        if not await self.acquire():
+            return False
+
+        try:
+            if self.conversation.conversation.revision != revision:
+                # changed while waiting, the summary is still valid if summarized records are the head as before
+                head = self.conversation.get_compaction_records(CODY_CONFIG.cody_summary_turns)
+                if [id(ele) for ele in head] != [id(ele) for ele in records]:
+                    self.log("conversation changed while summarizing, compaction skipped")
+                    return False
+
+            # replace the summarized records
+            self.conversation.compact(records, feedback.message.strip())
+
+        finally:
+            self.release()
+
+        return True
+
+    async def add_user_message(self, msg: str, user_id: int = None, user_name: str = None, timestamp: float = None):
+        """
+        add a user message with impression data to memory
+        :param msg: str, message text
+        :param user_id: int, QQ ID of sender
+        :param user_name: str, name of sender, used only when sender is unknown in impression database
+        :param timestamp: float (optional), receive time of message
+        :return:
+        """
         # get impression data
         frame = self.impression.get_individual(user_id)
+        username = frame.name
+        if user_name is not None and "UNKNOWN" in username.upper():
+            username = user_name
+
+        # add user message to memory
+        await self.conversation.add_user_message(msg, username=username, user_id=user_id,
+                                                 alternative_name=frame.alternatives,
+                                                 timestamp=TimeStamp(timestamp) if timestamp else None)
 
-        self.is_busy = False  # release busy flag
-
-        # OLD SCRIPTS
-        if user_id is not None or user_name is not None:
-            if user_id == CREATOR_ID:
-                user_name = "Icy"
-            elif user_id == CREATOR_GF_ID:
-                user_name = "Miuto"
-            elif user_name is not None:
-                upper = user_name.upper()
-                upper = upper.replace(" ", "")
-                if "ICY" in upper:
-                    user_name = user_name.upper().replace("ICY", "FakeTheBuster")
-                if "CCY" in upper:
-                    user_name = user_name.upper().replace("CCY", "FakeTheBuster")
-                if "吸吸歪" in upper:
-                    user_name = user_name.upper().replace("吸吸歪", "FakeTheBuster")
-                if "MIUTO" in upper:
-                    user_name = user_name.upper().replace("MIUTO", "FakeTheBuster")
-            if user_name is None:
-                if user_id not in self.users:
-                    self.users.update({user_id: len(self.users)})
-                user_session_id = self.users[user_id]
-                human_header = "\nHuman_{}: ".format(user_session_id)
+    async def get_chat_response(self, messages: list) -> str:
+        """
+        get Cody's response to user messages of one turn, conversation and impression data will be updated
+        :param messages: list of InboundMessage
+        :return: str, plain text of Cody's response, '……' if failed
+        """
+        # wait for other coroutines processing this session
+        if not await self.acquire():
+            return "……"
+
+        self.turn_priority = self.request_priority(messages)
+        try:
+            # add user messages to memory
+            for ele in messages:
+                await self.add_user_message(ele.msg, ele.user_id, ele.user_name, ele.timestamp)
+
+            # generate prompts that fit in token limit with completion tokens reserved
+            prompts, prompt_tokens, forgotten = self.conversation.build_prompt(CODY_CONFIG.cody_gpt3_max_tokens)
+
+            # get feedback from openai
+            feedback, status = await self.request_chat_response(prompts, prompt_tokens=prompt_tokens,
+                                                                priority=self.turn_priority)
+
+            if status:
+                # add feedback to memory
+                await self.conversation.add_cody_message(feedback)
+                self.schedule_compaction()
+                json_text, purged = extract_json_and_purge_cody_response(feedback)
+                ret = purged.message if purged.message else "……"
             else:
-                if user_id not in self.users:
-                    if user_id == CREATOR_ID:
-                        nickname = "Icy"
-                    elif user_id == CREATOR_GF_ID:
-                        nickname = "Miuto"
-                    else:
-                        # 生成昵称
-                        prompt = "Convert following name into one friendly nickname in short that must with the same " \
-                                 "language:\n{}\nreturn:".format(user_name)
-                        nickname, status, wm = await self.get_GPT3_feedback(prompt, stop_list=["->", "\n"],
-                                                                            temperature=0.0, frequency_p=0.2,
-                                                                            presence_p=0.0)
-                        # 检测昵称
-                        if not status or nickname == "":
-                            nickname = user_name
-                            if nickname == "":
-                                nickname = ANONYMOUS_HUMAN_HEADER
-                    self.users.update({user_id: nickname})
-                else:
-                    nickname = self.users[user_id]
-                human_header = "\n{}: ".format(nickname)
-        else:
-            human_header = ANONYMOUS_HUMAN_HEADER
+                ret = "……"
 
-        logger.debug("处理消息，发送人头部：{}".format(human_header))
+        finally:
+            self.turn_priority = None
+            self.release()
+
+        return ret
+
+    async def get_chat_response_stream(self, messages: list):
+        """
+        get Cody's response to user messages of one turn in stream mode, yield every completed sentence as soon
+        as it is ready. the leading JSON action text is held back and processed after the whole response arrived
+        :param messages: list of InboundMessage
+        :return: AsyncGenerator of str
+        """
+        # wait for other coroutines processing this session
+        if not await self.acquire():
+            return
+
+        self.turn_priority = self.request_priority(messages)
+        try:
+            # add user messages to memory
+            for ele in messages:
+                await self.add_user_message(ele.msg, ele.user_id, ele.user_name, ele.timestamp)
+            # generate prompts that fit in token limit with completion tokens reserved
+            prompts, prompt_tokens, forgotten = self.conversation.build_prompt(CODY_CONFIG.cody_gpt3_max_tokens)
+
+            # split deltas into sentences
+            splitter = SentenceSplitter(PUNCTUATION_SETS)
+            response_text = ""
+            async for delta in request_chat_response_stream(prompts, prompt_tokens=prompt_tokens,
+                                                            priority=self.turn_priority,
+                                                            session_key=self.key):
+                response_text += delta
+                for sentence in splitter.feed(delta):
+                    yield purge_cody_header(sentence)
+
+            for sentence in splitter.flush():
+                yield purge_cody_header(sentence)
+
+            # add feedback to memory
+            response_text = purge_cody_header(response_text.strip())
+            if response_text:
+                feedback = GPTResponse(message=response_text,
+                                       usage=estimate_usage(prompts, response_text, prompt_tokens))
+                await self.conversation.add_cody_message(feedback)
+                self.schedule_compaction()
+
+        finally:
+            self.turn_priority = None
+            self.release()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: i2cy(i2cy@outlook.com)
+# Project: CodyBot2
+# Filename: store
+# Created on: 2023/7/7
+
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Union
+from i2cylib.database.sqlite import SqliteDB, SqlDtype, Sqlimit, NewSqlTable
+
+
+class SessionStore(SqliteDB):
+
+    def __init__(self, database_path: str = "sessions.db"):
+        """
+        saved sessions in one sqlite table keyed by kind and ID of session, every session is stored as one blob
+        :param database_path: str, path of database file
+        """
+        super().__init__(database_path)
+        self.autocommit = True  # enable auto-commit
+        self.connect()
+        # write-ahead log lets the event loop read sessions while a batch is written in background thread
+        self.database.execute("PRAGMA journal_mode=WAL")
+        self.database.execute("PRAGMA synchronous=NORMAL")
+        self.database.execute("PRAGMA busy_timeout=5000")
+        self.__init_check()
+
+        self.__presets = {}  # cache of presets, format: {digest: data}
+        self.__writer: sqlite3.Connection = None  # connection of put_many, may be used from other threads
+        self.__write_lock = threading.Lock()
+
+    def __init_check(self):
+        """
+        check and initialize database, create table when initial start or table dose not exists
+        :return:
+        """
+        if "sessions" not in self:
+            new_table = NewSqlTable("sessions")
+            new_table.add_column('key', SqlDtype.TEXT)  # '<kind>_<ID>', e.g. 'user_123456'
+            new_table.add_column('is_group', SqlDtype.INTEGER)
+            new_table.add_column('id', SqlDtype.INTEGER)
+            new_table.add_column('data', SqlDtype.BLOB)
+            new_table.add_column('timestamp', SqlDtype.INTEGER)  # time of last save
+            new_table.add_limit(0, Sqlimit.PRIMARY_KEY)
+            new_table.add_limit(1, Sqlimit.NOT_NULL)
+            new_table.add_limit(2, Sqlimit.NOT_NULL)
+            new_table.add_limit(3, Sqlimit.NOT_NULL)
+            new_table.add_limit(4, Sqlimit.NOT_NULL)
+
+            self.create_table(new_table)
+
+        if "journal" not in self:
+            new_table = NewSqlTable("journal")
+            new_table.add_column('key', SqlDtype.TEXT)  # key of session that entry belongs to
+            new_table.add_column('data', SqlDtype.BLOB)  # operations since previous entry
+            new_table.add_limit(0, Sqlimit.NOT_NULL)
+            new_table.add_limit(1, Sqlimit.NOT_NULL)
+
+            self.create_table(new_table)
+            # entries are read by session key in order of rowid
+            self.database.execute("CREATE INDEX IF NOT EXISTS journal_key ON journal (key)")
+            self._auto_commit()
+
+        if "alarms" not in self:
+            new_table = NewSqlTable("alarms")
+            new_table.add_column('key', SqlDtype.TEXT)  # '<kind>_<ID>:<alarm ID>'
+            new_table.add_column('is_group', SqlDtype.INTEGER)
+            new_table.add_column('id', SqlDtype.INTEGER)
+            new_table.add_column('timestamp', SqlDtype.REAL)  # fire time
+            new_table.add_column('data', SqlDtype.TEXT)  # alarm in json
+            new_table.add_limit(0, Sqlimit.PRIMARY_KEY)
+            new_table.add_limit(1, Sqlimit.NOT_NULL)
+            new_table.add_limit(2, Sqlimit.NOT_NULL)
+            new_table.add_limit(3, Sqlimit.NOT_NULL)
+            new_table.add_limit(4, Sqlimit.NOT_NULL)
+
+            self.create_table(new_table)
+
+        if "presets" not in self:
+            new_table = NewSqlTable("presets")
+            new_table.add_column('digest', SqlDtype.BLOB)  # sha256 digest of data
+            new_table.add_column('data', SqlDtype.BLOB)  # compressed preset json
+            new_table.add_limit(0, Sqlimit.PRIMARY_KEY)
+            new_table.add_limit(1, Sqlimit.NOT_NULL)
+
+            self.create_table(new_table)
+
+    @staticmethod
+    def session_key(is_group: bool, id: int) -> str:
+        """
+        return primary key of a session
+        :param is_group: bool
+        :param id: int, QQ ID of user or group
+        :return: str
+        """
+        return f"{'group' if is_group else 'user'}_{int(id)}"
+
+    def get(self, is_group: bool, id: int) -> Union[bytes, None]:
+        """
+        get saved data of a session
+        :param is_group: bool
+        :param id: int, QQ ID of user or group
+        :return: bytes, or None if not found
+        """
+        cursor = self.database.execute("SELECT data FROM sessions WHERE key = ?", (self.session_key(is_group, id),))
+        ret = cursor.fetchone()
+
+        if ret is None:
+            return None
+
+        return bytes(ret[0])
+
+    def put(self, is_group: bool, id: int, data: bytes):
+        """
+        save checkpoint data of a session, replace the old one and drop its journal atomically
+        :param is_group: bool
+        :param id: int, QQ ID of user or group
+        :param data: bytes
+        :return:
+        """
+        self.put_many([(is_group, id, data)])
+
+    def put_many(self, rows: list, journal_rows: list = ()):
+        """
+        save checkpoint data and append journal entries of multiple sessions in one transaction, all or nothing
+        will be saved. journals of checkpointed sessions are dropped. this method uses its own connection and
+        can be called from another thread
+        :param rows: list of (bool is_group, int id, bytes data), checkpoints
+        :param journal_rows: list of (bool is_group, int id, bytes data), journal entries
+        :return:
+        """
+        ts = int(time.time())
+        with self.__write_lock:
+            if self.__writer is None:
+                self.__writer = sqlite3.connect(self.filename, timeout=5, check_same_thread=False)
+            with self.__writer:
+                self.__writer.executemany("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)",
+                                          [(self.session_key(is_group, id), int(is_group), int(id), data, ts)
+                                           for is_group, id, data in rows])
+                self.__writer.executemany("DELETE FROM journal WHERE key = ?",
+                                          [(self.session_key(is_group, id),) for is_group, id, data in rows])
+                self.__writer.executemany("INSERT INTO journal VALUES (?, ?)",
+                                          [(self.session_key(is_group, id), data)
+                                           for is_group, id, data in journal_rows])
+
+    def append_journal(self, is_group: bool, id: int, data: bytes):
+        """
+        append an entry to journal of a session
+        :param is_group: bool
+        :param id: int, QQ ID of user or group
+        :param data: bytes
+        :return:
+        """
+        self.put_many([], [(is_group, id, data)])
+
+    def get_journal(self, is_group: bool, id: int) -> list:
+        """
+        get journal entries of a session since its last checkpoint in order
+        :param is_group: bool
+        :param id: int, QQ ID of user or group
+        :return: list of bytes
+        """
+        cursor = self.database.execute("SELECT data FROM journal WHERE key = ? ORDER BY rowid",
+                                       (self.session_key(is_group, id),))
+
+        return [bytes(ele[0]) for ele in cursor.fetchall()]
+
+    def remove(self, is_group: bool, id: int):
+        """
+        delete saved data of a session
+        :param is_group: bool
+        :param id: int, QQ ID of user or group
+        :return:
+        """
+        self.database.execute("DELETE FROM sessions WHERE key = ?", (self.session_key(is_group, id),))
+        self.database.execute("DELETE FROM journal WHERE key = ?", (self.session_key(is_group, id),))
+        self._auto_commit()
+
+    def list_sessions(self, is_group: bool) -> list:
+        """
+        return ID of all saved sessions of one kind
+        :param is_group: bool
+        :return: list of int
+        """
+        cursor = self.database.execute("SELECT id FROM sessions WHERE is_group = ?", (int(is_group),))
+
+        return [ele[0] for ele in cursor.fetchall()]
+
+    def has_preset(self, digest: bytes) -> bool:
+        """
+        return whether if a preset is saved
+        :param digest: bytes, sha256 digest of preset data
+        :return: bool
+        """
+        return self.get_preset(digest) is not None
+
+    def get_preset(self, digest: bytes) -> Union[bytes, None]:
+        """
+        get saved preset data shared by sessions
+        :param digest: bytes, sha256 digest of preset data
+        :return: bytes, or None if not found
+        """
+        digest = bytes(digest)
+        ret = self.__presets.get(digest)
+        if ret is None:
+            cursor = self.database.execute("SELECT data FROM presets WHERE digest = ?", (digest,))
+            ret = cursor.fetchone()
+            if ret is None:
+                return None
+            ret = bytes(ret[0])
+            self.__presets[digest] = ret
+
+        return ret
+
+    def put_preset(self, digest: bytes, data: bytes):
+        """
+        save preset data, presets are content addressed so that sessions with the same preset share one copy
+        :param digest: bytes, sha256 digest of preset data
+        :param data: bytes
+        :return:
+        """
+        digest = bytes(digest)
+        self.database.execute("INSERT OR IGNORE INTO presets VALUES (?, ?)", (digest, data))
+        self._auto_commit()
+        self.__presets[digest] = data
+
+    def put_alarm(self, key: str, is_group: bool, id: int, timestamp: float, data: str):
+        """
+        save an alarm, replace the old one with the same key
+        :param key: str, global unique key of alarm
+        :param is_group: bool
+        :param id: int, QQ ID of user or group
+        :param timestamp: float, fire time
+        :param data: str, alarm in json
+        :return:
+        """
+        self.database.execute("INSERT OR REPLACE INTO alarms VALUES (?, ?, ?, ?, ?)",
+                              (key, int(is_group), int(id), float(timestamp), data))
+        self._auto_commit()
+
+    def remove_alarm(self, key: str):
+        """
+        delete a saved alarm
+        :param key: str, global unique key of alarm
+        :return:
+        """
+        self.database.execute("DELETE FROM alarms WHERE key = ?", (key,))
+        self._auto_commit()
+
+    def list_alarms(self) -> list:
+        """
+        return all saved alarms in order of fire time
+        :return: list of str, alarms in json
+        """
+        cursor = self.database.execute("SELECT data FROM alarms ORDER BY timestamp")
+
+        return [ele[0] for ele in cursor.fetchall()]
+
+    def migrate(self, cache_dir: str) -> int:
+        """
+        import session files of old version ('user_<ID>.session' and 'group_<ID>.session') in cache directory
+        in one transaction, files are deleted after imported
+        :param cache_dir: str, directory of session files
+        :return: int, count of sessions imported
+        """
+        files = []
+        for is_group, pattern in ((False, "user_*.session"), (True, "group_*.session")):
+            for ele in Path(cache_dir).glob(pattern):
+                try:
+                    files.append((is_group, int(ele.stem.split("_")[1]), ele))
+                except ValueError:
+                    continue
+
+        if not files:
+            return 0
+
+        with self.database:
+            # commit all or nothing
+            for is_group, id, path in files:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                    f.close()
+                self.database.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)",
+                                      (self.session_key(is_group, id), int(is_group), id, data,
+                                       int(path.stat().st_mtime)))
+
+        for is_group, id, path in files:
+            path.unlink()
+
+        return len(files)
+
+    def close(self):
+        """
+        close connections to database
+        :return:
+        """
+        with self.__write_lock:
+            if self.__writer is not None:
+                self.__writer.close()
+                self.__writer = None
+        super().close()
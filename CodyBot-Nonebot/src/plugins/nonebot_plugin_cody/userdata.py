@@ -6,6 +6,11 @@
 # Created on: 2023/4/28
 
 import json
+import math
+import time
+import heapq
+from collections import OrderedDict, Counter
+from typing import NamedTuple
 from i2cylib.database.sqlite import SqliteDB, SqlTable, SqlDtype, Sqlimit, NewSqlTable
 from pathlib import Path
 from pydantic import BaseModel
@@ -13,7 +18,7 @@ from hashlib import sha256
 
 if __name__ == "__main__":
     class CODY_CONFIG:
-        cody_session_cache_path = "./"
+        cody_session_cache_dir = "./"
     from utils import TimeStamp, CREATOR_ID, CREATOR_GF_ID
 else:
     from .config import CODY_CONFIG
@@ -32,16 +37,160 @@ class ImpressionFrame(BaseModel):
     title: str
     is_group: bool
 
+    class Config:
+        # cached frames are shared by all readers, changes must go through Impression.update_individual or
+        # Impression.update_group
+        allow_mutation = False
+
+
+class ImpressionRow(NamedTuple):
+    # compact read-only form of ImpressionFrame without alternatives and additional json
+    id: int
+    name: str
+    impression: str
+    last_interact_timestamp: int
+    last_interact_session_ID: int
+    last_interact_session_is_group: bool
+    title: str
+    is_group: bool
+
+
+# columns selected for ImpressionRow in order
+IMPRESSION_ROW_COLUMNS = "id, name, impression, last_interact_timestamp, last_interact_session_ID, " \
+                         "last_interact_session_is_group, title"
+
+
+# columns of impression tables in order, id is the primary key
+IMPRESSION_COLUMNS = ("id", "name", "alternatives", "impression", "last_interact_timestamp",
+                      "last_interact_session_ID", "last_interact_session_is_group", "title", "additional_json")
+
+
+def normalize_name(name: str) -> str:
+    """
+    return normalized form of a name used by name index, names are matched case-insensitively
+    :param name: str
+    :return: str
+    """
+    return " ".join(str(name).split()).upper()
+
+
+def frame_names(frame: ImpressionFrame) -> set:
+    """
+    return normalized name and alternative names of an impression frame
+    :param frame: ImpressionFrame
+    :return: set of str
+    """
+    ret = {normalize_name(ele) for ele in (frame.name, *frame.alternatives) if ele}
+    ret.discard("")
+
+    return ret
+
+
+def name_trigrams(name: str) -> set:
+    """
+    return trigrams of a normalized name padded with spaces, so that names of one character still have one
+    :param name: str, normalized name
+    :return: set of str
+    """
+    padded = f" {name} "
+
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+
+    def __init__(self, max_candidates: int = 32):
+        """
+        in-memory trigram index of normalized names for fuzzy matching. names are scored by dice coefficient
+        of their trigram sets, so typos and partial names still match
+        :param max_candidates: int, max count of names scored exactly for one query
+        """
+        self.max_candidates = max_candidates
+
+        self.__trigrams = {}  # format: {trigram: set of names}
+        self.__owners = {}  # format: {name: set of (is_group, id)}
+        self.__sizes = {}  # count of trigrams of names, format: {name: int}
+
+    def __len__(self) -> int:
+        return len(self.__owners)
+
+    def add(self, name: str, owner: tuple):
+        """
+        add a name of a user or group
+        :param name: str, normalized name
+        :param owner: tuple, (bool is_group, int id)
+        :return:
+        """
+        if name not in self.__owners:
+            self.__owners[name] = set()
+            trigrams = name_trigrams(name)
+            self.__sizes[name] = len(trigrams)
+            for ele in trigrams:
+                self.__trigrams.setdefault(ele, set()).add(name)
+        self.__owners[name].add(owner)
+
+    def remove(self, name: str, owner: tuple):
+        """
+        remove a name of a user or group
+        :param name: str, normalized name
+        :param owner: tuple, (bool is_group, int id)
+        :return:
+        """
+        owners = self.__owners.get(name)
+        if owners is None:
+            return
+        owners.discard(owner)
+        if not owners:
+            self.__owners.pop(name)
+            self.__sizes.pop(name)
+            for ele in name_trigrams(name):
+                self.__trigrams[ele].discard(name)
+                if not self.__trigrams[ele]:
+                    self.__trigrams.pop(ele)
+
+    def search(self, name: str, min_score: float = 0.3) -> dict:
+        """
+        return owners of names similar to given name with their best similarity
+        :param name: str, normalized name
+        :param min_score: float, min similarity from 0 to 1
+        :return: dict, format: {(is_group, id): float score}
+        """
+        query = name_trigrams(name)
+        counts = Counter()
+        for ele in query:
+            counts.update(self.__trigrams.get(ele, ()))
+
+        # a name scoring min_score shares at least this many trigrams with query
+        required = min_score * len(query) / (2 - min_score)
+        scores = []
+        for candidate, shared in counts.items():
+            if shared < required:
+                continue
+            # dice coefficient of trigram sets
+            score = 2 * shared / (len(query) + self.__sizes[candidate])
+            if score >= min_score:
+                scores.append((score, candidate))
+
+        ret = {}
+        for score, candidate in heapq.nlargest(self.max_candidates, scores):
+            for owner in self.__owners[candidate]:
+                if score > ret.get(owner, 0):
+                    ret[owner] = score
+
+        return ret
+
 
 class Impression(SqliteDB):
 
-    def __init__(self, database_filename: str = "impression.db"):
+    def __init__(self, database_filename: str = "impression.db", cache_size: int = 4096):
         """
-        impressions of user, connected with local sqlite database
+        impressions of user, connected with local sqlite database. frames are cached in RAM and changes are
+        written to database in one transaction when flush is called
         :param database_filename: str, the filename of database, not path
+        :param cache_size: int, max count of frames without changes kept in RAM
         """
         super().__init__(
-            Path(CODY_CONFIG.cody_session_cache_path).joinpath(database_filename).as_posix()
+            Path(CODY_CONFIG.cody_session_cache_dir).joinpath(database_filename).as_posix()
         )
         self.autocommit = True  # enable auto-commit
         self.connect()
@@ -50,6 +199,11 @@ class Impression(SqliteDB):
         self.__individuals_table = self.select_table("individuals")
         self.__groups_table = self.select_table("groups")
 
+        self.cache_size = cache_size
+        self.__frames = OrderedDict()  # cached frames, least recently used first, format: {(is_group, id): frame}
+        self.__dirty = {}  # changed columns of cached frames not written to database, format: {key: set}
+        self.__name_index: NameIndex = None  # fuzzy name index built on first search
+
     def __init_check(self):
         """
         check and initialize database, create table when initial start or table dose not exists
@@ -88,145 +242,401 @@ class Impression(SqliteDB):
 
             self.create_table(new_table)
 
-    def update_group(self, id: int, name: str = None,
-                     alternatives: str = None,
-                     impression: str = None,
-                     last_interact_timestamp: int = None,
-                     last_interact_session_ID: int = None,
-                     last_interact_session_is_group: bool = None,
-                     title: str = None,
-                     additional_json: dict = None):
+        if "names" not in self:
+            new_table = NewSqlTable("names")
+            new_table.add_column('name', SqlDtype.TEXT)  # normalized name or alternative name
+            new_table.add_column('is_group', SqlDtype.INTEGER)
+            new_table.add_column('id', SqlDtype.INTEGER)
+            new_table.add_limit(0, Sqlimit.NOT_NULL)
+            new_table.add_limit(1, Sqlimit.NOT_NULL)
+            new_table.add_limit(2, Sqlimit.NOT_NULL)
+
+            self.create_table(new_table)
+            # names are looked up by name, and replaced by owner when name or alternatives changed
+            self.database.execute("CREATE INDEX IF NOT EXISTS names_name ON names (name, is_group)")
+            self.database.execute("CREATE INDEX IF NOT EXISTS names_owner ON names (id, is_group)")
+
+            # index names of existing users and groups
+            for is_group, table_name in ((False, "individuals"), (True, "groups")):
+                cursor = self.database.execute(f"SELECT id, name, alternatives FROM {table_name}")
+                self.database.executemany(
+                    "INSERT INTO names VALUES (?, ?, ?)",
+                    [(name, int(is_group), ele[0])
+                     for ele in cursor.fetchall()
+                     for name in {normalize_name(alias) for alias in (ele[1], *json.loads(ele[2])) if alias}]
+                )
+            self._auto_commit()
+
+        # recent contacts are selected by time of last interaction
+        self.database.execute("CREATE INDEX IF NOT EXISTS individuals_last_interact "
+                              "ON individuals (last_interact_timestamp)")
+        self.database.execute("CREATE INDEX IF NOT EXISTS groups_last_interact "
+                              "ON groups (last_interact_timestamp)")
+        self._auto_commit()
+
+    @staticmethod
+    def __default_frame(is_group: bool, id: int) -> ImpressionFrame:
         """
-        Update impression information of a group
-        :param id: int, group ID, usually QQ ID
-        :param name: str, nickname that Cody would call for this group
-        :param alternatives: str, list of alternative names in json text
-        :param impression: str, impression text
-        :param last_interact_timestamp: int, timestamp of last interact
-        :param last_interact_session_ID: int, session ID of last interact session
-        :param last_interact_session_is_group: bool, whether the last interact location is
-        :param title: str, title for this group, e.g. 'creator', 'friends', 'enemy'
-        :param additional_json: dict, additional storage in json text, can be used for plugin storage
+        create impression frame of a group or user not in database
+        :param is_group: bool
+        :param id: int, QQ ID
+        :return: ImpressionFrame
+        """
+        name = f"Unknown_{id}"
+        alternatives = []
+        title = ""
+
+        if not is_group:
+            id_hash = sha256(str(id).encode()).hexdigest()
+            if id_hash == CREATOR_ID:
+                # creator auto-correction
+                name = "Icy"
+                alternatives = ['艾昔', 'ccy', '吸吸歪']
+                title = "creator(admin)"
+            elif id_hash == CREATOR_GF_ID:
+                # creator's girl auto-correction
+                name = "Miuto"
+                alternatives = ['猫条']
+                title = "besties(admin)"
+            else:
+                # anonymous
+                title = "stranger"
+
+        return ImpressionFrame(
+            id=id,  # QQ ID in int
+            name=name,  # nickname in str
+            alternatives=alternatives,  # alternative names
+            impression="",  # impression text in str
+            last_interact_timestamp={"timestamp": -1},  # timestamp when last interact, -1 stands for never
+            last_interact_session_ID=-1,  # session ID of last interact, -1 stands for none
+            last_interact_session_is_group=False,  # weather if last interact session is a group chat
+            title=title,  # title, e.g. 'creator', 'friends', 'enemy'
+            additional_json={},  # additional json storage for plugins
+            is_group=is_group
+        )
+
+    def __get_frame(self, is_group: bool, id: int) -> ImpressionFrame:
+        """
+        return cached impression frame, load it from database or create default one if it is not in RAM
+        :param is_group: bool
+        :param id: int, QQ ID
+        :return: ImpressionFrame, the cached object itself
+        """
+        key = (is_group, int(id))
+        frame = self.__frames.get(key)
+        if frame is not None:
+            self.__frames.move_to_end(key)
+            return frame
+
+        table_name = "groups" if is_group else "individuals"
+        data = self.database.execute(f"SELECT * FROM {table_name} WHERE id = ?", (key[1],)).fetchone()
+        if data is None:
+            # if not exists, create default
+            frame = self.__default_frame(is_group, key[1])
+            self.__dirty[key] = set(IMPRESSION_COLUMNS[1:])
+        else:
+            frame = ImpressionFrame(
+                id=data[0],
+                name=data[1],
+                alternatives=json.loads(data[2]),
+                impression=data[3],
+                last_interact_timestamp={"timestamp": data[4]},
+                last_interact_session_ID=data[5],
+                last_interact_session_is_group=data[6],
+                title=data[7],
+                additional_json=json.loads(data[8]),
+                is_group=is_group
+            )
+
+        self.__frames[key] = frame
+        self.__evict_overflow()
+
+        return frame
+
+    def __evict_overflow(self):
+        """
+        drop the least recently used frames without changes until cache fits in cache size
         :return:
         """
-        # when line with given id is not in table
-        if id not in self.__groups_table:
-            if name is None:
-                name = f"Unknown_{id}"
+        if len(self.__frames) <= self.cache_size:
+            return
+
+        for key in list(self.__frames):
+            if len(self.__frames) <= self.cache_size:
+                break
+            if key not in self.__dirty:
+                self.__frames.pop(key)
+
+    def __update(self, is_group: bool, id: int, name: str = None,
+                 alternatives: list = None,
+                 impression: str = None,
+                 last_interact_timestamp: int = None,
+                 last_interact_session_ID: int = None,
+                 last_interact_session_is_group: bool = None,
+                 title: str = None,
+                 additional_json: dict = None):
+        """
+        apply changes to cached frame and mark it dirty, see update_individual for parameters
+        """
+        old_frame = self.__get_frame(is_group, id)
+        columns = self.__dirty.setdefault((is_group, int(id)), set())
+        old_names = frame_names(old_frame)
+        changes = {}
 
-            if alternatives is None:
-                alternatives = "[]"
+        if name is not None:  # update name
+            changes['name'] = name
 
-            if last_interact_timestamp is None:
-                last_interact_timestamp = -1
+        if alternatives is not None:  # update alternative names, json text is also accepted
+            changes['alternatives'] = json.loads(alternatives) if isinstance(alternatives, str) \
+                else list(alternatives)
 
-            if last_interact_session_ID is None:
-                last_interact_session_ID = -1
+        if impression is not None:  # update impression text
+            changes['impression'] = impression
 
-            if last_interact_session_is_group is None:
-                last_interact_session_is_group = False
+        if last_interact_timestamp is not None:  # update interact timestamp
+            changes['last_interact_timestamp'] = TimeStamp(int(last_interact_timestamp))
 
-            if impression is None:
-                impression = ""
+        if last_interact_session_ID is not None:  # update interact session ID
+            changes['last_interact_session_ID'] = last_interact_session_ID
 
-            if title is None:
-                title = ""
+        if last_interact_session_is_group is not None:  # update is_group of interact session
+            changes['last_interact_session_is_group'] = last_interact_session_is_group
 
-            if additional_json is None:
-                additional_json = {}
+        if title is not None:  # update title
+            changes['title'] = title
 
-            self.__groups_table.append(
-                [
-                    id,  # QQ ID in int
-                    name,  # nickname in str
-                    alternatives,  # alternative names in json text
-                    impression,  # impression text in str
-                    last_interact_timestamp,  # timestamp when last interact, -1 stands for never
-                    last_interact_session_ID,  # session ID of last interact, -1 stands for none
-                    last_interact_session_is_group,  # weather if last interact session is a group chat
-                    title,  # title for this group, e.g. 'admin', 'close-friends', 'notice'
-                    json.dumps(additional_json)  # additional json text storage for plugins
-                ]
-            )
+        if additional_json is not None:  # update additions
+            changes['additional_json'] = dict(additional_json)
 
-        else:
-            if name is not None:  # update name
-                self.__groups_table.update(name, id, 'name')
+        frame = old_frame
+        if changes:
+            # replace cached frame with an updated copy, frames handed out before stay unchanged
+            frame = old_frame.copy(update=changes)
+            self.__frames[(is_group, int(id))] = frame
+            columns.update(changes)
 
-            if alternatives is not None:  # update alternative names
-                alternatives = json.dumps(alternatives)
-                self.__groups_table.update(alternatives, id, 'alternatives')
+        if not columns:
+            # nothing changed
+            self.__dirty.pop((is_group, int(id)))
 
-            if impression is not None:  # update impression text
-                self.__groups_table.update(impression, id, 'impression')
+        if self.__name_index is not None and (name is not None or alternatives is not None):
+            # keep fuzzy name index up to date right away
+            new_names = frame_names(frame)
+            for ele in old_names - new_names:
+                self.__name_index.remove(ele, (is_group, frame.id))
+            for ele in new_names - old_names:
+                self.__index_name(ele, (is_group, frame.id))
 
-            if last_interact_timestamp is not None:  # update interact timestamp
-                self.__groups_table.update(last_interact_timestamp, id, 'last_interact_timestamp')
+    @staticmethod
+    def __upsert_statement(is_group: bool, columns: tuple) -> str:
+        """
+        return statement that inserts a whole row, or updates only given columns if the row exists
+        :param is_group: bool
+        :param columns: tuple, names of changed columns
+        :return: str
+        """
+        return "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT (id) DO UPDATE SET {}".format(
+            'groups' if is_group else 'individuals',
+            ", ".join(IMPRESSION_COLUMNS),
+            ", ".join("?" * len(IMPRESSION_COLUMNS)),
+            ", ".join(f"{ele} = excluded.{ele}" for ele in columns)
+        )
 
-            if last_interact_session_ID is not None:  # update interact session ID
-                self.__groups_table.update(last_interact_session_ID, id, 'last_interact_session_ID')
+    def flush(self) -> int:
+        """
+        write all changed frames to database in one transaction, existing rows are updated only in changed
+        columns, frames with the same changed columns share one statement
+        :return: int, count of frames written
+        """
+        if not self.__dirty:
+            return 0
+
+        rows = {}  # format: {(is_group, changed columns): list of rows}
+        renamed = []  # owners of names to replace in name index, format: [(is_group, id)]
+        name_rows = []
+        for (is_group, id), columns in self.__dirty.items():
+            frame = self.__frames[(is_group, id)]
+            if 'name' in columns or 'alternatives' in columns:
+                renamed.append((id, int(is_group)))
+                name_rows.extend((ele, int(is_group), id) for ele in frame_names(frame))
+            columns = tuple(ele for ele in IMPRESSION_COLUMNS if ele in columns)
+            rows.setdefault((is_group, columns), []).append((
+                frame.id,
+                frame.name,
+                json.dumps(frame.alternatives),
+                frame.impression,
+                int(frame.last_interact_timestamp),
+                frame.last_interact_session_ID,
+                int(frame.last_interact_session_is_group),
+                frame.title,
+                json.dumps(frame.additional_json)
+            ))
+
+        with self.database:
+            # commit all or nothing
+            for (is_group, columns), table_rows in rows.items():
+                self.database.executemany(self.__upsert_statement(is_group, columns), table_rows)
+            if renamed:
+                self.database.executemany("DELETE FROM names WHERE id = ? AND is_group = ?", renamed)
+                self.database.executemany("INSERT INTO names VALUES (?, ?, ?)", name_rows)
+
+        ret = len(self.__dirty)
+        self.__dirty.clear()
+        self.__evict_overflow()
 
-            if last_interact_session_is_group is not None:  # update is_group of interact session
-                self.__groups_table.update(last_interact_session_is_group, id,
-                                           'last_interact_session_is_group')
+        return ret
 
-            if title is not None:  # update title
-                self.__groups_table.update(title, id, 'title')
+    def update_many(self, frames: list) -> int:
+        """
+        replace impression frames of many users or groups and write them to database in one transaction,
+        together with other changes not written yet
+        :param frames: list of ImpressionFrame
+        :return: int, count of frames written
+        """
+        for ele in frames:
+            key = (ele.is_group, int(ele.id))
+            self.__frames[key] = ele.copy(deep=True)
+            self.__frames.move_to_end(key)
+            self.__dirty[key] = set(IMPRESSION_COLUMNS[1:])
 
-            if additional_json is not None:  # update additions
-                self.__groups_table.update(json.dumps(additional_json), id, 'additional_json')
+        ret = self.flush()
+        # old names of replaced frames are unknown, rebuild fuzzy name index on next search
+        self.__name_index = None
+
+        return ret
+
+    def close(self):
+        """
+        write changed frames and close database
+        :return:
+        """
+        self.flush()
+        super().close()
+
+    def update_group(self, id: int, name: str = None,
+                     alternatives: list = None,
+                     impression: str = None,
+                     last_interact_timestamp: int = None,
+                     last_interact_session_ID: int = None,
+                     last_interact_session_is_group: bool = None,
+                     title: str = None,
+                     additional_json: dict = None):
+        """
+        Update impression information of a group, changes are written to database on next flush
+        :param id: int, group ID, usually QQ ID
+        :param name: str, nickname that Cody would call for this group
+        :param alternatives: list, list of alternative names
+        :param impression: str, impression text
+        :param last_interact_timestamp: int, timestamp of last interact
+        :param last_interact_session_ID: int, session ID of last interact session
+        :param last_interact_session_is_group: bool, whether the last interact location is
+        :param title: str, title for this group, e.g. 'creator', 'friends', 'enemy'
+        :param additional_json: dict, additional storage in json text, can be used for plugin storage
+        :return:
+        """
+        self.__update(True, id, name=name, alternatives=alternatives, impression=impression,
+                      last_interact_timestamp=last_interact_timestamp,
+                      last_interact_session_ID=last_interact_session_ID,
+                      last_interact_session_is_group=last_interact_session_is_group,
+                      title=title, additional_json=additional_json)
 
     def get_group(self, id: int) -> ImpressionFrame:
         """
         get impression information of a group
         :param id: int, QQ chat group ID
-        :return: ImpressionFrame
+        :return: ImpressionFrame, the cached frame which is read-only, copy its list and dict before modifying
         """
-        if id in self.__groups_table:
-            data = self.__groups_table.get(id)
-        else:
-            self.update_group(id)  # if not exists, create default
-            data = self.__groups_table.get(id)
-
-        ret = ImpressionFrame(
-            id=data[0],
-            name=data[1],
-            alternatives=json.loads(data[2]),
-            impression=data[3],
-            last_interact_timestamp={"timestamp": data[4]},
-            last_interact_session_ID=data[5],
-            last_interact_session_is_group=data[6],
-            title=data[7],
-            additional_json=json.loads(data[8]),
-            is_group=True
-        )
-
-        return ret
+        return self.__get_frame(True, id)
 
     def get_individual(self, id: int) -> ImpressionFrame:
         """
         get impression information of an individual
         :param id: int, QQ ID
-        :return: ImpressionFrame
+        :return: ImpressionFrame, the cached frame which is read-only, copy its list and dict before modifying
         """
-        if id in self.__individuals_table:
-            data = self.__individuals_table.get(id)[0]
-        else:
-            self.update_individual(id)  # if not exists, create default
-            data = self.__individuals_table.get(id)[0]
-
-        ret = ImpressionFrame(
-            id=data[0],
-            name=data[1],
-            alternatives=json.loads(data[2]),
-            impression=data[3],
-            last_interact_timestamp={"timestamp": data[4]},
-            last_interact_session_ID=data[5],
-            last_interact_session_is_group=data[6],
-            title=data[7],
-            additional_json=json.loads(data[8]),
-            is_group=False
+        return self.__get_frame(False, id)
+
+    @staticmethod
+    def __frame_row(frame: ImpressionFrame) -> ImpressionRow:
+        """
+        convert impression frame to compact form
+        :param frame: ImpressionFrame
+        :return: ImpressionRow
+        """
+        return ImpressionRow(frame.id, frame.name, frame.impression, int(frame.last_interact_timestamp),
+                             frame.last_interact_session_ID, bool(frame.last_interact_session_is_group),
+                             frame.title, frame.is_group)
+
+    def get_many(self, ids: list, is_group: bool = False) -> list:
+        """
+        get impression information of many users or groups in compact form, cached frames are used as they are
+        and the others are read in one query. unknown ID are skipped without creating default frames
+        :param ids: list of int, QQ ID
+        :param is_group: bool, get groups instead of users
+        :return: list of ImpressionRow, in order of given ID
+        """
+        rows = {}
+        missing = []
+        for id in ids:
+            frame = self.__frames.get((is_group, int(id)))
+            if frame is None:
+                missing.append(int(id))
+            else:
+                rows[frame.id] = self.__frame_row(frame)
+
+        for i in range(0, len(missing), 500):
+            # keep variables of one statement under the limit of sqlite
+            chunk = missing[i:i + 500]
+            cursor = self.database.execute(
+                f"SELECT {IMPRESSION_ROW_COLUMNS} FROM {'groups' if is_group else 'individuals'} "
+                f"WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            for ele in cursor.fetchall():
+                rows[ele[0]] = ImpressionRow(*ele[:5], bool(ele[5]), ele[6], is_group)
+
+        return [rows[int(id)] for id in ids if int(id) in rows]
+
+    def iter_recent(self, since_ts: float, limit: int = None, is_group: bool = False):
+        """
+        iterate users or groups interacted since a time in compact form, the most recent first
+        :param since_ts: float, timestamp of the earliest interaction
+        :param limit: int (optional), max count of rows
+        :param is_group: bool, iterate groups instead of users
+        :return: Generator of ImpressionRow
+        """
+        cursor = self.database.execute(
+            f"SELECT {IMPRESSION_ROW_COLUMNS} FROM {'groups' if is_group else 'individuals'} "
+            "WHERE last_interact_timestamp >= ? ORDER BY last_interact_timestamp DESC LIMIT ?",
+            (since_ts, -1 if limit is None else int(limit))
         )
+        rows = {ele[0]: ImpressionRow(*ele[:5], bool(ele[5]), ele[6], is_group) for ele in cursor.fetchall()}
+
+        # changes in RAM not written yet
+        for group, id in self.__dirty:
+            if group != is_group:
+                continue
+            frame = self.__frames[(group, id)]
+            if int(frame.last_interact_timestamp) >= since_ts:
+                rows[id] = self.__frame_row(frame)
+            else:
+                rows.pop(id, None)
+
+        ret = sorted(rows.values(), key=lambda ele: ele.last_interact_timestamp, reverse=True)
+        if limit is not None:
+            ret = ret[:limit]
+
+        yield from ret
+
+    def __list_ids(self, is_group: bool) -> list:
+        """
+        return ID in database and ID of new frames not written yet
+        :param is_group: bool
+        :return: list
+        """
+        table = self.__groups_table if is_group else self.__individuals_table
+        ret = [ele[0] for ele in table.get(column_names='id')]
+        known = set(ret)
+        ret.extend(id for group, id in self.__dirty if group == is_group and id not in known)
 
         return ret
 
@@ -236,7 +646,7 @@ class Impression(SqliteDB):
         :return: list
         """
         # get a list of ID of users from database
-        return [ele[0] for ele in self.__individuals_table.get(column_names='id')]
+        return self.__list_ids(False)
 
     def list_groups(self) -> list:
         """
@@ -244,7 +654,131 @@ class Impression(SqliteDB):
         :return: list
         """
         # get a list of ID of groups from database
-        return [ele[0] for ele in self.__groups_table.get(column_names='id')]
+        return self.__list_ids(True)
+
+    def find_by_name(self, name: str, is_group: bool = False) -> list:
+        """
+        return ID of users or groups whose name or alternative name matches given name, case-insensitive
+        :param name: str
+        :param is_group: bool, find groups instead of users
+        :return: list of int
+        """
+        name = normalize_name(name)
+        cursor = self.database.execute("SELECT DISTINCT id FROM names WHERE name = ? AND is_group = ?",
+                                       (name, int(is_group)))
+        ret = [ele[0] for ele in cursor.fetchall()]
+
+        # names changed in RAM but not written yet
+        for (group, id), columns in self.__dirty.items():
+            if group != is_group or not ('name' in columns or 'alternatives' in columns):
+                continue
+            matched = name in frame_names(self.__frames[(group, id)])
+            if matched and id not in ret:
+                ret.append(id)
+            elif not matched and id in ret:
+                ret.remove(id)
+
+        return ret
+
+    def __index_name(self, name: str, owner: tuple):
+        """
+        add a name to fuzzy name index, placeholder names of unknown users are skipped
+        :param name: str, normalized name
+        :param owner: tuple, (bool is_group, int id)
+        :return:
+        """
+        if name != f"UNKNOWN_{owner[1]}":
+            self.__name_index.add(name, owner)
+
+    def __build_name_index(self):
+        """
+        build fuzzy name index from name index table and names changed in RAM
+        :return:
+        """
+        self.__name_index = NameIndex()
+        for name, is_group, id in self.database.execute("SELECT name, is_group, id FROM names"):
+            key = (bool(is_group), id)
+            columns = self.__dirty.get(key, ())
+            if 'name' in columns or 'alternatives' in columns:
+                continue
+            self.__index_name(name, key)
+
+        for key, columns in self.__dirty.items():
+            if 'name' in columns or 'alternatives' in columns:
+                for ele in frame_names(self.__frames[key]):
+                    self.__index_name(ele, key)
+
+    def search_names(self, name: str, is_group: bool = False, limit: int = 5,
+                     session_id: int = None, session_is_group: bool = False,
+                     min_score: float = 0.3, half_life: float = 604800) -> list:
+        """
+        fuzzy match users or groups by name and alternative names. candidates are ranked by name similarity,
+        weighted by how recently they interacted and whether they interacted in current session
+        :param name: str
+        :param is_group: bool, search groups instead of users
+        :param limit: int, max count of candidates
+        :param session_id: int (optional), ID of current session
+        :param session_is_group: bool, whether current session is a group chat
+        :param min_score: float, min name similarity from 0 to 1
+        :param half_life: float, seconds after which weight of recency halves
+        :return: list of (int id, float score), the best first, exact matches score at least 0.7
+        """
+        if self.__name_index is None:
+            self.__build_name_index()
+
+        matches = {owner[1]: score
+                   for owner, score in self.__name_index.search(normalize_name(name), min_score).items()
+                   if owner[0] == is_group}
+        if not matches:
+            return []
+
+        # fetch last interactions of candidates, from cache if possible
+        interactions = {}
+        missing = []
+        for id in matches:
+            frame = self.__frames.get((is_group, id))
+            if frame is None:
+                missing.append(id)
+            else:
+                interactions[id] = (int(frame.last_interact_timestamp), frame.last_interact_session_ID,
+                                    bool(frame.last_interact_session_is_group))
+        if missing:
+            cursor = self.database.execute(
+                "SELECT id, last_interact_timestamp, last_interact_session_ID, last_interact_session_is_group "
+                f"FROM {'groups' if is_group else 'individuals'} WHERE id IN ({', '.join('?' * len(missing))})",
+                missing
+            )
+            for ele in cursor.fetchall():
+                interactions[ele[0]] = (ele[1], ele[2], bool(ele[3]))
+
+        now = time.time()
+        ret = []
+        for id, similarity in matches.items():
+            timestamp, last_session_id, last_session_is_group = interactions.get(id, (-1, -1, False))
+            recency = math.pow(0.5, max(now - timestamp, 0) / half_life) if timestamp > 0 else 0
+            related = session_id is not None and last_session_id == session_id \
+                and last_session_is_group == session_is_group
+            ret.append((id, similarity * (0.7 + 0.2 * recency + 0.1 * related)))
+
+        ret.sort(key=lambda ele: ele[1], reverse=True)
+
+        return ret[:limit]
+
+    def list_recent_sessions(self, limit: int) -> list:
+        """
+        return the most recently active sessions according to last interaction of users
+        :param limit: int, max count of sessions
+        :return: list of (bool is_group, int session_ID), the most recent first
+        """
+        cursor = self.database.execute(
+            "SELECT last_interact_session_is_group, last_interact_session_ID, "
+            "MAX(last_interact_timestamp) AS ts FROM individuals "
+            "WHERE last_interact_timestamp > 0 AND last_interact_session_ID > 0 "
+            "GROUP BY last_interact_session_is_group, last_interact_session_ID "
+            "ORDER BY ts DESC LIMIT ?", (int(limit),)
+        )
+
+        return [(bool(ele[0]), ele[1]) for ele in cursor.fetchall()]
 
     def update_individual(self, id: int, name: str = None,
                           alternatives: list = None,
@@ -255,10 +789,10 @@ class Impression(SqliteDB):
                           title: str = None,
                           additional_json: dict = None):
         """
-        Update impression information of an individual
+        Update impression information of an individual, changes are written to database on next flush
         :param id: int, user ID, usually QQ ID
         :param name: str, nickname that Cody would call
-        :param alternatives: list, list of alternative names in json text
+        :param alternatives: list, list of alternative names
         :param impression: str, impression text
         :param last_interact_timestamp: int, timestamp of last interact
         :param last_interact_session_ID: int, session ID of last interact session
@@ -267,99 +801,11 @@ class Impression(SqliteDB):
         :param additional_json: dict, additional storage in json text, can be used for plugin storage
         :return:
         """
-
-        # when line with given id is not in table
-        if id not in self.__individuals_table:
-            id_hash = sha256(str(id).encode()).hexdigest()
-
-            if name is None:
-                if id_hash == CREATOR_ID:
-                    # creator auto-correction
-                    name = "Icy"
-                elif id_hash == CREATOR_GF_ID:
-                    # creator's girl auto-correction
-                    name = "Miuto"
-                else:
-                    # anonymous
-                    name = f"Unknown_{id}"
-
-            if alternatives is None:
-                if id_hash == CREATOR_ID:
-                    # creator auto-correction
-                    alternatives = json.dumps(['艾昔', 'ccy', '吸吸歪'])
-                elif id_hash == CREATOR_GF_ID:
-                    # creator's girl auto-correction
-                    alternatives = json.dumps(['猫条'])
-                else:
-                    # anonymous
-                    alternatives = "[]"
-
-            if last_interact_timestamp is None:
-                last_interact_timestamp = -1
-
-            if last_interact_session_ID is None:
-                last_interact_session_ID = -1
-
-            if last_interact_session_is_group is None:
-                last_interact_session_is_group = False
-
-            if impression is None:
-                impression = ""
-
-            if title is None:
-                if id_hash == CREATOR_ID:
-                    # creator auto-correction
-                    title = "creator(admin)"
-                elif id_hash == CREATOR_GF_ID:
-                    # creator's girl auto-correction
-                    name = "besties(admin)"
-                else:
-                    # anonymous
-                    title = "stranger"
-
-            if additional_json is None:
-                additional_json = {}
-
-            self.__individuals_table.append(
-                [
-                    id,  # QQ ID in int
-                    name,  # nickname in str
-                    alternatives,  # alternative names in json text
-                    impression,  # impression text in str
-                    last_interact_timestamp,  # timestamp when last interact, -1 stands for never
-                    last_interact_session_ID,  # session ID of last interact, -1 stands for none
-                    last_interact_session_is_group,  # weather if last interact session is a group chat
-                    title,  # title for this user, e.g. 'creator', 'friends', 'enemy'
-                    json.dumps(additional_json)  # additional json text storage for plugins
-                ]
-            )
-
-        else:
-            if name is not None:  # update name
-                self.__individuals_table.update(name, id, 'name')
-
-            if alternatives is not None:  # update alternative names
-                alternatives = json.dumps(alternatives)
-                self.__individuals_table.update(alternatives, id, 'alternatives')
-
-            if impression is not None:  # update impression text
-                self.__individuals_table.update(impression, id, 'impression')
-
-            if last_interact_timestamp is not None:  # update interact timestamp
-                self.__individuals_table.update(last_interact_timestamp, id, 'last_interact_timestamp')
-
-            if last_interact_session_ID is not None:  # update interact session ID
-                self.__individuals_table.update(last_interact_session_ID, id, 'last_interact_session_ID')
-
-            if last_interact_session_is_group is not None:  # update is_group of interact session
-                self.__individuals_table.update(last_interact_session_is_group, id,
-                                                'last_interact_session_is_group')
-
-            if title is not None:  # update title
-                self.__individuals_table.update(title, id, 'title')
-
-            if additional_json is not None:  # update additions
-                self.__individuals_table.update(json.dumps(additional_json), id, 'additional_json')
+        self.__update(False, id, name=name, alternatives=alternatives, impression=impression,
+                      last_interact_timestamp=last_interact_timestamp,
+                      last_interact_session_ID=last_interact_session_ID,
+                      last_interact_session_is_group=last_interact_session_is_group,
+                      title=title, additional_json=additional_json)
 
 
 if __name__ == '__main__':
@@ -6,6 +6,7 @@
 # Created on: 2023/4/30
 
 import time
+import tiktoken
 from copy import copy
 from datetime import datetime, timedelta
 from typing import Union
@@ -14,6 +15,34 @@ from pydantic import BaseModel
 CREATOR_ID = "80b3456f5f8398d38d659e2d2930e26544a61f0482180d00161cae78171d8d60"
 CREATOR_GF_ID = "fa06dac2564d6b1995467e83c31e270b69de53160ce4c26ca913e28ea3a8669a"
 
+TOKEN_ENCODER = tiktoken.encoding_for_model("gpt-3.5-turbo")  # shared encoder, initialize once only
+REPLY_PRIMER_TOKENS = 3  # every reply of chat API is primed with <|start|>assistant<|message|>
+SENTENCE_TAILS = {"”", "’", "\"", "'", ")", "）", "」", "』", "]", "】"}  # characters that may follow punctuations
+
+
+def count_tokens(text: str) -> int:
+    """
+    return token count of given text
+    :param text: str
+    :return: int
+    """
+    return len(TOKEN_ENCODER.encode(text))
+
+
+def count_message_tokens(message: dict) -> int:
+    """
+    return token count of one message of chat API, including the format overhead of chat API
+    :param message: dict, e.g. {"role": "user", "content": "hi", "name": "123"}
+    :return: int
+    """
+    ret = 3  # every message is wrapped with <|start|>{role/name}\n{content}<|end|>
+    for key, value in message.items():
+        ret += len(TOKEN_ENCODER.encode(value))
+        if key == "name":
+            ret += 1
+
+    return ret
+
 
 class Usage(BaseModel):
     completion_tokens: int = -1
@@ -227,6 +256,127 @@ def extract_json_and_purge_cody_response(response: GPTResponse) -> (str, GPTResp
     return json_text, response
 
 
+class SentenceSplitter:
+
+    def __init__(self, punctuations: set):
+        """
+        split streamed text into complete sentences, the leading JSON action text will be held back until it closes
+        :param punctuations: set, punctuations that end a sentence
+        """
+        self.punctuations = punctuations
+        self.buffer = ""
+        self.json_text = ""  # leading JSON action text
+        self.json_closed = False
+        self.__json_depth = 0
+
+    def __hold_json(self):
+        """
+        move leading JSON action text from buffer to self.json_text
+        :return:
+        """
+        if not self.json_text:
+            stripped = self.buffer.lstrip()
+            if not stripped:
+                return
+            if stripped[0] != "{":
+                # no action JSON in this response
+                self.json_closed = True
+                return
+            self.buffer = stripped
+
+        for i, ele in enumerate(self.buffer):
+            if ele == "{":
+                self.__json_depth += 1
+            elif ele == "}":
+                self.__json_depth -= 1
+                if self.__json_depth == 0:
+                    self.json_text += self.buffer[:i + 1]
+                    self.buffer = self.buffer[i + 1:].lstrip()
+                    self.json_closed = True
+                    return
+
+        self.json_text += self.buffer
+        self.buffer = ""
+
+    def __sentence_end(self, index: int) -> int:
+        """
+        return end index of punctuation run starting at index, or -1 if it is not a sentence end
+        :param index: int
+        :return: int
+        """
+        buffer = self.buffer
+        if buffer[index:index + 2] in self.punctuations:
+            end = index + 2
+        elif buffer[index] in self.punctuations:
+            end = index + 1
+        else:
+            return -1
+
+        # absorb following punctuations and closing quotes
+        while end < len(buffer) and (buffer[end] in self.punctuations or buffer[end] in SENTENCE_TAILS
+                                     or buffer[end:end + 2] in self.punctuations):
+            end += 1
+
+        if end >= len(buffer):
+            # wait for next character to make sure punctuation run ends
+            return -1
+
+        if buffer[index] == "." and not buffer[end].isspace():
+            # skip decimals and abbreviations, e.g. 3.14
+            return -1
+
+        return end
+
+    def feed(self, text: str) -> list:
+        """
+        feed a piece of streamed text and return completed sentences
+        :param text: str
+        :return: list of str
+        """
+        self.buffer += text
+        if not self.json_closed:
+            self.__hold_json()
+            if not self.json_closed:
+                return []
+
+        ret = []
+        start = 0
+        i = 0
+        while i < len(self.buffer):
+            end = self.__sentence_end(i)
+            if end == -1:
+                i += 1
+                continue
+            sentence = self.buffer[start:end].strip()
+            if sentence:
+                ret.append(sentence)
+            start = end
+            i = end
+
+        self.buffer = self.buffer[start:]
+
+        return ret
+
+    def flush(self) -> list:
+        """
+        return all the rest text as a sentence
+        :return: list of str
+        """
+        ret = []
+        if not self.json_closed:
+            # JSON never closed, treat it as plain text
+            self.buffer = self.json_text + self.buffer
+            self.json_text = ""
+            self.json_closed = True
+
+        rest = self.buffer.strip()
+        if rest:
+            ret.append(rest)
+        self.buffer = ""
+
+        return ret
+
+
 if __name__ == '__main__':
     ts = TimeStamp(time.time())
     ts_copy = TimeStamp(**ts.dict())